@@ -0,0 +1,259 @@
+"""
+Case insensitive account uniqueness and bulk user provisioning.
+
+Usernames and emails are compared in lower case through the indexed
+UserKey table, so checking a registration, or a batch of a roster, is
+one index lookup rather than an iexact scan of auth_user.
+
+provision() creates users from a roster (see read_roster) a batch at a
+time: every batch is checked against the keys with two queries, its
+passwords are hashed by a pool of worker processes (password hashing is
+deliberately slow, and is by far the largest cost), and its users and
+keys are written with bulk inserts. Only one batch of rows and the keys
+seen in the file are held in memory.
+
+Usernames that already differ only by case in auth_user cannot all have
+keys: the first such user keeps the key and rebuild_keys logs and reports
+the others. Everywhere else a username taken in another case is an
+IntegrityError.
+"""
+import csv
+import logging
+import multiprocessing
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.color import no_style
+from django.core.validators import validate_email
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Max
+from django.utils.encoding import force_text
+
+from ems.models import UserKey
+
+logger = logging.getLogger('ems.accounts')
+
+COLUMNS = ('username', 'email', 'first_name', 'last_name', 'password')
+
+REQUIRED_COLUMNS = ('username', 'email')
+
+# Keys per "IN" clause (SQLite allows 999 parameters)
+LOOKUP_CHUNK = 500
+
+
+class RowRejected(Exception):
+    """
+    Raised when a roster row cannot be provisioned
+    """
+    pass
+
+
+def normalize(value):
+    return force_text(value or '').strip().lower()
+
+
+def username_taken(username):
+    return UserKey.objects.filter(username=normalize(username)).exists()
+
+
+def email_taken(email):
+    return UserKey.objects.filter(email=normalize(email)).exclude(email='').exists()
+
+
+def _taken(field, keys):
+    keys = list(set(keys))
+    taken = set()
+    for start in range(0, len(keys), LOOKUP_CHUNK):
+        taken.update(UserKey.objects.filter(**{field + '__in': keys[start:start + LOOKUP_CHUNK]})
+                                    .values_list(field, flat=True))
+    return taken
+
+
+def key_for(user):
+    return UserKey(user_id=user.pk, username=normalize(user.username), email=normalize(user.email))
+
+
+def save_key(user):
+    """
+    Save a user's key, replacing the one it had. Raises IntegrityError
+    when another user already holds the username in another case, so save
+    the user and its key in one transaction.
+    """
+    key_for(user).save()
+
+
+def rebuild_keys(chunk_size=1000):
+    """
+    Recreate every user's key. Returns the number of keys written and the
+    users left without one because an earlier user has the same username
+    in another case.
+    """
+    count = 0
+    duplicates = []
+    seen = set()
+    with transaction.atomic():
+        UserKey.objects.all().delete()
+        users = User.objects.order_by('pk').only('pk', 'username', 'email')
+        batch = []
+        for user in users.iterator():
+            key = key_for(user)
+            if key.username in seen:
+                logger.warning("User %d has no user key: username '%s' is already in use in another case",
+                               user.pk, user.username)
+                duplicates.append(user)
+                continue
+            seen.add(key.username)
+            batch.append(key)
+            if len(batch) >= chunk_size:
+                UserKey.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        UserKey.objects.bulk_create(batch)
+        count += len(batch)
+    return count, duplicates
+
+
+# ----------------------------- Provisioning ----------------------------
+
+def read_roster(lines):
+    """
+    Yield (line number, row dict) for each data row of a roster CSV file,
+    which needs a header row naming the columns in COLUMNS
+    """
+    reader = csv.DictReader(lines)
+    missing = [column for column in REQUIRED_COLUMNS if column not in
+               [force_text(name or '').strip().lower() for name in reader.fieldnames or ()]]
+    if missing:
+        raise ValueError("The roster has no %s column" % ', '.join(missing))
+    for row in reader:
+        yield reader.line_num, dict((force_text(key or '').strip().lower(), force_text(value or '').strip())
+                                    for key, value in row.items())
+
+
+_username_field = User._meta.get_field('username')
+
+
+def build(row):
+    """
+    An unsaved User from a roster row, with its raw password (None for an
+    unusable one) in password
+    """
+    username, email = row.get('username', ''), row.get('email', '')
+    if not username:
+        raise RowRejected("No username given")
+    try:
+        _username_field.run_validators(username)
+        if len(username) > _username_field.max_length:
+            raise ValidationError("Usernames have at most %d characters" % _username_field.max_length)
+        validate_email(email)
+    except ValidationError as e:
+        raise RowRejected('; '.join(e.messages))
+    return User(username=username, email=email, first_name=row.get('first_name', '')[:30],
+                last_name=row.get('last_name', '')[:30], password=row.get('password') or None)
+
+
+def _hash(password):
+    return make_password(password)
+
+
+def hash_passwords(passwords, pool=None, processes=1):
+    """
+    Hashes of the given passwords, in order, made by the pool's worker
+    processes when one is given
+    """
+    if pool is None:
+        return [_hash(password) for password in passwords]
+    return pool.map(_hash, passwords, chunksize=max(len(passwords) // (processes * 4), 1))
+
+
+def _next_id():
+    return (User.objects.aggregate(top=Max('id'))['top'] or 0) + 1
+
+
+def save_batch(users):
+    """
+    Insert hashed users and their keys. Ids are given up front, as
+    bulk_create does not return them.
+    """
+    with transaction.atomic():
+        first_id = _next_id()
+        for offset, user in enumerate(users):
+            user.id = first_id + offset
+        User.objects.bulk_create(users)
+        UserKey.objects.bulk_create([key_for(user) for user in users])
+
+        # Databases with sequences (PostgreSQL) need them moved past the explicit ids
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [User]):
+            cursor.execute(sql)
+
+
+def provision(rows, batch_size=1000, processes=None, on_reject=None, retries=3):
+    """
+    Create users from (line number, row dict) pairs. Usernames and emails
+    already in use, case insensitively, or repeated in the roster are
+    rejected, and on_reject is called with (line number, reason) for every
+    skipped row. processes is the size of the hashing pool (default one
+    per CPU; 1 hashes in this process). Returns the number of users
+    created and rejected.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    seen_usernames, seen_emails = set(), set()
+    created = rejected = 0
+
+    def reject(line, reason):
+        if on_reject is not None:
+            on_reject(line, reason)
+
+    def flush(pending):
+        rejects = []
+        built = []
+        for line, row in pending:
+            try:
+                built.append((line, build(row)))
+            except RowRejected as e:
+                rejects.append((line, force_text(e)))
+        usernames = _taken('username', [normalize(user.username) for line, user in built])
+        emails = _taken('email', [normalize(user.email) for line, user in built])
+        accepted = []
+        for line, user in built:
+            username, email = normalize(user.username), normalize(user.email)
+            if username in usernames or username in seen_usernames:
+                rejects.append((line, "Username '%s' is already in use" % user.username))
+            elif email in emails or email in seen_emails:
+                rejects.append((line, "Email '%s' is already in use" % user.email))
+            else:
+                seen_usernames.add(username)
+                seen_emails.add(email)
+                accepted.append(user)
+        for user, password in zip(accepted, hash_passwords([user.password for user in accepted], pool, processes)):
+            user.password = password
+        for attempt in range(retries):
+            try:
+                save_batch(accepted)
+                break
+            except IntegrityError:
+                # A concurrent insert took the ids
+                if attempt == retries - 1:
+                    raise
+        for line, reason in sorted(rejects):
+            reject(line, reason)
+        return len(accepted), len(rejects)
+
+    try:
+        pending = []
+        for line, row in rows:
+            pending.append((line, row))
+            if len(pending) >= batch_size:
+                saved, skipped = flush(pending)
+                created, rejected, pending = created + saved, rejected + skipped, []
+        if pending:
+            saved, skipped = flush(pending)
+            created, rejected = created + saved, rejected + skipped
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return created, rejected
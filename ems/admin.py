@@ -1,40 +1,72 @@
 from django.contrib import admin
 from django.conf.urls import patterns, include, url
 from django.shortcuts import render
-from ems.models import Event, Location, Reservation, Attendance, Approval, Category
+from ems.models import Event, Location, Reservation, Attendance, Approval, Category, DailyRollup, Job, Recurrence, OccurrenceException
 from ems.forms import QueryForm
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.contrib import messages
 
-from django.db import connection
+from ems import explorer, metrics
+from ems.routers import use_replica
+
+@use_replica
 def db_explorer(request, template_name="admin/ems/db_explorer.html"):
     """
-    Query the database with select statements
+    Query the database with select statements. Results are shown a page at
+    a time, and can be explained or downloaded in full as CSV (see
+    ems.explorer for the limits applied).
     """
     if not request.user.is_superuser:
         raise Http404
 
+    context = {}
     if request.method == 'POST':
         form = QueryForm(request.POST)
         if form.is_valid():
+            query = form.cleaned_data['query']
             try:
-                cursor = connection.cursor()
-                cursor.execute(form.cleaned_data['query'])
-                result_set = cursor.fetchall()
-                columns = [i[0] for i in cursor.description]
-                return render(request, template_name, {'form':form, 'columns':columns, 'result_set':result_set})
-            except: 
-                messages.error(request, "Error: Could not execute query.")
+                if 'export' in request.POST:
+                    # The export runs as it streams; explain it first so
+                    # invalid SQL is reported here instead of mid-download
+                    explorer.explain(query)
+                    response = StreamingHttpResponse(explorer.csv_rows(query), content_type='text/csv')
+                    response['Content-Disposition'] = 'attachment; filename="query.csv"'
+                    return response
+                elif 'explain' in request.POST:
+                    columns, result_set = explorer.explain(query)
+                    context.update({'columns':columns, 'result_set':result_set, 'explained':True})
+                else:
+                    page = form.cleaned_data['page'] or 1
+                    columns, result_set, has_next = explorer.fetch_page(query, page)
+                    context.update({'columns':columns, 'result_set':result_set, 'page':page,
+                                    'previous_page':page - 1, 'next_page':page + 1 if has_next else None})
+            except Exception as e:
+                messages.error(request, "Error: Could not execute query (%s)." % e)
 
     else:
         form = QueryForm()
-    return render(request, template_name, {'form':form})
+    context['form'] = form
+    return render(request, template_name, context)
+
+
+def request_metrics(request, template_name="admin/ems/request_metrics.html"):
+    """
+    Show request latency, SQL query count and SQL time percentiles per view
+    """
+    if not request.user.is_superuser:
+        raise Http404
+
+    if request.method == 'POST' and 'reset' in request.POST:
+        metrics.reset()
+        messages.info(request, "Request metrics have been reset.")
+    return render(request, template_name, {'rows':metrics.summary(), 'metrics':metrics.METRICS, 'percentiles':metrics.PERCENTILES})
 
 
 def get_admin_urls(urls):
     def get_urls():
         my_urls = patterns('',
-                url(r'^db_explorer/$', admin.site.admin_view(db_explorer))
+                url(r'^db_explorer/$', admin.site.admin_view(db_explorer)),
+                url(r'^request_metrics/$', admin.site.admin_view(request_metrics)),
             )
         return my_urls + urls
     return get_urls
@@ -46,6 +78,17 @@ admin.site.register(Reservation)
 admin.site.register(Attendance)
 admin.site.register(Approval)
 admin.site.register(Category)
+admin.site.register(DailyRollup)
+admin.site.register(Recurrence)
+admin.site.register(OccurrenceException)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'run_after', 'duration', 'locked_by')
+    list_filter = ('status', 'task')
+    readonly_fields = ('created', 'started_at', 'finished_at', 'duration', 'last_error')
+
+admin.site.register(Job, JobAdmin)
 
 
 admin_urls = get_admin_urls(admin.site.get_urls())
@@ -0,0 +1,277 @@
+"""
+Bundled, fingerprinted static files.
+
+collectstatic concatenates the stylesheets and scripts the templates use
+into the bundles listed in BUNDLES, minifies them, and stores every file
+under a name carrying a hash of its content. The original to hashed name
+mapping is written to MANIFEST_NAME in STATIC_ROOT, where the storage
+looks names up, and gzipped copies of text files are stored next to the
+hashed files. Hashed files never change, so they are served with far
+future, immutable cache headers.
+
+Templates include a bundle with {% bundle %} from the assets tag library.
+While EMS_BUNDLE_ASSETS is off (it defaults to off when DEBUG is on), or
+before collectstatic has built the bundle, the tag includes the source
+files one by one instead, under their own names.
+
+The select2 locale files are left out of STATIC_ROOT except for the ones
+listed in EMS_SELECT2_LOCALES.
+"""
+import fnmatch
+import gzip
+import json
+import mimetypes
+import os
+import posixpath
+import re
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.staticfiles.finders import FileSystemFinder
+from django.contrib.staticfiles.storage import CachedStaticFilesStorage, StaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import Http404, StreamingHttpResponse
+from django.utils.encoding import force_bytes, force_text
+from django.utils.six.moves.urllib.parse import unquote
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+# Bundle name: source files, in the order they are concatenated
+BUNDLES = {
+    'bundles/site.css': [
+        'plugins/bootstrap/bootstrap.css',
+        'plugins/fancybox/jquery.fancybox.css',
+        'plugins/bootstrap-datetimepicker/bootstrap-datetimepicker.min.css',
+        'plugins/select2/select2.css',
+        'plugins/select2/select2-bootstrap.css',
+        'css/style.css',
+    ],
+    'bundles/login.css': [
+        'plugins/bootstrap/bootstrap.css',
+        'css/login.css',
+    ],
+    'bundles/site.js': [
+        'plugins/jquery/jquery-2.1.0.min.js',
+        'plugins/bootstrap/bootstrap.min.js',
+        'plugins/moment/moment.min.js',
+        'plugins/bootstrap-datetimepicker/bootstrap-datetimepicker.min.js',
+        'plugins/bootstrap-touchspin/bootstrap.touchspin.js',
+        'plugins/bootbox/bootbox.min.js',
+    ],
+    'bundles/theme.js': [
+        'js/devoops.js',
+    ],
+    'bundles/datatables.js': [
+        'plugins/datatables/jquery.dataTables.js',
+        'plugins/datatables/dataTables.bootstrap.js',
+    ],
+    'bundles/select2.js': [
+        'plugins/select2/select2.min.js',
+    ],
+}
+
+MANIFEST_NAME = 'staticfiles.json'
+
+# Stored files worth keeping a gzipped copy of
+GZIP_PATTERNS = ('*.css', '*.js', '*.svg', '*.json', '*.txt', '*.eot', '*.ttf')
+
+SELECT2_LOCALE_PATTERN = 'select2_locale_*.js'
+
+# Seconds browsers may cache files whose name does not carry a hash
+UNHASHED_MAX_AGE = 5 * 60
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)(.*?)\1\s*\)""")
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+
+
+def bundling():
+    return getattr(settings, 'EMS_BUNDLE_ASSETS', not settings.DEBUG)
+
+
+def collected(name):
+    """
+    Whether the last collectstatic run stored the file
+    """
+    manifest = getattr(staticfiles_storage, 'manifest', None)
+    return manifest is not None and name in manifest()
+
+
+def sources(name):
+    """
+    The files a template includes for a bundle
+    """
+    return [name] if bundling() and collected(name) else BUNDLES[name]
+
+
+# ------------------------------ Building -------------------------------
+
+def _rebase_urls(css, source, bundle):
+    """
+    Point the relative url()s of a stylesheet moving from source to bundle
+    at the same files
+    """
+    def rebase(match):
+        quote, url = match.groups()
+        if not url or url.startswith(('/', '#', 'data:')) or '//' in url:
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(source), url))
+        return 'url(%s%s%s)' % (quote, posixpath.relpath(target, posixpath.dirname(bundle)), quote)
+    return CSS_URL.sub(rebase, css)
+
+
+def minify_css(css):
+    css = CSS_COMMENT.sub('', css)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    # Without rjsmin the scripts are only concatenated; most ship minified
+    return rjsmin.jsmin(js) if rjsmin is not None else js
+
+
+def concatenate(name, read):
+    """
+    The minified content of a bundle, reading each source with read(path)
+    """
+    parts = []
+    for source in BUNDLES[name]:
+        content = force_text(read(source))
+        if name.endswith('.css'):
+            parts.append(minify_css(_rebase_urls(content, source, name)))
+        else:
+            # A script missing its final semicolon must not run into the next
+            parts.append(minify_js(content).rstrip() + '\n;')
+    return '\n'.join(parts)
+
+
+def _gzipped(content):
+    buffer = BytesIO()
+    # A fixed mtime keeps the output identical between runs
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as gzip_file:
+        gzip_file.write(content)
+    return buffer.getvalue()
+
+
+class BundledStaticFilesStorage(CachedStaticFilesStorage):
+    """
+    STATICFILES_STORAGE that builds the bundles, hashes every file and
+    writes the manifest and gzipped copies when collectstatic runs
+    """
+    _manifest = None
+    _hashed_names = None
+
+    def _read(self, name):
+        with self.open(name) as source:
+            return source.read()
+
+    def post_process(self, paths, dry_run=False, **options):
+        if dry_run:
+            return
+        # Names are hashed afresh, not looked up in the previous manifest
+        self._manifest = {}
+        paths = dict(paths)
+        for name in BUNDLES:
+            if self.exists(name):
+                self.delete(name)
+            self._save(name, ContentFile(force_bytes(concatenate(name, self._read))))
+            paths[name] = (self, name)
+
+        manifest = {}
+        for name, hashed_name, processed in super(BundledStaticFilesStorage, self).post_process(paths, **options):
+            manifest[name.replace('\\', '/')] = hashed_name
+            yield name, hashed_name, processed
+
+        for hashed_name in manifest.values():
+            if any(fnmatch.fnmatch(hashed_name, pattern) for pattern in GZIP_PATTERNS):
+                compressed = hashed_name + '.gz'
+                if self.exists(compressed):
+                    self.delete(compressed)
+                self._save(compressed, ContentFile(_gzipped(self._read(hashed_name))))
+
+        if self.exists(MANIFEST_NAME):
+            self.delete(MANIFEST_NAME)
+        self._save(MANIFEST_NAME, ContentFile(force_bytes(json.dumps(manifest, indent=1, sort_keys=True))))
+        self._manifest = manifest
+        self._hashed_names = set(manifest.values())
+
+    def manifest(self):
+        """
+        {original name: hashed name} from the last collectstatic run
+        """
+        if self._manifest is None:
+            try:
+                self._manifest = json.loads(force_text(self._read(MANIFEST_NAME)))
+            except (IOError, OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def url(self, name, force=False):
+        hashed_name = self.manifest().get(name)
+        if force and hashed_name is None:
+            # Stylesheets being processed by collectstatic
+            return super(BundledStaticFilesStorage, self).url(name, force)
+        if hashed_name is None or (settings.DEBUG and not force):
+            # Not collected yet, or in development: the file's own name
+            return StaticFilesStorage.url(self, name)
+        return StaticFilesStorage.url(self, hashed_name)
+
+    def is_hashed(self, name):
+        if self._hashed_names is None:
+            self._hashed_names = set(self.manifest().values())
+        return name in self._hashed_names
+
+
+class StaticFinder(FileSystemFinder):
+    """
+    FileSystemFinder leaving out the select2 locales the site does not use
+    """
+    def list(self, ignore_patterns):
+        keep = set('select2_locale_%s.js' % locale for locale in getattr(settings, 'EMS_SELECT2_LOCALES', ()))
+        for path, storage in super(StaticFinder, self).list(ignore_patterns):
+            filename = posixpath.basename(path.replace('\\', '/'))
+            if fnmatch.fnmatch(filename, SELECT2_LOCALE_PATTERN) and filename not in keep:
+                continue
+            yield path, storage
+
+
+# ------------------------------- Serving -------------------------------
+
+def _chunks(path, chunk_size=64 * 1024):
+    with open(path, 'rb') as static_file:
+        for chunk in iter(lambda: static_file.read(chunk_size), b''):
+            yield chunk
+
+
+def serve(request, path):
+    """
+    Serve a collected static file, gzipped when the client accepts it.
+    Hashed files are cached for a year. Only routed when EMS_SERVE_STATIC
+    is on; a front end server can do the same with its gzip_static and
+    expires settings.
+    """
+    name = posixpath.normpath(unquote(path)).lstrip('/')
+    if name.startswith('..') or name == MANIFEST_NAME:
+        raise Http404
+    full_path = staticfiles_storage.path(name)
+    if not os.path.isfile(full_path):
+        raise Http404
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    encoding = None
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '') and os.path.isfile(full_path + '.gz'):
+        full_path += '.gz'
+        encoding = 'gzip'
+    response = StreamingHttpResponse(_chunks(full_path), content_type=content_type)
+    response['Content-Length'] = os.path.getsize(full_path)
+    response['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if getattr(staticfiles_storage, 'is_hashed', lambda name: False)(name):
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = 'public, max-age=%d' % UNHASHED_MAX_AGE
+    return response
@@ -0,0 +1,50 @@
+"""
+Cached loading of the logged in user.
+
+django.contrib.auth reads the User row on every request that touches
+request.user. CachedAuthenticationMiddleware reads it from the cache
+instead, under the user's 'account' version (see ems.caching), which the
+receivers in ems.signals bump whenever a User is saved or deleted. Only a
+cache shared by every worker sees those bumps, so unless EMS_SHARED_CACHE
+is on the middleware reads the user from the database like Django's.
+"""
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+from ems import caching
+
+
+def get_user(request):
+    """
+    The user logged in to the request's session, or an AnonymousUser
+    """
+    try:
+        user_id = request.session[auth.SESSION_KEY]
+        backend_path = request.session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+    key = caching.versioned_key('account', 'account', user_id, backend_path)
+    user = cache.get(key)
+    if user is None:
+        user = auth.load_backend(backend_path).get_user(user_id)
+        if user is None:
+            return AnonymousUser()
+        user.backend = backend_path
+        cache.set(key, user, caching.CACHE_TIMEOUT)
+    return user
+
+
+class CachedAuthenticationMiddleware(object):
+    """
+    Drop-in replacement for django.contrib.auth's AuthenticationMiddleware
+    """
+    def process_request(self, request):
+        if getattr(settings, 'EMS_SHARED_CACHE', False):
+            request.user = SimpleLazyObject(lambda: get_user(request))
+        else:
+            request.user = SimpleLazyObject(lambda: auth.get_user(request))
@@ -0,0 +1,294 @@
+"""
+Reservation conflict detection.
+
+The database is the source of truth: overlaps are found with a range query
+on (location, start_datetime) while the location row is locked, so two
+concurrent bookings of the same room cannot both succeed. No reservation
+may last longer than MAX_DURATION, which bounds that range from below: only
+reservations starting less than MAX_DURATION before a slot can reach it. Batches of
+proposed slots are checked against one query per batch using an in-memory
+IntervalIndex per location, and free slots are found by sweeping the
+reservations of every location in one sorted pass.
+
+Recurring reservations take part through the occurrences they have in the
+window being checked (see ems.recurrence); a new series is checked over
+its occurrences up to EMS_RECURRENCE_HORIZON_DAYS ahead.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from datetime import timedelta
+from itertools import takewhile
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from ems.models import Location, Reservation
+from ems import recurrence, status_const
+
+# Days ahead the occurrences of a new series without an end are checked
+RECURRENCE_HORIZON_DAYS = getattr(settings, 'EMS_RECURRENCE_HORIZON_DAYS', 365)
+
+# Longest a reservation may last
+MAX_DURATION = timedelta(days=getattr(settings, 'EMS_MAX_RESERVATION_DAYS', 31))
+
+
+class BookingConflict(Exception):
+    """
+    Raised when a reservation would overlap an existing booking
+    """
+    def __init__(self, event_ids):
+        self.event_ids = event_ids
+        super(BookingConflict, self).__init__("Location is already booked by event(s) %s"
+                                              % ', '.join(str(event_id) for event_id in event_ids))
+
+
+class IntervalIndex(object):
+    """
+    Half-open [start, end) intervals kept sorted by start, alongside the
+    running maximum of their ends. An overlap query bisects to the last
+    interval starting before the query ends and walks back only while
+    some earlier interval could still reach past the query start.
+    """
+    def __init__(self, intervals=()):
+        self.intervals = sorted(intervals, key=lambda interval: interval[:2])
+        self._reindex()
+
+    def _reindex(self):
+        self.starts = [interval[0] for interval in self.intervals]
+        self.max_ends = []
+        for start, end, key in self.intervals:
+            if self.max_ends and self.max_ends[-1] > end:
+                end = self.max_ends[-1]
+            self.max_ends.append(end)
+
+    def add(self, start, end, key):
+        i = bisect_right(self.intervals, (start, end, key))
+        self.intervals.insert(i, (start, end, key))
+        self.starts.insert(i, start)
+        if i and self.max_ends[i - 1] > end:
+            end = self.max_ends[i - 1]
+        self.max_ends.insert(i, end)
+        # Later running maximums only change until one already reaches past end
+        i += 1
+        while i < len(self.max_ends) and self.max_ends[i] < end:
+            self.max_ends[i] = end
+            i += 1
+
+    def overlapping(self, start, end):
+        """
+        Keys of the intervals overlapping [start, end)
+        """
+        keys = []
+        i = bisect_left(self.starts, end) - 1
+        while i >= 0 and self.max_ends[i] > start:
+            if self.intervals[i][1] > start:
+                keys.append(self.intervals[i][2])
+            i -= 1
+        keys.reverse()
+        return keys
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+def active_reservations():
+    """
+    Reservations that hold their location (everything except denied ones)
+    """
+    return Reservation.objects.exclude(status=status_const.DENIED)
+
+
+def lock_locations(location_ids):
+    """
+    Lock the given location rows until the end of the current transaction,
+    serializing bookings at those locations. Locks are taken in id order
+    so concurrent batches cannot deadlock.
+    """
+    list(Location.objects.select_for_update().filter(id__in=location_ids).order_by('id').values_list('id', flat=True))
+
+
+def overlap(start, end):
+    """
+    Filter for reservations overlapping [start, end). The start of the
+    reservation is bounded on both sides, so the (location, start_datetime)
+    index is read over a bounded range.
+    """
+    return Q(start_datetime__lt=end, start_datetime__gt=start - MAX_DURATION, end_datetime__gt=start)
+
+
+def check_duration(start, end):
+    """
+    Raise ValueError unless [start, end) is a valid reservation time
+    """
+    if end <= start:
+        raise ValueError("The event must end after it starts.")
+    if end - start > MAX_DURATION:
+        raise ValueError("Events can last at most %d days." % MAX_DURATION.days)
+
+
+def overlapping(location_id, start, end, exclude_event=None):
+    """
+    Active reservations at a location that overlap [start, end), not
+    counting recurring ones (see busy)
+    """
+    reservations = recurrence.singles(active_reservations()).filter(overlap(start, end), location=location_id)
+    if exclude_event is not None:
+        reservations = reservations.exclude(event=exclude_event)
+    return reservations
+
+
+def busy(location_ids, start, end, exclude_events=()):
+    """
+    (location_id, start, end, event_id) of every occurrence of an active
+    recurring reservation at the locations that overlaps [start, end)
+    """
+    series = recurrence.series_in_window(active_reservations().filter(location__in=location_ids), start, end)
+    if exclude_events:
+        series = series.exclude(event__in=exclude_events)
+    series = series.only('id', 'event', 'location', 'start_datetime', 'end_datetime', 'status')
+    return [(occurrence.location_id, occurrence.start_datetime, occurrence.end_datetime, occurrence.event_id)
+            for occurrence in recurrence.expand(series, start, end)]
+
+
+def ensure_available(location_id, start, end, exclude_event=None):
+    """
+    Lock the location and raise BookingConflict if [start, end) overlaps one
+    of its active reservations. Call inside transaction.atomic() and save
+    the reservation in the same transaction.
+    """
+    lock_locations([location_id])
+    event_ids = list(overlapping(location_id, start, end, exclude_event).values_list('event', flat=True))
+    exclude_events = [exclude_event] if exclude_event is not None else ()
+    event_ids.extend(event_id for location, occurrence_start, occurrence_end, event_id
+                     in busy([location_id], start, end, exclude_events) if event_id not in event_ids)
+    if event_ids:
+        raise BookingConflict(event_ids)
+
+
+def ensure_series_available(location_id, start, end, rule, exclude_event=None):
+    """
+    Like ensure_available, for every occurrence of a series starting with
+    [start, end) up to RECURRENCE_HORIZON_DAYS ahead
+    """
+    horizon = start + timedelta(days=RECURRENCE_HORIZON_DAYS)
+    duration = end - start
+    slots = [(location_id, occurrence_start, occurrence_start + duration)
+             for occurrence_start in takewhile(lambda moment: moment < horizon, recurrence.starts(start, rule))]
+    exclude_events = [exclude_event] if exclude_event is not None else ()
+    event_ids = []
+    for conflicts, slot_indexes in check_slots(slots, exclude_events, lock=True):
+        event_ids.extend(event_id for event_id in conflicts if event_id not in event_ids)
+    if event_ids:
+        raise BookingConflict(event_ids)
+
+
+def build_indexes(location_ids, start, end, exclude_events=()):
+    """
+    An IntervalIndex per location holding its active reservations and
+    occurrences that overlap [start, end), keyed by event id
+    """
+    indexes = defaultdict(IntervalIndex)
+    reservations = recurrence.singles(active_reservations()).filter(overlap(start, end), location__in=location_ids)
+    if exclude_events:
+        reservations = reservations.exclude(event__in=exclude_events)
+    intervals = defaultdict(list)
+    rows = list(reservations.values_list('location', 'start_datetime', 'end_datetime', 'event'))
+    for location_id, reservation_start, reservation_end, event_id in rows + busy(location_ids, start, end, exclude_events):
+        intervals[location_id].append((reservation_start, reservation_end, event_id))
+    for location_id, location_intervals in intervals.items():
+        indexes[location_id] = IntervalIndex(location_intervals)
+    return indexes
+
+
+def check_slots(slots, exclude_events=(), lock=False):
+    """
+    Check a batch of proposed (location_id, start, end) slots in one query.
+
+    Returns one (event_ids, slot_indexes) pair per slot: the existing events
+    it overlaps and the earlier slots of the same batch it overlaps. A slot
+    with conflicts does not block later slots. Pass lock=True inside a
+    transaction to hold the locations until the slots are saved.
+    """
+    if not slots:
+        return []
+    location_ids = set(slot[0] for slot in slots)
+    if lock:
+        lock_locations(location_ids)
+    window_start = min(slot[1] for slot in slots)
+    window_end = max(slot[2] for slot in slots)
+    indexes = build_indexes(location_ids, window_start, window_end, exclude_events)
+    accepted = defaultdict(IntervalIndex)
+
+    results = []
+    for index, (location_id, start, end) in enumerate(slots):
+        event_ids = indexes[location_id].overlapping(start, end)
+        slot_indexes = accepted[location_id].overlapping(start, end)
+        if not event_ids and not slot_indexes:
+            accepted[location_id].add(start, end, index)
+        results.append((event_ids, slot_indexes))
+    return results
+
+
+def free_slots(start, end, min_duration, min_capacity=None, location_ids=None):
+    """
+    The free [start, end) slots of at least min_duration within the window,
+    per location, as a list of (location values, slots) ordered by name.
+    Locations can be narrowed to those seating min_capacity (capacity 0
+    means unlimited) or to the given ids.
+
+    All reservations in the window are read with one query, merged with
+    the occurrences of recurring ones, sorted by location and start, and
+    the gaps between them found in a single sweep. The query is bounded
+    below like the conflict checks (see overlap), so its cost does not
+    grow with the bookings made before the window.
+    """
+    locations = Location.objects.all()
+    if min_capacity:
+        locations = locations.filter(Q(capacity=0) | Q(capacity__gte=min_capacity))
+    if location_ids is not None:
+        locations = locations.filter(id__in=location_ids)
+    booked = recurrence.singles(active_reservations()).filter(overlap(start, end), location__in=locations.values('id')) \
+                                                      .values_list('location', 'start_datetime', 'end_datetime')
+    booked = list(booked) + [slot[:3] for slot in busy(locations.values('id'), start, end)]
+    booked.sort()
+    slots = defaultdict(list)
+    swept = set()
+    current, free_from = None, start
+    for location_id, booked_start, booked_end in booked:
+        if location_id != current:
+            if current is not None and end - free_from >= min_duration:
+                slots[current].append((free_from, end))
+            current, free_from = location_id, start
+            swept.add(location_id)
+        if booked_start - free_from >= min_duration:
+            slots[location_id].append((free_from, booked_start))
+        free_from = max(free_from, booked_end)
+    if current is not None and end - free_from >= min_duration:
+        slots[current].append((free_from, end))
+
+    results = []
+    for location in locations.order_by('name', 'id').values('id', 'name', 'capacity'):
+        if location['id'] in swept:
+            results.append((location, slots[location['id']]))
+        elif end - start >= min_duration:
+            results.append((location, [(start, end)]))
+        else:
+            results.append((location, []))
+    return results
+
+
+def suggestions(location_id, start, end, limit=3):
+    """
+    Alternatives to a booking that conflicts: free slots of the same length
+    at the location on the same day, and other locations free for the
+    requested time. Returns (slots, location values).
+    """
+    duration = end - start
+    day_start = timezone.localtime(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    day_end = day_start + timedelta(days=1)
+    same_location = free_slots(day_start, max(day_end, end), duration, location_ids=[location_id])
+    slots = same_location[0][1][:limit] if same_location else []
+    locations = [location for location, location_slots in free_slots(start, end, duration)
+                 if location_slots and location['id'] != location_id]
+    return slots, locations[:limit]
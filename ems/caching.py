@@ -0,0 +1,130 @@
+"""
+Version counters for cache keys.
+
+Cached data is stored under keys that include the version of every object
+it was built from, so bumping a version makes the old entries unreachable
+instead of having to find and delete them. Versions live in the cache
+themselves; a missing version is recreated from the clock so an evicted
+counter can never come back with a value that was used before.
+
+Every bump of an object also bumps the ALL counter of its kind, which
+changes whenever anything of that kind does.
+
+Bumps made during a request are repeated when the request finishes. A
+render cached by a concurrent request between the first bump and the
+commit of the write that caused it is orphaned by the second bump. Bumps
+made outside a request (management commands, workers, tests) are not
+repeated, as there is no later point at which to repeat them.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+
+# How long rendered pages and other versioned data are kept
+CACHE_TIMEOUT = getattr(settings, 'EMS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# pk of the counter bumped along with every object of a kind
+ALL = 'all'
+
+_pending = threading.local()
+
+
+def _version_key(kind, pk):
+    return 'ems:version:%s:%s' % (kind, pk)
+
+
+def _modified_key(kind, pk):
+    return 'ems:modified:%s:%s' % (kind, pk)
+
+
+def _fresh_version():
+    return int(time.time() * 1000000)
+
+
+def get_version(kind, pk):
+    return get_versions(kind, [pk])[pk]
+
+
+def get_versions(kind, pks):
+    """
+    Current versions of several objects of one kind, as {pk: version}
+    """
+    keys = dict((_version_key(kind, pk), pk) for pk in pks)
+    found = cache.get_many(keys.keys())
+    versions = {}
+    for key, pk in keys.items():
+        if key not in found:
+            cache.add(key, _fresh_version(), None)
+            found[key] = cache.get(key)
+        versions[pk] = found[key]
+    return versions
+
+
+def last_modified(kind, pk):
+    """
+    Time of the last bump as a unix timestamp, or None if unknown
+    """
+    return cache.get(_modified_key(kind, pk))
+
+
+def _bump(items):
+    """
+    Move each (kind, pk) to a version it has never had, in two cache round
+    trips however many there are
+    """
+    keys = [_version_key(kind, pk) for kind, pk in items]
+    if not keys:
+        return
+    current = cache.get_many(keys)
+    fresh = _fresh_version()
+    now = time.time()
+    values = {}
+    for (kind, pk), key in zip(items, keys):
+        values[key] = max(fresh, current.get(key, 0) + 1)
+        values[_modified_key(kind, pk)] = now
+    cache.set_many(values, None)
+
+
+def bump(kind, *pks):
+    """
+    Invalidate everything cached under the given objects' versions
+    """
+    items = set((kind, pk) for pk in pks if pk is not None)
+    if items:
+        items.add((kind, ALL))
+    items = list(items)
+    pending = getattr(_pending, 'versions', None)
+    if pending is not None:
+        pending.update(items)
+    _bump(items)
+
+
+def start_pending(**kwargs):
+    """
+    Start recording the bumps of a request
+    """
+    _pending.versions = set()
+
+
+def flush_pending(**kwargs):
+    """
+    Bump again every version bumped during the request, now that its
+    writes are committed, and stop recording
+    """
+    pending = getattr(_pending, 'versions', None)
+    _pending.versions = None
+    if pending:
+        _bump(list(pending))
+
+request_started.connect(start_pending)
+request_finished.connect(flush_pending)
+
+
+def versioned_key(name, kind, pk, *extra):
+    """
+    Cache key for data about one object that changes with its version
+    """
+    return ':'.join(['ems', name, str(pk), str(get_version(kind, pk))] + [str(part) for part in extra])
@@ -0,0 +1,176 @@
+"""
+Bounded execution of the ad hoc queries run from the admin db_explorer.
+
+Queries run in their own read only transaction under a statement timeout.
+A page of results is read by wrapping the query in LIMIT/OFFSET, so the
+database only returns the rows shown. A CSV export reads the whole result
+through a server-side cursor where the database has one (PostgreSQL named
+cursors, unbuffered MySQL cursors; SQLite steps through results as they
+are fetched anyway) and writes it out chunk by chunk. Queries run on the
+read replica when the view uses one (see ems.routers).
+"""
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+
+from ems import export, routers
+
+# Rows shown per page of results
+PAGE_SIZE = getattr(settings, 'EMS_EXPLORER_PAGE_SIZE', 100)
+
+# Highest page that may be requested, so a page can never skip more than
+# PAGE_SIZE * MAX_PAGES rows
+MAX_PAGES = getattr(settings, 'EMS_EXPLORER_MAX_PAGES', 1000)
+
+# Seconds a statement may run before the database cancels it
+TIMEOUT = getattr(settings, 'EMS_EXPLORER_TIMEOUT', 10)
+
+# Seconds a CSV export may run; it reads the whole result
+EXPORT_TIMEOUT = getattr(settings, 'EMS_EXPLORER_EXPORT_TIMEOUT', 300)
+
+# Rows fetched from the cursor of an export at a time
+CHUNK_SIZE = 1000
+
+
+@contextmanager
+def statement_timeout(seconds, using=None):
+    """
+    Cancel statements of the current transaction that run longer than the
+    given number of seconds
+    """
+    connection = connections[using or routers.read_alias()]
+    milliseconds = int(seconds * 1000)
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute('SET LOCAL statement_timeout = %s', [milliseconds])
+        yield
+    elif connection.vendor == 'mysql':
+        cursor = connection.cursor()
+        try:
+            # MySQL 5.7.8 and later; older servers run without a limit
+            cursor.execute('SET SESSION max_execution_time = %s', [milliseconds])
+        except DatabaseError:
+            yield
+            return
+        try:
+            yield
+        finally:
+            cursor.execute('SET SESSION max_execution_time = 0')
+    elif connection.vendor == 'sqlite':
+        deadline = time.time() + seconds
+        raw = connection.connection
+        raw.set_progress_handler(lambda: 1 if time.time() > deadline else 0, 10000)
+        try:
+            yield
+        finally:
+            raw.set_progress_handler(None, 10000)
+    else:
+        yield
+
+
+def _server_side_cursor(connection):
+    connection.ensure_connection()
+    raw = connection.connection
+    if connection.vendor == 'postgresql':
+        return raw.cursor(name='ems_explorer_%s' % uuid.uuid4().hex)
+    if connection.vendor == 'mysql':
+        try:
+            from MySQLdb.cursors import SSCursor
+            return raw.cursor(SSCursor)
+        except ImportError:
+            # MySQL Connector/Python cursors are unbuffered by default
+            return raw.cursor()
+    return raw.cursor()
+
+
+def _clean(query):
+    return query.strip().rstrip(';')
+
+
+@contextmanager
+def _read_only(alias, timeout):
+    connection = connections[alias]
+    with transaction.atomic(using=alias):
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute('SET TRANSACTION READ ONLY')
+        with statement_timeout(timeout, alias):
+            yield connection
+
+
+@contextmanager
+def open_query(query, timeout=TIMEOUT, using=None):
+    """
+    Execute a query and yield a server-side cursor to read it from. Read
+    the result to the end: an unbuffered MySQL cursor left with unread
+    rows breaks its connection, which is then closed rather than reused.
+    """
+    alias = using or routers.read_alias()
+    with _read_only(alias, timeout) as connection:
+        cursor = _server_side_cursor(connection)
+        try:
+            cursor.execute(_clean(query))
+            yield cursor
+        except Exception:
+            connection.close()
+            raise
+        else:
+            cursor.close()
+
+
+def _columns(cursor):
+    return [column[0] for column in cursor.description or ()]
+
+
+def fetch_page(query, page=1, page_size=PAGE_SIZE):
+    """
+    One page of a query's results as (columns, rows, has_next_page). The
+    database skips the earlier pages and returns one row past the page,
+    which tells whether another page follows.
+    """
+    page = max(1, min(page, MAX_PAGES))
+    alias = routers.read_alias()
+    with _read_only(alias, TIMEOUT) as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT * FROM (%s) AS ems_page LIMIT %d OFFSET %d' % (
+            _clean(query), page_size + 1, (page - 1) * page_size))
+        rows = cursor.fetchall()
+        columns = _columns(cursor)
+    return columns, rows[:page_size], len(rows) > page_size
+
+
+def explain(query):
+    """
+    The database's plan for a query, as (columns, rows)
+    """
+    alias = routers.read_alias()
+    with _read_only(alias, TIMEOUT) as connection:
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(prefix + _clean(query))
+        return _columns(cursor), cursor.fetchall()
+
+
+def csv_rows(query, timeout=EXPORT_TIMEOUT):
+    """
+    Yield the full result of a query as CSV lines, header first. The
+    database is chosen now, as the lines are read after the view returns.
+    """
+    return _csv_rows(query, timeout, routers.read_alias())
+
+
+def _csv_rows(query, timeout, using):
+    with open_query(query, timeout, using) as cursor:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        header = _columns(cursor)
+
+        def remaining():
+            chunk = rows
+            while chunk:
+                for row in chunk:
+                    yield row
+                chunk = cursor.fetchmany(CHUNK_SIZE)
+
+        for lines in export.csv_lines(header, remaining(), CHUNK_SIZE):
+            yield lines
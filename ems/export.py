@@ -0,0 +1,92 @@
+"""
+Streamed CSV and XLSX downloads.
+
+CSV is written row by row into the response as it is sent. XLSX files
+are zip archives that cannot be streamed as they are built, so they are
+written with XlsxWriter's constant memory mode to a temporary file, which
+is then streamed. XlsxWriter is optional; without it only CSV is offered.
+"""
+import csv
+import tempfile
+from wsgiref.util import FileWrapper
+
+from django.http import StreamingHttpResponse
+from django.utils import six
+from django.utils.encoding import force_text
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+FORMATS = ('csv', 'xlsx') if xlsxwriter is not None else ('csv',)
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class Echo(object):
+    """
+    File-like object whose write() returns what it is given, so csv.writer
+    can format rows for a generator
+    """
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    value = force_text(value)
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def csv_lines(header, rows, chunk_size=500):
+    """
+    Yield CSV text for a header and an iterable of rows, a chunk of rows at
+    a time
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([csv_value(column) for column in header])
+    chunk = []
+    for row in rows:
+        chunk.append(writer.writerow([csv_value(value) for value in row]))
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def _xlsx_value(value):
+    if hasattr(value, 'tzinfo') and value.tzinfo is not None:
+        # Excel has no time zones
+        return value.replace(tzinfo=None)
+    return value
+
+
+def xlsx_file(header, rows):
+    """
+    A temporary file holding an XLSX workbook of the header and rows,
+    built without keeping the rows in memory
+    """
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm'})
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, header)
+    for index, row in enumerate(rows, 1):
+        sheet.write_row(index, 0, [_xlsx_value(value) for value in row])
+    workbook.close()
+    output.seek(0)
+    return output
+
+
+def response(header, rows, filename, fmt='csv'):
+    """
+    A streamed download of the rows in the given format
+    """
+    if fmt == 'xlsx':
+        result = StreamingHttpResponse(FileWrapper(xlsx_file(header, rows)), content_type=XLSX_CONTENT_TYPE)
+    else:
+        result = StreamingHttpResponse(csv_lines(header, rows), content_type='text/csv')
+    result['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, fmt)
+    return result
@@ -0,0 +1,230 @@
+"""
+iCalendar and JSON feeds of approved events per location, category and user.
+
+Feeds are streamed from a lazily iterated queryset. Their ETag and
+Last-Modified values come from the cache versions in ems.caching, so a
+client polling an unchanged feed gets a 304 without the event tables
+being read. The window of past events a feed covers moves once a day,
+and the date is part of the ETag for that reason.
+
+A recurring event is one VEVENT with an RRULE in iCalendar, its cancelled
+dates as EXDATEs and its moved dates as extra VEVENTs with a
+RECURRENCE-ID. JSON has no rules, so its occurrences are listed one by
+one up to FEED_FUTURE_DAYS ahead, after the events that do not repeat.
+
+Calendar clients cannot log in, so every feed URL carries a token signed
+with the site's secret key. Logged in users may also read location and
+category feeds, and their own feed, without one.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from ems.models import Reservation
+from ems import caching, recurrence, status_const
+
+FEED_KINDS = ('location', 'category', 'user')
+
+# Days of past events a feed keeps showing
+FEED_HISTORY_DAYS = getattr(settings, 'EMS_FEED_HISTORY_DAYS', 30)
+
+# Days of occurrences of recurring events listed ahead in JSON feeds
+FEED_FUTURE_DAYS = getattr(settings, 'EMS_FEED_FUTURE_DAYS', 180)
+
+ICS_LINE_LENGTH = 75
+
+
+def token(kind, pk):
+    return salted_hmac('ems.feeds', '%s:%s' % (kind, pk)).hexdigest()[:20]
+
+
+def allowed(request, kind, pk, feed_token=None):
+    """
+    Whether the request may read the feed: a valid token, or a logged in
+    user reading a shared feed or their own
+    """
+    if feed_token is not None:
+        return constant_time_compare(feed_token, token(kind, pk))
+    if not request.user.is_authenticated():
+        return False
+    return kind != 'user' or request.user.id == int(pk)
+
+
+def urls(kind, pk):
+    """
+    {format: path} of the signed feed URLs for an object
+    """
+    return dict((fmt, reverse('feed', kwargs={'kind': kind, 'pk': pk, 'feed_token': token(kind, pk), 'fmt': fmt}))
+                for fmt in ('ics', 'json'))
+
+
+def _window_start():
+    today = timezone.localtime(timezone.now()).date()
+    return today - timedelta(days=FEED_HISTORY_DAYS)
+
+
+def _window_start_datetime():
+    return timezone.make_aware(datetime.combine(_window_start(), datetime.min.time()),
+                               timezone.get_current_timezone())
+
+
+def etag(kind, pk, fmt):
+    versions = (kind, pk, fmt, caching.get_version(kind, pk), caching.get_version('names', 0), _window_start())
+    return hashlib.md5(':'.join(str(part) for part in versions).encode('utf-8')).hexdigest()
+
+
+def last_modified(kind, pk):
+    """
+    When the feed last changed, or None if the cache does not know
+    """
+    times = [caching.last_modified(kind, pk), caching.last_modified('names', 0)]
+    times = [moment for moment in times if moment is not None]
+    if not times:
+        return None
+    return datetime.utcfromtimestamp(max(times))
+
+
+def reservations(kind, pk):
+    """
+    Approved reservations in a feed, oldest first, with the related rows
+    the feed shows. Iterate it with .iterator() to stream.
+    """
+    window_start = _window_start_datetime()
+    # A series is kept while it has occurrences left in the window
+    rows = Reservation.objects.filter(Q(end_datetime__gte=window_start) |
+                                      Q(recurrence__isnull=False, recurrence__last_end__isnull=True) |
+                                      Q(recurrence__last_end__gte=window_start),
+                                      status=status_const.APPROVED)
+    if kind == 'location':
+        rows = rows.filter(location=pk)
+    elif kind == 'category':
+        rows = rows.filter(event__category=pk)
+    else:
+        rows = rows.filter(Q(event__creator=pk) | Q(event__attendance__user=pk)).distinct()
+    return rows.select_related('event__category', 'location') \
+               .only('start_datetime', 'end_datetime', 'event', 'location', 'event__name', 'event__description',
+                     'event__category', 'event__category__name', 'location__name') \
+               .order_by('start_datetime', 'pk')
+
+
+def series(kind, pk):
+    """
+    recurrence.load() for the recurring reservations in a feed
+    """
+    return recurrence.load(reservations(kind, pk).filter(recurrence__isnull=False).values('id'))
+
+
+# ------------------------------ iCalendar ------------------------------
+
+def _ics_text(value):
+    return value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,') \
+                .replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def _ics_line(line):
+    """
+    A content line folded to ICS_LINE_LENGTH characters, with its CRLF
+    """
+    parts = [line[:ICS_LINE_LENGTH]]
+    for start in range(ICS_LINE_LENGTH, len(line), ICS_LINE_LENGTH - 1):
+        parts.append(' ' + line[start:start + ICS_LINE_LENGTH - 1])
+    return '\r\n'.join(parts) + '\r\n'
+
+
+def _ics_datetime(moment):
+    return moment.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _vevent(reservation, uid, dtstamp, start, end, url, extra=()):
+    event = reservation.event
+    return ''.join(_ics_line(line) for line in (
+        ('BEGIN:VEVENT',
+         'UID:%s' % uid,
+         'DTSTAMP:%s' % dtstamp,
+         'DTSTART:%s' % _ics_datetime(start),
+         'DTEND:%s' % _ics_datetime(end)) + tuple(extra) +
+        ('SUMMARY:%s' % _ics_text(event.name),
+         'DESCRIPTION:%s' % _ics_text(event.description),
+         'LOCATION:%s' % _ics_text(reservation.location.name),
+         'CATEGORIES:%s' % _ics_text(event.category.name),
+         'URL:%s' % url,
+         'END:VEVENT')))
+
+
+def ics(rows, name, base_url, stamp, series=None):
+    """
+    Yield an iCalendar file a few lines at a time. series is the feed's
+    recurrence.load() result.
+    """
+    yield _ics_line('BEGIN:VCALENDAR')
+    yield _ics_line('VERSION:2.0')
+    yield _ics_line('PRODID:-//ems//Event Management System//EN')
+    yield _ics_line('X-WR-CALNAME:%s' % _ics_text(name))
+    dtstamp = _ics_datetime(stamp)
+    host = base_url.split('//')[-1].rstrip('/')
+    series = series or {}
+    for reservation in rows:
+        uid = 'event-%d@%s' % (reservation.event.id, host)
+        url = base_url.rstrip('/') + reservation.event.get_absolute_url()
+        if reservation.id not in series:
+            yield _vevent(reservation, uid, dtstamp, reservation.start_datetime, reservation.end_datetime, url)
+            continue
+        rule, exceptions = series[reservation.id]
+        extra = ['RRULE:%s' % recurrence.build(rule.freq, rule.interval, rule.byday, rule.count, rule.until)]
+        extra.extend('EXDATE:%s' % _ics_datetime(exception.original_start)
+                     for exception in sorted(exceptions.values(), key=lambda exception: exception.original_start)
+                     if exception.cancelled)
+        yield _vevent(reservation, uid, dtstamp, reservation.start_datetime, reservation.end_datetime, url, extra)
+        for exception in sorted(exceptions.values(), key=lambda exception: exception.original_start):
+            if not exception.cancelled and exception.start_datetime is not None:
+                yield _vevent(reservation, uid, dtstamp, exception.start_datetime, exception.end_datetime, url,
+                              ['RECURRENCE-ID:%s' % _ics_datetime(exception.original_start)])
+    yield _ics_line('END:VCALENDAR')
+
+
+# -------------------------------- JSON ---------------------------------
+
+def _json_event(reservation, start, end, base_url):
+    event = reservation.event
+    return json.dumps({
+        'id': event.id,
+        'name': event.name,
+        'description': event.description,
+        'category': event.category.name,
+        'location': reservation.location.name,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'url': base_url.rstrip('/') + event.get_absolute_url(),
+    })
+
+
+def json_events(rows, name, base_url, series=None):
+    """
+    Yield a JSON document one event at a time. series is the feed's
+    recurrence.load() result; the occurrences of those events follow the
+    others.
+    """
+    yield '{"name": %s, "events": [' % json.dumps(name)
+    series = series or {}
+    recurring = []
+    separator = ''
+    for reservation in rows:
+        if reservation.id in series:
+            recurring.append(reservation)
+            continue
+        yield separator + _json_event(reservation, reservation.start_datetime, reservation.end_datetime, base_url)
+        separator = ', '
+    window_start = _window_start_datetime()
+    window_end = timezone.now() + timedelta(days=FEED_FUTURE_DAYS)
+    for reservation in recurring:
+        rule, exceptions = series[reservation.id]
+        for occurrence in recurrence.occurrences(reservation, rule, exceptions, window_start, window_end):
+            yield separator + _json_event(reservation, occurrence.start_datetime, occurrence.end_datetime, base_url)
+            separator = ', '
+    yield ']}'
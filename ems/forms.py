@@ -1,6 +1,184 @@
 from django import forms
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.utils.encoding import force_text
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from datetime import datetime, time, timedelta
+from django.utils import timezone
 from ems.models import Event, Location, Reservation, Category
+from ems.reports import MAX_REPORT_WEEKS
+from ems import accounts, booking, caching, recurrence
+
+# Selects with more options than this are rendered as a search box that
+# fetches matching options from the choice_search view
+REMOTE_CHOICES_THRESHOLD = getattr(settings, 'EMS_REMOTE_CHOICES_THRESHOLD', 200)
+
+# Models offered through CachedModelChoiceField, by the name used in URLs
+# and cache versions
+CHOICE_MODELS = {'category': Category, 'location': Location}
+
+def cached_choices(model):
+    """
+    (pk, name) of every instance of a model, ordered by name. Cached under
+    a version the receivers in ems.signals bump on every save or delete.
+    """
+    key = caching.versioned_key('choices', 'choices', model._meta.model_name)
+    choices = cache.get(key)
+    if choices is None:
+        choices = list(model.objects.order_by('name').values_list('pk', 'name'))
+        cache.set(key, choices, caching.CACHE_TIMEOUT)
+    return choices
+
+
+class LazyChoices(object):
+    """
+    Iterable over a model's cached choices, read only when a widget is
+    rendered rather than when the form is built
+    """
+    def __init__(self, model, blank=True):
+        self.model = model
+        self.blank = blank
+
+    def __iter__(self):
+        if self.blank:
+            yield ('', '---------')
+        for choice in cached_choices(self.model):
+            yield choice
+
+    def __len__(self):
+        return len(cached_choices(self.model))
+
+
+class CachedChoiceSelect(forms.Select):
+    """
+    A select over cached choices. When there are more than
+    REMOTE_CHOICES_THRESHOLD options it renders a hidden input instead,
+    which the remote choice script turns into a search box.
+    """
+    def render(self, name, value, attrs=None, choices=()):
+        if len(self.choices) <= REMOTE_CHOICES_THRESHOLD:
+            return super(CachedChoiceSelect, self).render(name, value, attrs, choices)
+        model = self.choices.model
+        label = dict(cached_choices(model)).get(_choice_pk(value), '')
+        final_attrs = self.build_attrs(attrs, type='hidden', name=name)
+        final_attrs['class'] = (final_attrs.get('class', '') + ' remote-choice').strip()
+        final_attrs['data-url'] = reverse('choice_search', args=[model._meta.model_name])
+        final_attrs['data-label'] = label
+        if value not in (None, ''):
+            final_attrs['value'] = value
+        return mark_safe('<input %s />' % ' '.join('%s="%s"' % (attr, escape(attr_value))
+                                                   for attr, attr_value in sorted(final_attrs.items())))
+
+
+def _choice_pk(value):
+    if hasattr(value, 'pk'):
+        return value.pk
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedModelChoiceField(forms.ChoiceField):
+    """
+    Like ModelChoiceField, but the options come from cached_choices() and
+    the submitted id is checked against them without a query. Cleans to
+    the chosen pk rather than an instance; choice_label() gives its name.
+    """
+    widget = CachedChoiceSelect
+
+    def __init__(self, model, *args, **kwargs):
+        self.model = model
+        super(CachedModelChoiceField, self).__init__(*args, **kwargs)
+        self.widget.choices = LazyChoices(model)
+
+    def prepare_value(self, value):
+        pk = _choice_pk(value)
+        return value if pk is None else pk
+
+    def valid_value(self, value):
+        return _choice_pk(value) in dict(cached_choices(self.model))
+
+    def clean(self, value):
+        value = super(CachedModelChoiceField, self).clean(value)
+        if value in self.empty_values:
+            return None
+        return _choice_pk(value)
+
+    def choice_label(self, pk):
+        return dict(cached_choices(self.model)).get(pk, '')
+
+
+class CachedChoiceModelForm(forms.ModelForm):
+    """
+    ModelForm whose CachedModelChoiceFields set their foreign key ids on
+    the instance and are left out of model validation. They are already
+    checked against the cached choices, and ForeignKey.validate() would
+    look the row up again.
+    """
+    def _post_clean(self):
+        cached = dict((name, self.cleaned_data.pop(name)) for name, field in self.fields.items()
+                      if isinstance(field, CachedModelChoiceField) and name in self.cleaned_data)
+        for name, pk in cached.items():
+            field = self.instance._meta.get_field(name)
+            setattr(self.instance, field.attname, pk)
+            # Forget the row loaded for the old id
+            self.instance.__dict__.pop(field.get_cache_name(), None)
+        try:
+            super(CachedChoiceModelForm, self)._post_clean()
+        finally:
+            self.cleaned_data.update(cached)
+
+    def _get_validation_exclusions(self):
+        exclude = super(CachedChoiceModelForm, self)._get_validation_exclusions()
+        return exclude + [name for name, field in self.fields.items()
+                          if isinstance(field, CachedModelChoiceField) and name not in exclude]
+
+
+def clean_datetime_range(form):
+    """
+    Verify that a form's end_datetime comes after its start_datetime, and
+    not more than booking.MAX_DURATION after it
+    """
+    start_datetime = form.cleaned_data.get('start_datetime')
+    end_datetime = form.cleaned_data.get('end_datetime')
+    if start_datetime and end_datetime:
+        try:
+            booking.check_duration(start_datetime, end_datetime)
+        except ValueError as e:
+            raise forms.ValidationError(force_text(e))
+    return form.cleaned_data
+
+
+REPEAT_CHOICES = (('', 'Does not repeat'), ('DAILY', 'Daily'), ('WEEKLY', 'Weekly'), ('MONTHLY', 'Monthly'))
+
+def clean_repeat(form):
+    """
+    Turn a form's repeat fields into an RRULE in cleaned_data['rule'],
+    None for a one-off event
+    """
+    data = form.cleaned_data
+    data['rule'] = None
+    if not data.get('repeat') or not data.get('start_datetime') or not data.get('end_datetime'):
+        return data
+    if data.get('repeat_until') and data.get('repeat_count'):
+        raise forms.ValidationError("Give either an end date or a number of times, not both.")
+    until = None
+    if data.get('repeat_until'):
+        until = timezone.make_aware(datetime.combine(data['repeat_until'], time.max), timezone.get_current_timezone())
+        if until < data['start_datetime']:
+            raise forms.ValidationError("The series must end after the first event.")
+    rule = recurrence.build(data['repeat'], data.get('repeat_interval') or 1, count=data.get('repeat_count'), until=until)
+    upcoming = recurrence.starts(data['start_datetime'], recurrence.parse(rule))
+    next(upcoming)
+    following = next(upcoming, None)
+    if following is not None and following < data['end_datetime']:
+        raise forms.ValidationError("Each event must end before the next one in the series starts.")
+    data['rule'] = rule
+    return data
+
 
 class RegistrationForm(forms.Form):
     """
@@ -35,8 +213,7 @@ class RegistrationForm(forms.Form):
         in use.
         
         """
-        existing = User.objects.filter(username__iexact=self.cleaned_data['username'])
-        if existing.exists():
+        if accounts.username_taken(self.cleaned_data['username']):
             raise forms.ValidationError("A user with that username already exists.")
         else:
             return self.cleaned_data['username']
@@ -47,7 +224,7 @@ class RegistrationForm(forms.Form):
         site.
         
         """
-        if User.objects.filter(email__iexact=self.cleaned_data['email']):
+        if accounts.email_taken(self.cleaned_data['email']):
             raise forms.ValidationError("This email address is already in use. Please supply a different email address.")
         return self.cleaned_data['email']
 
@@ -67,9 +244,9 @@ class RegistrationForm(forms.Form):
 
 class EventCreationForm(forms.Form):
     name = forms.CharField(label='Name', max_length=255, widget=forms.TextInput(attrs={'class':'form-control '}))
-    category =  forms.ModelChoiceField(queryset=Category.objects.all(), widget=forms.Select(attrs={'class':'form-control',} ),)
+    category =  CachedModelChoiceField(Category, widget=CachedChoiceSelect(attrs={'class':'form-control',} ),)
     description = forms.CharField(label='Description', max_length=1000, widget=forms.Textarea(attrs={'class':'form-control'}))
-    location =  forms.ModelChoiceField(queryset=Location.objects.all(), widget=forms.Select(attrs={'class':'form-control',} ),)
+    location =  CachedModelChoiceField(Location, widget=CachedChoiceSelect(attrs={'class':'form-control',} ),)
     start_datetime = forms.DateTimeField(label='Start Date/Time',  widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy hh:mm'}))
     end_datetime = forms.DateTimeField(label='End Date/Time',  widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy hh:mm',}))
     is_public = forms.BooleanField(label='Public Event', required=False)
@@ -77,10 +254,18 @@ class EventCreationForm(forms.Form):
     staff_fee = forms.DecimalField(max_digits=4, decimal_places=2, widget=forms.NumberInput(attrs={'value':'0'}))
     public_fee = forms.DecimalField(max_digits=4, decimal_places=2, widget=forms.NumberInput(attrs={'value':'0'}))
     prepay = forms.BooleanField(label='Can Pre-pay', required=False)
+    repeat = forms.ChoiceField(label='Repeat', choices=REPEAT_CHOICES, required=False, widget=forms.Select(attrs={'class':'form-control'}))
+    repeat_interval = forms.IntegerField(label='Every', min_value=1, max_value=52, required=False, widget=forms.NumberInput(attrs={'class':'form-control', 'value':'1'}))
+    repeat_until = forms.DateField(label='Until', required=False, widget=forms.DateInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+    repeat_count = forms.IntegerField(label='Times', min_value=1, max_value=500, required=False, widget=forms.NumberInput(attrs={'class':'form-control'}))
 
-class EventEditForm(forms.ModelForm):
+    def clean(self):
+        clean_datetime_range(self)
+        return clean_repeat(self)
+
+class EventEditForm(CachedChoiceModelForm):
     name = forms.CharField(label='Name', max_length=255, widget=forms.TextInput(attrs={'class':'form-control '}))
-    category =  forms.ModelChoiceField(queryset=Category.objects.all(), widget=forms.Select(attrs={'class':'form-control',} ),)
+    category =  CachedModelChoiceField(Category, widget=CachedChoiceSelect(attrs={'class':'form-control',} ),)
     description = forms.CharField(label='Description', max_length=1000, widget=forms.Textarea(attrs={'class':'form-control '}))
     is_public = forms.BooleanField(label='Public Event', required=False)
     student_fee = forms.DecimalField(max_digits=4, decimal_places=2)
@@ -92,22 +277,71 @@ class EventEditForm(forms.ModelForm):
         model = Event
         fields = ('name', 'category', 'description', 'is_public', 'student_fee', 'staff_fee', 'public_fee', 'prepay')
 
-class ReservationEditForm(forms.ModelForm):
-    location =  forms.ModelChoiceField(queryset=Location.objects.all(), widget=forms.Select(attrs={'class':'form-control',} ),)
+class ReservationEditForm(CachedChoiceModelForm):
+    location =  CachedModelChoiceField(Location, widget=CachedChoiceSelect(attrs={'class':'form-control',} ),)
     start_datetime = forms.DateTimeField(label='Start Date/Time',  widget=forms.DateTimeInput(attrs={'class':'form-control','placeholder':'mm/dd/yy hh:mm'}))
     end_datetime = forms.DateTimeField(label='End Date/Time',  widget=forms.DateTimeInput(attrs={'class':'form-control', 'placeholder':'mm/dd/yy hh:mm'}))
     class Meta:
         model = Reservation
         fields = ('location', 'start_datetime', 'end_datetime')
 
+    def clean(self):
+        return clean_datetime_range(self)
+
 class SummaryReportForm(forms.Form):
-    week_start_datetime = forms.DateTimeField(label='Week Starting Date/Time',  widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+    start_datetime = forms.DateTimeField(label='Starting Date',  widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+    end_datetime = forms.DateTimeField(label='Ending Date', required=False, widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+
+    def clean(self):
+        """
+        Default to a one week report when no end date is given, and make sure
+        the range is not empty or too long to break down by week.
+        """
+        start_datetime = self.cleaned_data.get('start_datetime')
+        if start_datetime is None:
+            return self.cleaned_data
+        end_datetime = self.cleaned_data.get('end_datetime')
+        if end_datetime is None:
+            end_datetime = start_datetime + timedelta(days=7)
+            self.cleaned_data['end_datetime'] = end_datetime
+        if end_datetime <= start_datetime:
+            raise forms.ValidationError("The end date must be after the start date.")
+        if end_datetime - start_datetime > timedelta(weeks=MAX_REPORT_WEEKS):
+            raise forms.ValidationError("Reports can cover at most %d weeks." % MAX_REPORT_WEEKS)
+        return self.cleaned_data
+
+# Longest window the availability view searches
+MAX_AVAILABILITY_DAYS = 62
+
+class AvailabilityForm(forms.Form):
+    start_datetime = forms.DateTimeField(label='From')
+    end_datetime = forms.DateTimeField(label='Until')
+    min_duration = forms.IntegerField(label='Minimum length (minutes)', min_value=1, required=False)
+    capacity = forms.IntegerField(label='Minimum capacity', min_value=1, required=False)
+
+    def clean(self):
+        clean_datetime_range(self)
+        start_datetime = self.cleaned_data.get('start_datetime')
+        end_datetime = self.cleaned_data.get('end_datetime')
+        if start_datetime and end_datetime and end_datetime - start_datetime > timedelta(days=MAX_AVAILABILITY_DAYS):
+            raise forms.ValidationError("Availability can be searched at most %d days at a time." % MAX_AVAILABILITY_DAYS)
+        if not self.cleaned_data.get('min_duration'):
+            self.cleaned_data['min_duration'] = 60
+        return self.cleaned_data
+
+class RosterExportForm(forms.Form):
+    start_datetime = forms.DateTimeField(label='From', widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+    end_datetime = forms.DateTimeField(label='Until', widget=forms.DateTimeInput(attrs={'class':'form-control ', 'placeholder':'mm/dd/yy'}))
+
+    def clean(self):
+        return clean_datetime_range(self)
 
 class QueryForm(forms.Form):
 	query = forms.CharField(label='SQL SELECT Statement', widget=forms.Textarea(attrs={'class':'form-control '}))
+	page = forms.IntegerField(min_value=1, required=False, widget=forms.HiddenInput)
 
 	def clean(self):
-	    if self.cleaned_data['query'][:6].lower() != 'select':
+	    if self.cleaned_data.get('query', '').strip()[:6].lower() != 'select':
 	        raise forms.ValidationError("The query must be a SELECT statement.")
 	    return self.cleaned_data
 
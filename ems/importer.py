@@ -0,0 +1,376 @@
+"""
+Bulk import of events from CSV and iCalendar files.
+
+Rows are read as a stream and saved in batches: categories, locations and
+creators are resolved through in-memory maps, each batch is checked for
+double bookings with one query (see booking.check_slots) and its events
+and reservations are written with bulk inserts. Only the lookup maps and
+one batch of rows are held in memory, whatever the size of the file.
+
+CSV files need a header row naming the columns below; ICS files are read
+from their VEVENT components (SUMMARY, DESCRIPTION, LOCATION, CATEGORIES,
+DTSTART, DTEND or DURATION and ORGANIZER).
+"""
+import csv
+import re
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django import forms
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from ems.models import Category, Location, Event, Reservation
+from ems import booking, caching, rollups, search, status_const
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+COLUMNS = ('name', 'category', 'location', 'start', 'end', 'description', 'creator',
+           'is_public', 'student_fee', 'staff_fee', 'public_fee', 'prepay')
+
+REQUIRED_COLUMNS = ('name', 'category', 'location', 'start', 'end')
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y')
+
+# Length of ICS events that give neither DTEND nor DURATION
+DEFAULT_DURATION = timedelta(hours=1)
+
+# Ids per "IN" clause when resolving creators and indexing events (SQLite
+# allows 999 parameters)
+LOOKUP_CHUNK = 500
+
+
+class RowRejected(Exception):
+    """
+    Raised when an input row cannot be imported
+    """
+    pass
+
+
+# ----------------------------- Readers -----------------------------
+
+def read_csv(lines):
+    """
+    Yield (line number, row dict) for each data row of a CSV file
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, dict((force_text(key or '').strip().lower(), force_text(value or '').strip())
+                                    for key, value in row.items())
+
+
+def _unfold(lines):
+    """
+    Join folded iCalendar content lines, yielding (line number, line)
+    """
+    number, current = 0, None
+    for index, line in enumerate(lines, 1):
+        line = force_text(line).rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield number, current
+        number, current = index, line
+    if current is not None:
+        yield number, current
+
+
+def _split_property(line):
+    """
+    Split a content line into (name, {param: value}, value)
+    """
+    in_quotes = False
+    for index, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ':' and not in_quotes:
+            head, value = line[:index], line[index + 1:]
+            break
+    else:
+        return line.upper(), {}, ''
+    parts = head.split(';')
+    params = {}
+    for part in parts[1:]:
+        key, _, param = part.partition('=')
+        params[key.upper()] = param.strip('"')
+    return parts[0].upper(), params, value
+
+
+def _unescape(value):
+    return re.sub(r'\\([\\;,nN])', lambda match: '\n' if match.group(1) in 'nN' else match.group(1), value)
+
+
+def _ics_datetime(value, params):
+    """
+    An aware datetime from an ICS DATE or DATE-TIME value. Times without a
+    zone (or in a zone pytz does not know) are taken as site local time.
+    """
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        moment = datetime.strptime(value[:8], '%Y%m%d')
+    else:
+        moment = datetime.strptime(value.rstrip('Z')[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        return timezone.make_aware(moment, timezone.utc)
+    zone = timezone.get_current_timezone()
+    if 'TZID' in params and pytz is not None:
+        try:
+            zone = pytz.timezone(params['TZID'])
+        except pytz.UnknownTimeZoneError:
+            pass
+    return timezone.make_aware(moment, zone)
+
+
+def _ics_duration(value):
+    match = re.match(r'^\+?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$', value)
+    if not match:
+        raise ValueError("Invalid duration %s" % value)
+    weeks, days, hours, minutes, seconds = [int(part or 0) for part in match.groups()]
+    return timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+
+def read_ics(lines):
+    """
+    Yield (line number, row dict) for each VEVENT of an iCalendar file, with
+    the same keys as a CSV row. start and end are already datetimes.
+    """
+    row, number = None, 0
+    for line_number, line in _unfold(lines):
+        name, params, value = _split_property(line)
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            row, number, duration = {}, line_number, None
+        elif row is None:
+            continue
+        elif name == 'END' and value.upper() == 'VEVENT':
+            if 'end' not in row and row.get('start'):
+                row['end'] = row['start'] + (duration if duration is not None else DEFAULT_DURATION)
+            yield number, row
+            row = None
+        else:
+            try:
+                if name == 'SUMMARY':
+                    row['name'] = _unescape(value)
+                elif name == 'DESCRIPTION':
+                    row['description'] = _unescape(value)
+                elif name == 'LOCATION':
+                    row['location'] = _unescape(value)
+                elif name == 'CATEGORIES':
+                    row['category'] = _unescape(re.split(r'(?<!\\),', value)[0])
+                elif name == 'DTSTART':
+                    row['start'] = _ics_datetime(value, params)
+                elif name == 'DTEND':
+                    row['end'] = _ics_datetime(value, params)
+                elif name == 'DURATION':
+                    duration = _ics_duration(value)
+                elif name == 'ORGANIZER':
+                    row['creator'] = params.get('CN') or re.sub(r'^mailto:', '', value, flags=re.I)
+                elif name == 'CLASS':
+                    row['is_public'] = 'false' if value.upper() in ('PRIVATE', 'CONFIDENTIAL') else 'true'
+            except ValueError as e:
+                row['error'] = "%s: %s" % (name, force_text(e))
+
+
+# ----------------------------- Import ------------------------------
+
+class Lookups(object):
+    """
+    Name (or id) to primary key maps for categories, locations and
+    creators. Categories and locations are loaded once; creators are
+    fetched per batch and remembered.
+    """
+    def __init__(self, default_creator=None):
+        self.categories = self._names(Category)
+        self.locations = self._names(Location)
+        self.users = {}
+        self.default_creator = default_creator
+
+    def _names(self, model):
+        names = {}
+        for pk, name in model.objects.order_by('-id').values_list('pk', 'name'):
+            names[name.strip().lower()] = pk
+            names[str(pk)] = pk
+        return names
+
+    def load_users(self, usernames):
+        missing = list(set(usernames) - set(self.users))
+        for start in range(0, len(missing), LOOKUP_CHUNK):
+            chunk = missing[start:start + LOOKUP_CHUNK]
+            found = dict(User.objects.filter(username__in=chunk).values_list('username', 'pk'))
+            for username in chunk:
+                self.users[username] = found.get(username)
+
+    def resolve(self, names, value, label):
+        pk = names.get(force_text(value).strip().lower())
+        if pk is None:
+            raise RowRejected("Unknown %s '%s'" % (label, value))
+        return pk
+
+    def creator(self, username):
+        if not username:
+            if self.default_creator is None:
+                raise RowRejected("No creator given")
+            return self.default_creator.pk
+        pk = self.users.get(username)
+        if pk is None:
+            raise RowRejected("Unknown creator '%s'" % username)
+        return pk
+
+
+_datetime_field = forms.DateTimeField()
+
+
+def _datetime(value, label):
+    if isinstance(value, datetime):
+        return value
+    try:
+        return _datetime_field.clean(value)
+    except forms.ValidationError:
+        raise RowRejected("Invalid %s '%s'" % (label, value))
+
+
+def _decimal(value, label):
+    try:
+        fee = Decimal(value or 0)
+    except InvalidOperation:
+        raise RowRejected("Invalid %s '%s'" % (label, value))
+    if fee < 0 or fee >= 100:
+        raise RowRejected("%s must be between 0 and 99.99" % label)
+    return fee
+
+
+def build(row, lookups, status):
+    """
+    The unsaved Event and Reservation for one input row
+    """
+    if row.get('error'):
+        raise RowRejected(row['error'])
+    for column in REQUIRED_COLUMNS:
+        if not row.get(column):
+            raise RowRejected("Missing %s" % column)
+    start = _datetime(row['start'], 'start')
+    end = _datetime(row['end'], 'end')
+    try:
+        booking.check_duration(start, end)
+    except ValueError as e:
+        raise RowRejected(force_text(e))
+    event = Event(creator_id=lookups.creator(row.get('creator')),
+                  category_id=lookups.resolve(lookups.categories, row['category'], 'category'),
+                  name=row['name'][:255],
+                  description=row.get('description', '')[:1000],
+                  is_public=row.get('is_public', 'true').lower() in TRUE_VALUES,
+                  student_fee=_decimal(row.get('student_fee'), 'student_fee'),
+                  staff_fee=_decimal(row.get('staff_fee'), 'staff_fee'),
+                  public_fee=_decimal(row.get('public_fee'), 'public_fee'),
+                  prepay=row.get('prepay', '').lower() in TRUE_VALUES)
+    reservation = Reservation(location_id=lookups.resolve(lookups.locations, row['location'], 'location'),
+                              start_datetime=start, end_datetime=end, status=status)
+    return event, reservation
+
+
+def _next_id(model):
+    return (model.objects.aggregate(top=Max('id'))['top'] or 0) + 1
+
+
+def save_batch(batch):
+    """
+    Save a batch of (line number, event, reservation), skipping rows that
+    overlap an existing booking or an earlier row of the batch. Returns
+    the saved reservations and a list of (line number, reason) rejects.
+    """
+    if not batch:
+        return [], []
+    slots = [(reservation.location_id, reservation.start_datetime, reservation.end_datetime)
+             for line, event, reservation in batch]
+    with transaction.atomic():
+        accepted = []
+        rejects = []
+        for (line, event, reservation), (event_ids, slot_indexes) in zip(batch, booking.check_slots(slots, lock=True)):
+            if event_ids:
+                rejects.append((line, "Location is already booked by event(s) %s"
+                                      % ', '.join(str(event_id) for event_id in event_ids)))
+            elif slot_indexes:
+                rejects.append((line, "Overlaps line(s) %s of the import"
+                                      % ', '.join(str(batch[index][0]) for index in slot_indexes)))
+            else:
+                accepted.append((event, reservation))
+
+        # bulk_create does not return primary keys, so events are given ids
+        # up front. The location locks do not cover the event table, so a
+        # clash with a concurrent insert rolls the batch back to be retried.
+        first_id = _next_id(Event)
+        for offset, (event, reservation) in enumerate(accepted):
+            event.id = first_id + offset
+            reservation.event = event
+        Event.objects.bulk_create([event for event, reservation in accepted])
+        reservations = [reservation for event, reservation in accepted]
+        Reservation.objects.bulk_create(reservations)
+        rollups.add_reservations(reservations)
+
+        # Databases with sequences (PostgreSQL) need them moved past the explicit ids
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Event]):
+            cursor.execute(sql)
+
+    event_ids = [event.id for event, reservation in accepted]
+    for start in range(0, len(event_ids), LOOKUP_CHUNK):
+        search.index_events(event_ids[start:start + LOOKUP_CHUNK])
+    caching.bump('location', *set(reservation.location_id for reservation in reservations))
+    caching.bump('category', *set(event.category_id for event, reservation in accepted))
+    caching.bump('user', *set(event.creator_id for event, reservation in accepted))
+    # The new events have nothing cached yet, but lists of all events do
+    caching.bump('event', caching.ALL)
+    return reservations, rejects
+
+
+def import_rows(rows, creator=None, status=status_const.PENDING, batch_size=1000, on_reject=None, retries=3):
+    """
+    Import (line number, row dict) pairs as events and reservations.
+    on_reject is called with (line number, reason) for every row that is
+    skipped. Returns the number of events imported and rejected.
+    """
+    lookups = Lookups(creator)
+    imported = rejected = 0
+
+    def reject(line, reason):
+        if on_reject is not None:
+            on_reject(line, reason)
+
+    def flush(pending):
+        lookups.load_users(row.get('creator') for line, row in pending if row.get('creator'))
+        batch = []
+        rejects = []
+        for line, row in pending:
+            try:
+                event, reservation = build(row, lookups, status)
+            except RowRejected as e:
+                rejects.append((line, force_text(e)))
+            else:
+                batch.append((line, event, reservation))
+        for attempt in range(retries):
+            try:
+                saved, conflicts = save_batch(batch)
+                break
+            except IntegrityError:
+                if attempt == retries - 1:
+                    raise
+        for line, reason in sorted(rejects + conflicts):
+            reject(line, reason)
+        return len(saved), len(rejects) + len(conflicts)
+
+    pending = []
+    for line, row in rows:
+        pending.append((line, row))
+        if len(pending) >= batch_size:
+            saved, skipped = flush(pending)
+            imported, rejected, pending = imported + saved, rejected + skipped, []
+    if pending:
+        saved, skipped = flush(pending)
+        imported, rejected = imported + saved, rejected + skipped
+    return imported, rejected
@@ -0,0 +1,167 @@
+"""
+Background jobs stored in the project's database.
+
+Views enqueue follow-up work (emails, and the attendance rows of the
+creators of approved events) as Job rows in the same transaction as the
+change that caused it, and the run_worker command runs them. Workers
+claim a batch of due jobs at a time under a row lock, so several workers
+never run the same job. A job is marked done in the transaction of its
+task's own writes, so a task that has committed is never run again; failed
+jobs are retried with exponential backoff until they run out of attempts.
+
+Tasks are plain functions registered with the @task decorator and called
+with the job's payload as keyword arguments. The tasks in ems.tasks are
+registered the first time a job is queued or run, as that module imports
+the ones whose work it does. Set EMS_JOBS_EAGER to run them at once
+inside enqueue() instead.
+"""
+import json
+import logging
+import os
+import socket
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ems.models import Job
+
+logger = logging.getLogger('ems.jobs')
+
+# Seconds before the first retry; doubled for every further attempt
+RETRY_DELAY = getattr(settings, 'EMS_JOB_RETRY_DELAY', 30)
+MAX_RETRY_DELAY = getattr(settings, 'EMS_JOB_MAX_RETRY_DELAY', 60 * 60)
+
+# Seconds after which a running job whose worker went away is run again
+JOB_TIMEOUT = getattr(settings, 'EMS_JOB_TIMEOUT', 10 * 60)
+
+TASKS = {}
+
+
+def task(function):
+    """
+    Register a function as a task, under its name
+    """
+    TASKS[function.__name__] = function
+    return function
+
+
+def load_tasks():
+    # Importing the module registers its tasks
+    from ems import tasks
+
+
+def enqueue(task_name, delay=0, max_attempts=5, **kwargs):
+    """
+    Queue a task to be run with the given keyword arguments, which must be
+    JSON serializable. Call it inside the transaction of the change the
+    task follows up on, so the job only exists if the change is committed.
+    """
+    load_tasks()
+    if task_name not in TASKS:
+        raise KeyError("Unknown task %s" % task_name)
+    now = timezone.now()
+    job = Job.objects.create(task=task_name, payload=json.dumps(kwargs), max_attempts=max_attempts,
+                             run_after=now + timedelta(seconds=delay), created=now)
+    if getattr(settings, 'EMS_JOBS_EAGER', False):
+        run(job)
+    return job
+
+
+def default_worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def claim(batch_size=10, worker=None):
+    """
+    Lock and mark as running up to batch_size due jobs, oldest first
+    """
+    worker = worker or default_worker_name()
+    now = timezone.now()
+    with transaction.atomic():
+        # Jobs left running by a worker that died go back in the queue
+        Job.objects.filter(status=Job.RUNNING, started_at__lt=now - timedelta(seconds=JOB_TIMEOUT)) \
+                   .update(status=Job.QUEUED, locked_by='')
+        jobs = list(Job.objects.select_for_update()
+                               .filter(status=Job.QUEUED, run_after__lte=now)
+                               .order_by('run_after', 'id')[:batch_size])
+        if jobs:
+            Job.objects.filter(id__in=[job.id for job in jobs]).update(status=Job.RUNNING, locked_by=worker,
+                                                                       started_at=now)
+    for job in jobs:
+        job.status, job.locked_by, job.started_at = Job.RUNNING, worker, now
+    return jobs
+
+
+def backoff(attempts):
+    """
+    Seconds to wait before retrying a job that has failed attempts times
+    """
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def _finish(job, began):
+    job.finished_at = timezone.now()
+    job.duration = (time.time() - began) * 1000
+    job.locked_by = ''
+    job.save()
+
+
+def run(job):
+    """
+    Run one job and record the outcome. Returns True if the task succeeded.
+    A claimed job that another worker has since claimed again (its batch
+    outlasted JOB_TIMEOUT) is left to that worker.
+    """
+    load_tasks()
+    began = time.time()
+    now = timezone.now()
+    if job.status == Job.RUNNING:
+        # The timeout counts from when each job starts, not from the claim
+        if not Job.objects.filter(pk=job.pk, status=Job.RUNNING, locked_by=job.locked_by).update(started_at=now):
+            return False
+    job.started_at = now
+    job.attempts += 1
+    try:
+        with transaction.atomic():
+            TASKS[job.task](**json.loads(job.payload))
+            job.status = Job.DONE
+            _finish(job, began)
+        return True
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            logger.error("Job %d (%s) failed for good:\n%s", job.id, job.task, job.last_error)
+        else:
+            job.status = Job.QUEUED
+            job.run_after = timezone.now() + timedelta(seconds=backoff(job.attempts))
+            logger.warning("Job %d (%s) failed, retrying at %s", job.id, job.task, job.run_after)
+        _finish(job, began)
+        return False
+
+
+def work(batch_size=10, worker=None):
+    """
+    Claim and run one batch of due jobs. Returns the number run.
+    """
+    jobs = claim(batch_size, worker)
+    for job in jobs:
+        run(job)
+    return len(jobs)
+
+
+def work_all(batch_size=10, worker=None):
+    """
+    Run due jobs until none are left. Returns the number run.
+    """
+    total = 0
+    while True:
+        count = work(batch_size, worker)
+        if not count:
+            return total
+        total += count
+
@@ -0,0 +1,382 @@
+"""
+Load test harness behind the loadtest command.
+
+The site's WSGI application is served from a threaded server in this
+process (or a running server is targeted by its base URL), and a number
+of logged in clients drive a mix of actions against it from their own
+threads: browsing the event list, searching, opening event details,
+attending events and, for staff clients, approving pending events. Every
+request is timed and filed under its URL name, so the report gives the
+throughput and latency percentiles of each route.
+
+Clients share the process, and the GIL, with an in-process server, so
+absolute numbers are lower than a deployment's. Compare runs made the
+same way.
+"""
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.utils.six.moves import http_client, http_cookies, socketserver
+from django.utils.six.moves.urllib.parse import urlencode, urlsplit
+
+from ems.models import Reservation
+from ems import caching, status_const, synthetic
+
+# Relative weight of each action in the traffic mix
+DEFAULT_MIX = (('browse', 30), ('search', 20), ('details', 30), ('attend', 15), ('approve', 5))
+
+PERCENTILES = (50, 90, 99)
+
+# Event ids sampled for the clients to pick from
+SAMPLE_SIZE = 1000
+
+REQUEST_TIMEOUT = 30
+
+
+class LoadTestError(Exception):
+    pass
+
+
+def parse_mix(text):
+    """
+    [(action, weight)] from 'browse=30,search=20,...'; actions left out
+    are not run
+    """
+    actions = dict(DEFAULT_MIX)
+    mix = []
+    for part in text.split(','):
+        if not part.strip():
+            continue
+        action, sep, weight = part.partition('=')
+        action = action.strip()
+        if action not in actions:
+            raise LoadTestError("Unknown action %s (use %s)" % (action, ', '.join(name for name, w in DEFAULT_MIX)))
+        try:
+            weight = int(weight)
+        except ValueError:
+            raise LoadTestError("Weight of %s must be a number" % action)
+        if weight > 0:
+            mix.append((action, weight))
+    if not mix:
+        raise LoadTestError("The mix has no actions")
+    return mix
+
+
+def percentile(samples, pct):
+    """
+    Nearest rank percentile of sorted samples
+    """
+    if not samples:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+# ------------------------------ Dataset --------------------------------
+
+def seed(scale, seed_value=0, staff=1):
+    """
+    Generate a synthetic dataset and make its first users staff
+    """
+    ids = synthetic.generate(scale, seed=seed_value)
+    users = list(ids['users'])
+    User.objects.filter(id__in=users[:staff]).update(is_staff=True)
+    # Bulk updates skip the receivers that bump cache versions
+    caching.bump('account', *users[:staff])
+    return ids
+
+
+class Dataset(object):
+    """
+    The synthetic users and events the clients pick from
+    """
+    def __init__(self, clients, staff):
+        users = list(User.objects.filter(username__startswith='synthetic').order_by('id')
+                                 .values_list('username', 'is_staff')[:clients * 4])
+        staff_users = [username for username, is_staff in users if is_staff]
+        other_users = [username for username, is_staff in users if not is_staff]
+        if not users:
+            raise LoadTestError("No synthetic users found; run with --seed-data or run generate_data first")
+        self.staff_users = staff_users[:staff]
+        self.users = other_users or staff_users
+        self.approved = list(Reservation.objects.filter(status=status_const.APPROVED).order_by('?')
+                                                .values_list('event', flat=True)[:SAMPLE_SIZE])
+        self.locations = list(Reservation.objects.filter(status=status_const.APPROVED)
+                                                 .values_list('location', flat=True).distinct()[:SAMPLE_SIZE])
+        if not self.approved:
+            raise LoadTestError("The dataset has no approved events")
+        self._pending = list(Reservation.objects.filter(status=status_const.PENDING).order_by('?')
+                                                .values_list('event', flat=True)[:SAMPLE_SIZE])
+        self._lock = threading.Lock()
+
+    def logins(self, clients):
+        """
+        (username, is_staff) for each client, staff first
+        """
+        staff = [(username, True) for username in self.staff_users]
+        return [staff[i] if i < len(staff) else (self.users[i % len(self.users)], False) for i in range(clients)]
+
+    def pop_pending(self):
+        with self._lock:
+            return self._pending.pop() if self._pending else None
+
+
+# ------------------------------- Server --------------------------------
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def start_server(application, host='127.0.0.1', port=0):
+    """
+    Serve the application from a background thread and return the server;
+    port 0 picks a free port
+    """
+    server = make_server(host, port, application, ThreadedWSGIServer, _QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# ------------------------------- Results -------------------------------
+
+class Results(object):
+    """
+    Latencies and status codes per route, recorded from every client
+    """
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route, milliseconds, status):
+        with self._lock:
+            self.latencies[route].append(milliseconds)
+            self.statuses[route][str(status)] += 1
+            if status is None or status >= 500:
+                self.errors[route] += 1
+
+    def _summary(self, samples, errors, elapsed):
+        samples = sorted(samples)
+        summary = {
+            'requests': len(samples),
+            'errors': errors,
+            'throughput': round(len(samples) / float(elapsed), 2) if elapsed else None,
+            'mean_ms': round(sum(samples) / float(len(samples)), 2) if samples else None,
+            'max_ms': round(samples[-1], 2) if samples else None,
+        }
+        for pct in PERCENTILES:
+            value = percentile(samples, pct)
+            summary['p%d_ms' % pct] = round(value, 2) if value is not None else None
+        return summary
+
+    def report(self, elapsed, **info):
+        """
+        The run as a JSON serializable dict: info, the whole run's totals
+        and one entry per route
+        """
+        routes = {}
+        for route, samples in self.latencies.items():
+            routes[route] = self._summary(samples, self.errors[route], elapsed)
+            routes[route]['statuses'] = dict(self.statuses[route])
+        every = [sample for samples in self.latencies.values() for sample in samples]
+        report = dict(info)
+        report.update({'elapsed': round(elapsed, 2),
+                       'total': self._summary(every, sum(self.errors.values()), elapsed),
+                       'routes': routes})
+        return report
+
+
+def format_report(report, previous=None):
+    """
+    Lines of a table of the routes in a report, with the change in p50 and
+    p99 from a previous report when one is given
+    """
+    columns = ['requests', 'errors', 'throughput', 'mean_ms'] + ['p%d_ms' % pct for pct in PERCENTILES] + ['max_ms']
+    header = '%-22s' % 'route' + ''.join('%12s' % column for column in columns)
+    if previous:
+        header += '%12s%12s' % ('p50 change', 'p99 change')
+    lines = [header]
+    rows = sorted(report['routes'].items()) + [('TOTAL', report['total'])]
+    for route, summary in rows:
+        line = '%-22s' % route + ''.join('%12s' % ('-' if summary[column] is None else summary[column])
+                                         for column in columns)
+        if previous:
+            before = previous['total'] if route == 'TOTAL' else previous.get('routes', {}).get(route)
+            for column in ('p50_ms', 'p99_ms'):
+                if before and before.get(column) and summary[column] is not None:
+                    line += '%11.0f%%' % ((summary[column] - before[column]) * 100.0 / before[column])
+                else:
+                    line += '%12s' % '-'
+        lines.append(line)
+    return lines
+
+
+# ------------------------------- Clients -------------------------------
+
+class Client(object):
+    """
+    A browser session: keeps its cookies and times every request
+    """
+    def __init__(self, base_url, results):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.results = results
+        self.cookies = {}
+        self.recording = True
+
+    def _cookie_headers(self, response):
+        if hasattr(response.msg, 'get_all'):
+            return response.msg.get_all('Set-Cookie') or []
+        return response.msg.getheaders('Set-Cookie')
+
+    def request(self, route, path, params=None, method='GET'):
+        """
+        Make one request and return (status, body); redirects are not
+        followed. Failed connections are recorded with status None.
+        """
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % item for item in self.cookies.items())
+        if params and method == 'GET':
+            path += '?' + urlencode(params)
+        elif params:
+            body = urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection = http_client.HTTPConnection(self.host, self.port, timeout=REQUEST_TIMEOUT)
+        started = time.time()
+        try:
+            connection.request(method, self.prefix + path, body, headers)
+            response = connection.getresponse()
+            content = response.read()
+            status = response.status
+        except (IOError, http_client.HTTPException):
+            content, status, response = b'', None, None
+        finally:
+            connection.close()
+        if self.recording:
+            self.results.record(route, (time.time() - started) * 1000, status)
+        if response is not None:
+            for header in self._cookie_headers(response):
+                cookie = http_cookies.SimpleCookie()
+                cookie.load(header)
+                for name, morsel in cookie.items():
+                    if morsel.value and morsel['max-age'] != '0':
+                        self.cookies[name] = morsel.value
+                    else:
+                        self.cookies.pop(name, None)
+        return status, content
+
+    def login(self, username, password):
+        self.request('login', reverse('login'))
+        status, content = self.request('login', reverse('login'),
+                                       {'username': username, 'password': password,
+                                        'csrfmiddlewaretoken': self.cookies.get('csrftoken', '')}, 'POST')
+        if status != 302:
+            raise LoadTestError("Could not log in as %s (status %s)" % (username, status))
+
+
+DATATABLE_PARAMS = {'sEcho': 1, 'iDisplayLength': 25, 'iSortCol_0': 3, 'sSortDir_0': 'asc'}
+
+
+class Worker(object):
+    """
+    One logged in client running actions from the mix until stopped
+    """
+    def __init__(self, client, dataset, mix, is_staff, rng):
+        self.client = client
+        self.dataset = dataset
+        self.mix = [(action, weight) for action, weight in mix if is_staff or action != 'approve']
+        self.rng = rng
+
+    def _choose(self):
+        point = self.rng.uniform(0, sum(weight for action, weight in self.mix))
+        for action, weight in self.mix:
+            point -= weight
+            if point <= 0:
+                return action
+        return self.mix[-1][0]
+
+    def browse(self):
+        self.client.request('all_events', reverse('all_events'))
+        self.client.request('all_events_data', reverse('all_events_data'),
+                            dict(DATATABLE_PARAMS, iDisplayStart=self.rng.choice((0, 0, 25, 50))))
+        if self.dataset.locations and self.rng.random() < 0.3:
+            location = self.rng.choice(self.dataset.locations)
+            self.client.request('location_details', reverse('location_details', args=[location]))
+
+    def search(self):
+        self.client.request('all_events_search', reverse('all_events_data'),
+                            dict(DATATABLE_PARAMS, iDisplayStart=0, sSearch=self.rng.choice(synthetic.WORDS)))
+
+    def details(self):
+        event_id = self.rng.choice(self.dataset.approved)
+        self.client.request('event_details', reverse('event_details', args=[event_id]))
+
+    def attend(self):
+        event_id = self.rng.choice(self.dataset.approved)
+        self.client.request('attend', reverse('attend', args=[event_id]))
+        self.client.request('my_events', reverse('my_events'))
+
+    def approve(self):
+        self.client.request('pending_events', reverse('pending_events'))
+        event_id = self.dataset.pop_pending()
+        if event_id is not None:
+            self.client.request('approve_event', reverse('approve_event', args=[event_id]))
+
+    def run(self, warmup_until, stop_at):
+        self.client.recording = False
+        while time.time() < stop_at:
+            self.client.recording = time.time() >= warmup_until
+            getattr(self, self._choose())()
+
+
+def run(base_url, dataset, clients=10, duration=30, warmup=5, mix=DEFAULT_MIX, password=synthetic.PASSWORD,
+        seed_value=0):
+    """
+    Log the clients in, run the mix for warmup + duration seconds and
+    return (Results, seconds recorded)
+    """
+    results = Results()
+    rng = random.Random(seed_value)
+    workers = []
+    for username, is_staff in dataset.logins(clients):
+        client = Client(base_url, results)
+        client.recording = False
+        client.login(username, password)
+        workers.append(Worker(client, dataset, mix, is_staff, random.Random(rng.random())))
+    warmup_until = time.time() + warmup
+    stop_at = warmup_until + duration
+    threads = [threading.Thread(target=worker.run, args=(warmup_until, stop_at)) for worker in workers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, duration
+
+
+def load_report(path):
+    with open(path) as report_file:
+        return json.load(report_file)
+
+
+def save_report(report, path):
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
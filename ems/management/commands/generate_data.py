@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ems import synthetic
+
+
+class Command(NoArgsCommand):
+    help = "Insert a synthetic dataset of users, categories, locations, events, reservations and attendance."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--events', type='int', default=1000, help='Number of events (default 1000)'),
+        make_option('--users', type='int', default=None, help='Number of users (default scales with events)'),
+        make_option('--categories', type='int', default=10),
+        make_option('--locations', type='int', default=50),
+        make_option('--attendance-per-event', type='int', dest='attendance_per_event', default=20),
+        make_option('--seed', type='int', default=0),
+        make_option('--no-index', action='store_false', dest='index', default=True,
+                    help='Skip rebuilding the search index'),
+    )
+
+    def handle_noargs(self, **options):
+        scale = synthetic.Scale(events=options['events'], users=options['users'],
+                                categories=options['categories'], locations=options['locations'],
+                                attendance_per_event=options['attendance_per_event'])
+        synthetic.generate(scale, seed=options['seed'], index=options['index'])
+        self.stdout.write("Generated %r." % scale)
@@ -0,0 +1,57 @@
+import os
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from ems import importer, status_const
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Import events from a CSV or iCalendar (.ics) file. CSV files need a header row with the columns %s "
+            "(name, category, location, start and end are required). Rows that cannot be imported, including "
+            "double bookings, are reported and skipped." % ', '.join(importer.COLUMNS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=('csv', 'ics'), default=None,
+                    help='Input format (default from the file extension)'),
+        make_option('--creator', default=None,
+                    help='Username of the creator for rows that do not name one'),
+        make_option('--approve', action='store_true', default=False,
+                    help='Import the reservations as approved instead of pending'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000),
+        make_option('--rejects', default=None,
+                    help='Write rejected rows to this file instead of standard error'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import.")
+        path = args[0]
+        file_format = options['format'] or os.path.splitext(path)[1].lower().lstrip('.')
+        if file_format not in ('csv', 'ics'):
+            raise CommandError("Unknown format '%s'; use --format csv or --format ics." % file_format)
+
+        creator = None
+        if options['creator']:
+            try:
+                creator = User.objects.get(username=options['creator'])
+            except User.DoesNotExist:
+                raise CommandError("No user named '%s'." % options['creator'])
+
+        rejects = open(options['rejects'], 'w') if options['rejects'] else sys.stderr
+        def on_reject(line, reason):
+            rejects.write("line %d: %s\n" % (line, reason))
+
+        status = status_const.APPROVED if options['approve'] else status_const.PENDING
+        try:
+            with open(path, 'rU') as input_file:
+                reader = importer.read_csv if file_format == 'csv' else importer.read_ics
+                imported, rejected = importer.import_rows(reader(input_file), creator=creator, status=status,
+                                                          batch_size=options['batch_size'], on_reject=on_reject)
+        finally:
+            if rejects is not sys.stderr:
+                rejects.close()
+        self.stdout.write("Imported %d events, rejected %d." % (imported, rejected))
@@ -0,0 +1,81 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ems import loadtest, synthetic
+
+
+class Command(NoArgsCommand):
+    help = ("Serve the site from a local WSGI server and drive mixed traffic from logged in clients over the "
+            "synthetic dataset (seeded first with --seed-data), reporting throughput and latency percentiles per route.")
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--clients', type='int', default=10, help="Concurrent clients (default 10)."),
+        make_option('--duration', type='float', default=30, help="Seconds of recorded traffic (default 30)."),
+        make_option('--warmup', type='float', default=5, help="Seconds of unrecorded traffic first (default 5)."),
+        make_option('--mix', default=','.join('%s=%d' % item for item in loadtest.DEFAULT_MIX),
+                    help="Action weights, e.g. browse=30,search=20,details=30,attend=15,approve=5."),
+        make_option('--staff', type='int', default=1, help="Clients logged in as staff, who approve events."),
+        make_option('--events', type='int', default=1000, help="Events to seed (default 1000)."),
+        make_option('--users', type='int', default=None, help="Users to seed (default scales with events)."),
+        make_option('--attendance-per-event', type='int', dest='attendance_per_event', default=20),
+        make_option('--seed', type='int', default=0, help="Random seed for the dataset and the traffic."),
+        make_option('--seed-data', action='store_true', dest='seed_data', default=False,
+                    help="Bulk insert a synthetic dataset into the configured database first, making its first "
+                         "--staff users staff. Point DATABASES at a scratch database."),
+        make_option('--url', default=None,
+                    help="Base URL of a running server to test instead of starting one."),
+        make_option('--port', type='int', default=0, help="Port of the local server (default any free port)."),
+        make_option('--output', default=None, help="Write the results to this JSON file."),
+        make_option('--compare', default=None, help="Show the change from the results in this JSON file."),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+            previous = loadtest.load_report(options['compare']) if options['compare'] else None
+        except (loadtest.LoadTestError, IOError, ValueError) as e:
+            raise CommandError(e)
+        if settings.DEBUG:
+            self.stderr.write("DEBUG is on: queries are logged in memory and pages are not bundled. "
+                              "Turn it off for representative numbers.")
+
+        scale = None
+        if options['seed_data']:
+            scale = synthetic.Scale(events=options['events'], users=options['users'],
+                                    attendance_per_event=options['attendance_per_event'])
+            self.stdout.write("Seeding %r." % scale)
+            loadtest.seed(scale, options['seed'], options['staff'])
+
+        try:
+            dataset = loadtest.Dataset(options['clients'], options['staff'])
+        except loadtest.LoadTestError as e:
+            raise CommandError(e)
+
+        server = None
+        base_url = options['url']
+        if base_url is None:
+            from ems_site.wsgi import application
+            server = loadtest.start_server(application, port=options['port'])
+            base_url = 'http://%s:%d/' % server.server_address[:2]
+        self.stdout.write("Running %d clients against %s for %ss after a %ss warmup." %
+                          (options['clients'], base_url, options['duration'], options['warmup']))
+        try:
+            results, elapsed = loadtest.run(base_url, dataset, options['clients'], options['duration'],
+                                            options['warmup'], mix, seed_value=options['seed'])
+        except loadtest.LoadTestError as e:
+            raise CommandError(e)
+        finally:
+            if server is not None:
+                server.shutdown()
+
+        report = results.report(elapsed, started=datetime.now().isoformat(), url=base_url,
+                                clients=options['clients'], staff=options['staff'], warmup=options['warmup'],
+                                mix=dict(mix), scale=repr(scale) if scale else None)
+        for line in loadtest.format_report(report, previous):
+            self.stdout.write(line)
+        if options['output']:
+            loadtest.save_report(report, options['output'])
+            self.stdout.write("Results written to %s." % options['output'])
@@ -0,0 +1,40 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ems import accounts
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Create user accounts from a roster CSV file with a header row naming the columns %s (username and "
+            "email are required; users without a password cannot log in until one is set). Rows whose username "
+            "or email is already in use, ignoring case, are reported and skipped." % ', '.join(accounts.COLUMNS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000),
+        make_option('--processes', type='int', default=None,
+                    help='Worker processes hashing passwords (default one per CPU)'),
+        make_option('--rejects', default=None,
+                    help='Write rejected rows to this file instead of standard error'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the roster file.")
+
+        rejects = open(options['rejects'], 'w') if options['rejects'] else sys.stderr
+        def on_reject(line, reason):
+            rejects.write("line %d: %s\n" % (line, reason))
+
+        try:
+            with open(args[0], 'rU') as roster:
+                created, rejected = accounts.provision(accounts.read_roster(roster), batch_size=options['batch_size'],
+                                                       processes=options['processes'], on_reject=on_reject)
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if rejects is not sys.stderr:
+                rejects.close()
+        self.stdout.write("Created %d users, rejected %d." % (created, rejected))
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from ems import registration
+
+
+class Command(NoArgsCommand):
+    help = "Recount every event's attendee_count, which the capacity check reads, from the attendance table."
+
+    def handle_noargs(self, **options):
+        count = registration.recount()
+        self.stdout.write("Recounted the attendees of %d events." % count)
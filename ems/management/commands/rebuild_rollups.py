@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from ems import rollups
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the daily reporting rollups from the event, reservation and attendance tables."
+
+    def handle_noargs(self, **options):
+        count = rollups.rebuild()
+        self.stdout.write("Wrote %d rollup rows." % count)
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from ems import search
+
+
+class Command(NoArgsCommand):
+    help = "Create the native full-text index if the database has one and reindex every event."
+
+    def handle_noargs(self, **options):
+        if search.create_native_index():
+            self.stdout.write("Created %s full-text index." % search.native_backend())
+        count = search.rebuild()
+        self.stdout.write("Indexed %d events." % count)
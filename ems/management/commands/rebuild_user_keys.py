@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from ems import accounts
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the lower case username and email keys used to check that accounts are unique."
+
+    def handle_noargs(self, **options):
+        count, duplicates = accounts.rebuild_keys()
+        self.stdout.write("Wrote %d user keys." % count)
+        for user in duplicates:
+            self.stderr.write("User %d has no key: username '%s' is already in use in another case." %
+                              (user.pk, user.username))
@@ -0,0 +1,32 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from ems import jobs
+
+
+class Command(NoArgsCommand):
+    help = "Run queued background jobs (emails, creators' attendance rows) until stopped."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=10,
+                    help="Jobs claimed at a time."),
+        make_option('--sleep', type='float', default=2.0,
+                    help="Seconds to wait when no job is due."),
+        make_option('--once', action='store_true', default=False,
+                    help="Run the jobs that are due and exit."),
+        make_option('--worker', default=None,
+                    help="Name recorded on claimed jobs (defaults to host:pid)."),
+    )
+
+    def handle_noargs(self, **options):
+        worker = options['worker'] or jobs.default_worker_name()
+        if options['once']:
+            count = jobs.work_all(options['batch_size'], worker)
+            self.stdout.write("Ran %d jobs." % count)
+            return
+        self.stdout.write("Worker %s waiting for jobs." % worker)
+        while True:
+            if not jobs.work(options['batch_size'], worker):
+                time.sleep(options['sleep'])
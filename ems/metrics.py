@@ -0,0 +1,115 @@
+"""
+Rolling per view request metrics kept in the cache.
+
+For every URL name we keep a request count and histograms of request
+latency, SQL query count and SQL time. Histograms are fixed buckets stored
+as separate cache counters and bumped with cache.incr(), so every process
+sharing the cache (memcached, or a database/file cache) adds to the same
+numbers. Percentiles are read back as the upper bound of the bucket they
+fall in.
+"""
+from django.core.cache import cache
+
+# Bucket upper bounds. Anything larger lands in the final overflow bucket.
+LATENCY_BUCKETS = (5, 10, 25, 50, 75, 100, 150, 200, 300, 500, 750, 1000, 2000, 5000, 10000)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100, 200)
+
+METRICS = (
+    ('latency', 'Request time (ms)', LATENCY_BUCKETS),
+    ('queries', 'SQL queries', QUERY_BUCKETS),
+    ('sql_time', 'SQL time (ms)', LATENCY_BUCKETS),
+)
+
+PERCENTILES = (50, 95, 99)
+
+KEY_PREFIX = 'ems:metrics'
+
+
+def _generation():
+    """
+    Counter included in every key; bumping it resets all metrics
+    """
+    generation = cache.get('%s:generation' % KEY_PREFIX)
+    if generation is None:
+        cache.add('%s:generation' % KEY_PREFIX, 1, None)
+        generation = cache.get('%s:generation' % KEY_PREFIX, 1)
+    return generation
+
+
+def _key(generation, *parts):
+    return ':'.join([KEY_PREFIX, str(generation)] + [str(part) for part in parts])
+
+
+def _incr(key):
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between add() and incr()
+            cache.add(key, 1, None)
+
+
+def _bucket(value, bounds):
+    for index, bound in enumerate(bounds):
+        if value <= bound:
+            return index
+    return len(bounds)
+
+
+def record(name, latency, queries, sql_time):
+    """
+    Add one request to the metrics of the named view. Times are in ms.
+    """
+    generation = _generation()
+    names_key = _key(generation, 'names')
+    names = cache.get(names_key) or []
+    if name not in names:
+        cache.set(names_key, sorted(names + [name]), None)
+    _incr(_key(generation, name, 'count'))
+    values = {'latency': latency, 'queries': queries, 'sql_time': sql_time}
+    for metric, label, bounds in METRICS:
+        _incr(_key(generation, name, metric, _bucket(values[metric], bounds)))
+
+
+def _percentiles(counts, bounds):
+    total = sum(counts)
+    results = []
+    for percentile in PERCENTILES:
+        if not total:
+            results.append(None)
+            continue
+        threshold = total * percentile / 100.0
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= threshold:
+                results.append(bounds[index] if index < len(bounds) else '> %s' % bounds[-1])
+                break
+    return results
+
+
+def summary():
+    """
+    One row per view: its name, request count and the percentiles of each metric
+    """
+    generation = _generation()
+    names = cache.get(_key(generation, 'names')) or []
+    keys = [_key(generation, name, 'count') for name in names]
+    for name in names:
+        for metric, label, bounds in METRICS:
+            keys.extend(_key(generation, name, metric, index) for index in range(len(bounds) + 1))
+    values = cache.get_many(keys)
+
+    rows = []
+    for name in names:
+        row = {'name': name, 'count': values.get(_key(generation, name, 'count'), 0), 'metrics': []}
+        for metric, label, bounds in METRICS:
+            counts = [values.get(_key(generation, name, metric, index), 0) for index in range(len(bounds) + 1)]
+            row['metrics'].append({'name': metric, 'label': label, 'percentiles': _percentiles(counts, bounds)})
+        rows.append(row)
+    return rows
+
+
+def reset():
+    generation = _generation()
+    cache.set('%s:generation' % KEY_PREFIX, generation + 1, None)
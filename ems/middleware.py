@@ -0,0 +1,128 @@
+"""
+Request middleware for the ems site.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from ems import metrics, routers
+
+logger = logging.getLogger('ems.metrics')
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised, when EMS_QUERY_BUDGET_RAISE is on, when a GET or HEAD request
+    runs more SQL queries than its view's budget
+    """
+    pass
+
+
+class TimingCursor(object):
+    """
+    Cursor wrapper counting and timing the statements run through it
+    """
+    def __init__(self, cursor, timings):
+        self.cursor = cursor
+        self.timings = timings
+
+    def _timed(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.timings['queries'] += 1
+            self.timings['sql_time'] += (time.time() - start) * 1000
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def _timed_cursor(connection, timings):
+    cursor = type(connection).cursor
+    return lambda: TimingCursor(cursor(connection), timings)
+
+
+def query_budget(name):
+    """
+    Most queries the named view may run, or None for no limit. Budgets are
+    set per URL name in EMS_QUERY_BUDGETS, falling back to
+    EMS_DEFAULT_QUERY_BUDGET.
+    """
+    budgets = getattr(settings, 'EMS_QUERY_BUDGETS', {})
+    return budgets.get(name, getattr(settings, 'EMS_DEFAULT_QUERY_BUDGET', None))
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Records latency, SQL query count and SQL time for every request under
+    its URL name (see ems.metrics), and enforces the per view query budgets.
+
+    For the length of the request, the cursors of the thread's connections
+    are wrapped in a TimingCursor, which only keeps a count and a total
+    time; no SQL is stored.
+
+    A view over its budget is logged. With EMS_QUERY_BUDGET_RAISE on (for
+    development and tests) GET and HEAD requests over budget raise
+    QueryBudgetExceeded instead; other requests have committed their
+    writes by then, so they are only logged.
+    """
+    def process_request(self, request):
+        timings = {'queries': 0, 'sql_time': 0.0}
+        request._metrics = {'start': time.time(), 'timings': timings, 'connections': list(connections.all())}
+        for connection in request._metrics['connections']:
+            connection.cursor = _timed_cursor(connection, timings)
+
+    def process_response(self, request, response):
+        state = getattr(request, '_metrics', None)
+        if state is None:
+            return response
+        latency = (time.time() - state['start']) * 1000
+        for connection in state['connections']:
+            connection.__dict__.pop('cursor', None)
+        queries = state['timings']['queries']
+        sql_time = state['timings']['sql_time']
+
+        name = self.view_name(request)
+        metrics.record(name, latency, queries, sql_time)
+
+        budget = query_budget(name)
+        if budget is not None and queries > budget:
+            message = "%s ran %d SQL queries, over its budget of %d" % (name, queries, budget)
+            if getattr(settings, 'EMS_QUERY_BUDGET_RAISE', False) and request.method in ('GET', 'HEAD'):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    def view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.url_name or match.func.__module__ + '.' + getattr(match.func, '__name__', 'view')
+
+
+class ReplicaPinMiddleware(object):
+    """
+    Pins a browser to the default database for a while after a request of
+    its writes anything, so views reading from a replica (see ems.routers)
+    still show the user their own changes. List it before the session
+    middleware so session saves count as writes.
+    """
+    def process_request(self, request):
+        routers.pop_write()
+
+    def process_response(self, request, response):
+        if routers.pop_write():
+            response.set_cookie(routers.PIN_COOKIE, '1', max_age=routers.replica_lag(), httponly=True)
+        return response
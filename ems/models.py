@@ -24,6 +24,8 @@ class Event(models.Model):
     staff_fee = models.DecimalField(max_digits=4, decimal_places=2, default=0)
     public_fee = models.DecimalField(max_digits=4, decimal_places=2, default=0)
     prepay = models.BooleanField(default=False)
+    # Number of Attendance rows, maintained by ems.registration
+    attendee_count = models.PositiveIntegerField(default=0)
 
     def start(self):
         return self.reservation.start_datetime
@@ -85,6 +87,9 @@ class Reservation(models.Model):
     def __unicode__(self):
         return self.event.name
 
+    class Meta:
+        index_together = (('status', 'start_datetime'), ('location', 'start_datetime'))
+
 class Approval(models.Model):
     approver = models.ForeignKey(User)
     reservation = models.OneToOneField(Reservation)
@@ -105,4 +110,140 @@ class Attendance(models.Model):
         return "No"
         
     def __unicode__(self):
-        return '%s - %s - %s' % (self.user.username, self.event, self.date_registered)
\ No newline at end of file
+        return '%s - %s - %s' % (self.user.username, self.event, self.date_registered)
+
+    class Meta:
+        unique_together = ('user', 'event')
+
+class DailyRollup(models.Model):
+    """
+    Pre-aggregated event and registration totals for one day, category,
+    location and reservation status. Kept up to date by the event views
+    and rebuilt from scratch with the rebuild_rollups command.
+    """
+    day = models.DateField()
+    category = models.ForeignKey(Category)
+    location = models.ForeignKey(Location)
+    status = models.CharField(max_length=30)
+    event_count = models.IntegerField(default=0)
+    registration_count = models.IntegerField(default=0)
+    prepaid_count = models.IntegerField(default=0)
+    student_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    staff_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    public_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    def __unicode__(self):
+        return '%s - %s - %s - %s' % (self.day, self.category, self.location, self.status)
+
+    class Meta:
+        unique_together = ('day', 'category', 'location', 'status')
+
+
+class SearchDocument(models.Model):
+    """
+    Searchable text for one event: its name, category, location and
+    description. Indexed natively on MySQL and PostgreSQL.
+    """
+    event = models.OneToOneField(Event, primary_key=True)
+    content = models.TextField()
+
+    def __unicode__(self):
+        return self.event.name
+
+
+class SearchToken(models.Model):
+    """
+    Inverted index entry used for searching on databases without native
+    full-text search. weight is higher for matches in the event name.
+    """
+    token = models.CharField(max_length=40)
+    event = models.ForeignKey(Event)
+    weight = models.PositiveIntegerField(default=1)
+
+    def __unicode__(self):
+        return '%s - %s' % (self.token, self.event_id)
+
+    class Meta:
+        index_together = (('token', 'event'),)
+
+
+
+class Job(models.Model):
+    """
+    A unit of background work run by the run_worker command (see ems.jobs).
+    payload holds the task's keyword arguments as JSON.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    task = models.CharField(max_length=100)
+    payload = models.TextField(default='{}')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField()
+    created = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Time spent in the task on the last attempt, in milliseconds
+    duration = models.FloatField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return '%s - %s - %s' % (self.task, self.status, self.created)
+
+    class Meta:
+        index_together = (('status', 'run_after'),)
+
+class Recurrence(models.Model):
+    """
+    Repeats a reservation, which is the first occurrence, by an iCalendar
+    RRULE (see ems.recurrence for the parts supported). Occurrences are
+    generated for the window asked for and never stored. last_end is the
+    end of the last occurrence, or null if the series never ends.
+    """
+    reservation = models.OneToOneField(Reservation, related_name='recurrence')
+    rule = models.CharField(max_length=255)
+    last_end = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s - %s' % (self.reservation, self.rule)
+
+
+class OccurrenceException(models.Model):
+    """
+    One occurrence of a recurring reservation, identified by the start the
+    rule gives it, that was cancelled or moved to other times
+    """
+    recurrence = models.ForeignKey(Recurrence, related_name='exceptions')
+    original_start = models.DateTimeField()
+    cancelled = models.BooleanField(default=False)
+    start_datetime = models.DateTimeField(null=True, blank=True)
+    end_datetime = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return '%s - %s' % (self.recurrence, self.original_start)
+
+    class Meta:
+        unique_together = ('recurrence', 'original_start')
+
+class UserKey(models.Model):
+    """
+    A user's username and email in lower case, indexed so the case
+    insensitive uniqueness checks of registration and provisioning are
+    index lookups (see ems.accounts). Kept up to date by the receivers in
+    ems.signals and rebuilt with the rebuild_user_keys command.
+    """
+    user = models.OneToOneField(User, primary_key=True, related_name='key')
+    username = models.CharField(max_length=30, unique=True)
+    email = models.CharField(max_length=75, db_index=True, blank=True)
+
+    def __unicode__(self):
+        return self.username
+
+# Connect the receivers that keep derived tables up to date
+from ems import signals
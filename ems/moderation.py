@@ -0,0 +1,105 @@
+"""
+Approval and denial of event reservations, one event or a whole batch at
+a time.
+
+A batch costs the same number of queries however many events it holds:
+the reservations are locked and read once, their status is changed with a
+single UPDATE and the Approval records are written with one bulk insert,
+all in one transaction. The creators' attendance rows and the emails
+follow in a background job.
+
+Denied reservations do not hold their location, so approving one checks
+it against the location's bookings first (see ems.booking); events whose
+slot has been taken meanwhile stay denied.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from ems.models import Event, Reservation, Attendance, Approval
+from ems import booking, caching, jobs, recurrence, rollups, status_const
+
+
+def moderate(event_ids, status, moderator):
+    """
+    Give the reservations of the given events a new status, recording
+    moderator as the approver of approved ones. Reservations that already
+    have the status are left alone, as are denied reservations whose
+    location is now booked at their time. Registering the creators of
+    approved events and emailing the creators are queued as a background
+    job. Returns the ids of the events changed.
+    """
+    with transaction.atomic():
+        reservations = list(Reservation.objects.select_for_update()
+                            .filter(event__in=list(event_ids)).exclude(status=status)
+                            .values('id', 'event', 'start_datetime', 'end_datetime', 'location', 'status', 'event__category',
+                                    'event__creator', 'event__student_fee', 'event__staff_fee', 'event__public_fee'))
+        if status != status_const.DENIED:
+            reservations = _bookable(reservations)
+        if not reservations:
+            return []
+        changed = [values['event'] for values in reservations]
+
+        rollups.restatus(reservations, status)
+        Reservation.objects.filter(id__in=[values['id'] for values in reservations]).update(status=status)
+        if status == status_const.APPROVED:
+            reservation_ids = [values['id'] for values in reservations]
+            Approval.objects.filter(reservation__in=reservation_ids).delete()
+            Approval.objects.bulk_create([Approval(approver=moderator, reservation_id=reservation_id, date=timezone.now())
+                                          for reservation_id in reservation_ids])
+        jobs.enqueue('moderation_followup', event_ids=changed, status=status)
+
+    # Bulk writes skip the receivers in ems.signals
+    caching.bump('event', *changed)
+    caching.bump('location', *set(values['location'] for values in reservations))
+    caching.bump('category', *set(values['event__category'] for values in reservations))
+    users = set(Attendance.objects.filter(event__in=changed).values_list('user', flat=True))
+    caching.bump('user', *users.union(values['event__creator'] for values in reservations))
+    return changed
+
+
+def _bookable(reservations):
+    """
+    The reservations without the denied ones that overlap an active
+    booking or each other. Locks the locations of the denied ones.
+    """
+    denied = [values for values in reservations if values['status'] == status_const.DENIED]
+    if not denied:
+        return reservations
+    series = recurrence.load([values['id'] for values in denied])
+    singles = [values for values in denied if values['id'] not in series]
+    slots = [(values['location'], values['start_datetime'], values['end_datetime']) for values in singles]
+    blocked = set(values['id'] for values, (event_ids, slot_indexes) in zip(singles, booking.check_slots(slots, lock=True))
+                  if event_ids or slot_indexes)
+    for values in denied:
+        if values['id'] in series:
+            try:
+                booking.ensure_series_available(values['location'], values['start_datetime'], values['end_datetime'],
+                                                series[values['id']][0], exclude_event=values['event'])
+            except booking.BookingConflict:
+                blocked.add(values['id'])
+    return [values for values in reservations if values['id'] not in blocked]
+
+
+def register_creators(event_ids):
+    """
+    Register the creator of each event to attend it, with a fixed number
+    of queries. Creators who are already attending are skipped. A creator
+    hosts their event, so they are registered even when it is full and
+    may take attendee_count past the location's capacity.
+    """
+    with transaction.atomic():
+        events = list(Event.objects.filter(id__in=event_ids))
+        attending = set(Attendance.objects.filter(event__in=event_ids, user__in=[event.creator_id for event in events])
+                                          .values_list('event', 'user'))
+        new = [event for event in events if (event.id, event.creator_id) not in attending]
+        if not new:
+            return
+        now = timezone.now()
+        Attendance.objects.bulk_create([Attendance(user_id=event.creator_id, event_id=event.id, date_registered=now)
+                                        for event in new])
+        Event.objects.filter(id__in=[event.id for event in new]).update(attendee_count=F('attendee_count') + 1)
+        reservations = Reservation.objects.filter(event__in=[event.id for event in new]).values(*rollups.RESERVATION_FIELDS)
+        rollups.add_registrations([(values, False) for values in reservations])
+    caching.bump('event', *[event.id for event in new])
+    caching.bump('user', *set(event.creator_id for event in new))
@@ -0,0 +1,60 @@
+"""
+Keyset (seek) pagination.
+
+Pages are fetched with WHERE (field, pk) > (last field value, last pk)
+instead of OFFSET, so every page costs one index range scan however deep
+into the table it is.
+"""
+from django.db.models import Q
+
+
+def keyset_filter(field, value, pk, descending=False):
+    """
+    Rows that come after (value, pk) when ordered by (field, pk)
+    """
+    op = 'lt' if descending else 'gt'
+    return Q(**{'%s__%s' % (field, op): value}) | Q(**{field: value, 'pk__%s' % op: pk})
+
+
+def keyset_page(queryset, field, descending=False, offset=0, length=25, after=None):
+    """
+    One page of queryset ordered by (field, pk).
+
+    after is the pk of the last row of the previous page when the caller
+    knows it. Otherwise the row just before offset is located with a
+    narrow values_list() query, which only has to walk the index, and the
+    page is read from there. An offset past the last row gives an empty
+    page.
+    """
+    prefix = '-' if descending else ''
+    ordered = queryset.order_by(prefix + field, prefix + 'pk')
+    boundary = None
+    if after is not None:
+        boundary = list(ordered.filter(pk=after).values_list(field, 'pk')[:1])
+    if not boundary and offset > 0:
+        boundary = list(ordered.values_list(field, 'pk')[offset - 1:offset])
+        if not boundary:
+            return []
+    if boundary:
+        value, pk = boundary[0]
+        ordered = ordered.filter(keyset_filter(field, value, pk, descending))
+    return list(ordered[:length])
+
+
+def chunked(queryset, chunk_size=1000, key=None):
+    """
+    Iterate over queryset in primary key order, chunk_size rows per query,
+    so that a large result is never held in memory at once (the database
+    drivers buffer whole results, even with QuerySet.iterator()). key reads
+    the pk from a row; the default suits model instances, pass one for
+    values_list() rows.
+    """
+    key = key or (lambda row: row.pk)
+    ordered = queryset.order_by('pk')
+    chunk = list(ordered[:chunk_size])
+    while chunk:
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        chunk = list(ordered.filter(pk__gt=key(chunk[-1]))[:chunk_size])
@@ -0,0 +1,379 @@
+"""
+Recurring reservations.
+
+A series is stored once, as its first Reservation plus a Recurrence
+holding an iCalendar RRULE. The supported subset is FREQ (DAILY, WEEKLY or
+MONTHLY), INTERVAL, BYDAY (weekly rules only), and COUNT or UNTIL.
+Occurrences keep the first one's wall clock time across DST changes.
+
+Occurrences are generated lazily for whatever window a view, feed or
+conflict check asks for, with the series' OccurrenceExceptions applied:
+cancelled occurrences are left out and moved ones take their new times.
+"""
+from calendar import monthrange
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import count as counter
+
+from django.db.models import Q
+from django.utils import timezone
+
+from ems.models import Recurrence, OccurrenceException
+
+FREQS = ('DAILY', 'WEEKLY', 'MONTHLY')
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+WEEKDAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+UNITS = {'DAILY': 'day', 'WEEKLY': 'week', 'MONTHLY': 'month'}
+
+Rule = namedtuple('Rule', 'freq interval byday count until')
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _until(value):
+    try:
+        if 'T' in value:
+            return timezone.make_aware(datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S'), timezone.utc)
+        moment = datetime.strptime(value, '%Y%m%d') + timedelta(days=1, microseconds=-1)
+        return timezone.make_aware(moment, timezone.get_current_timezone())
+    except ValueError:
+        raise RuleError("Invalid UNTIL %s" % value)
+
+
+def _positive(name, value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise RuleError("%s must be a positive number" % name)
+    return number
+
+
+def parse(rule):
+    """
+    A Rule from RRULE text, e.g. 'FREQ=WEEKLY;BYDAY=TU,TH;COUNT=10'.
+    byday holds weekday numbers (Monday is 0).
+    """
+    parts = {}
+    for part in rule.upper().replace('RRULE:', '').split(';'):
+        if not part:
+            continue
+        if '=' not in part:
+            raise RuleError("Invalid rule part %s" % part)
+        key, value = part.split('=', 1)
+        parts[key] = value
+    unsupported = set(parts) - set(('FREQ', 'INTERVAL', 'BYDAY', 'COUNT', 'UNTIL'))
+    if unsupported:
+        raise RuleError("Unsupported rule parts: %s" % ', '.join(sorted(unsupported)))
+    freq = parts.get('FREQ')
+    if freq not in FREQS:
+        raise RuleError("FREQ must be one of %s" % ', '.join(FREQS))
+    byday = []
+    if parts.get('BYDAY'):
+        if freq != 'WEEKLY':
+            raise RuleError("BYDAY is only supported for weekly rules")
+        for day in parts['BYDAY'].split(','):
+            if day not in WEEKDAYS:
+                raise RuleError("Invalid BYDAY %s" % day)
+            byday.append(WEEKDAYS.index(day))
+    if 'COUNT' in parts and 'UNTIL' in parts:
+        raise RuleError("A rule cannot have both COUNT and UNTIL")
+    return Rule(freq,
+                _positive('INTERVAL', parts['INTERVAL']) if 'INTERVAL' in parts else 1,
+                tuple(sorted(set(byday))),
+                _positive('COUNT', parts['COUNT']) if 'COUNT' in parts else None,
+                _until(parts['UNTIL']) if 'UNTIL' in parts else None)
+
+
+def build(freq, interval=1, byday=(), count=None, until=None):
+    """
+    RRULE text for a rule
+    """
+    parts = ['FREQ=%s' % freq]
+    if interval > 1:
+        parts.append('INTERVAL=%d' % interval)
+    if byday:
+        parts.append('BYDAY=%s' % ','.join(WEEKDAYS[day] for day in sorted(byday)))
+    if count:
+        parts.append('COUNT=%d' % count)
+    elif until:
+        parts.append('UNTIL=%s' % until.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+    return ';'.join(parts)
+
+
+def describe(rule):
+    """
+    The rule in words, e.g. 'Every 2 weeks on Tuesday, Thursday, 10 times'
+    """
+    unit = UNITS[rule.freq]
+    text = 'Every %s' % unit if rule.interval == 1 else 'Every %d %ss' % (rule.interval, unit)
+    if rule.byday:
+        text += ' on %s' % ', '.join(WEEKDAY_NAMES[day] for day in rule.byday)
+    if rule.count:
+        text += ', %d times' % rule.count
+    elif rule.until:
+        text += ' until %s' % timezone.localtime(rule.until).strftime('%b %d, %Y')
+    return text
+
+
+# ----------------------------- Expansion ------------------------------
+
+def _skip(first, rule, since):
+    """
+    (periods, occurrences) to pass over so that expansion resumes at most
+    one period before since: the intervals of the rule that can be skipped
+    and how many occurrences fall in them, so COUNT still ends the series
+    """
+    if since is None or since <= first:
+        return 0, 0
+    if rule.freq == 'DAILY':
+        periods = max((since - first).days // rule.interval - 1, 0)
+        return periods, periods
+    if rule.freq == 'WEEKLY':
+        days = rule.byday or (first.weekday(),)
+        week_start = first - timedelta(days=first.weekday())
+        periods = max((since - week_start).days // (7 * rule.interval) - 1, 0)
+        if not periods:
+            return 0, 0
+        first_week = len([day for day in days if week_start + timedelta(days=day) >= first])
+        return periods, first_week + (periods - 1) * len(days)
+    months = (since.year - first.year) * 12 + since.month - first.month
+    periods = max(months // rule.interval - 1, 0)
+    if first.day <= 28:
+        return periods, periods
+    found = 0
+    for n in range(periods):
+        month = first.month - 1 + n * rule.interval
+        if monthrange(first.year + month // 12, month % 12 + 1)[1] >= first.day:
+            found += 1
+    return periods, found
+
+
+def _naive_starts(first, rule, skip=0):
+    if rule.freq == 'DAILY':
+        for n in counter(skip):
+            yield first + timedelta(days=n * rule.interval)
+    elif rule.freq == 'WEEKLY':
+        days = rule.byday or (first.weekday(),)
+        week_start = first - timedelta(days=first.weekday())
+        for n in counter(skip):
+            week = week_start + timedelta(weeks=n * rule.interval)
+            for day in days:
+                candidate = week + timedelta(days=day)
+                if candidate >= first:
+                    yield candidate
+    else:
+        for n in counter(skip):
+            month = first.month - 1 + n * rule.interval
+            try:
+                yield first.replace(year=first.year + month // 12, month=month % 12 + 1)
+            except ValueError:
+                # Months without the day (e.g. the 31st) are skipped, as in RFC 5545
+                continue
+
+
+def _aware(naive, tz):
+    if hasattr(tz, 'localize'):
+        # Times skipped or repeated by a DST change resolve to standard time
+        return tz.normalize(tz.localize(naive, is_dst=False))
+    return naive.replace(tzinfo=tz)
+
+
+def starts(first_start, rule, since=None):
+    """
+    Yield the start of every occurrence in order, the first one included.
+    Series without COUNT or UNTIL never end, so stop reading in time.
+
+    Given since, the occurrences well before it are skipped by arithmetic
+    rather than walked, so that old series cost no more to expand than new
+    ones; the first start yielded may still be up to one period early.
+    """
+    tz = timezone.get_current_timezone()
+    first = timezone.localtime(first_start, tz).replace(tzinfo=None)
+    naive_since = timezone.localtime(since, tz).replace(tzinfo=None) if since is not None else None
+    skip, passed = _skip(first, rule, naive_since)
+    for number, naive in enumerate(_naive_starts(first, rule, skip), passed + 1):
+        start = _aware(naive, tz)
+        if rule.until is not None and start > rule.until:
+            return
+        yield start
+        if rule.count is not None and number >= rule.count:
+            return
+
+
+def last_end(first_start, first_end, rule):
+    """
+    End of the last occurrence, or None if the series never ends
+    """
+    if rule.count is None and rule.until is None:
+        return None
+    last = first_start
+    for last in starts(first_start, rule):
+        pass
+    return last + (first_end - first_start)
+
+
+class Occurrence(object):
+    """
+    One occurrence of a recurring reservation, with the attributes of a
+    Reservation that lists, feeds and conflict checks read
+    """
+    recurring = True
+
+    def __init__(self, reservation, start, end, original_start):
+        self.reservation = reservation
+        self.id = self.pk = reservation.id
+        self.event_id = reservation.event_id
+        self.location_id = reservation.location_id
+        self.status = reservation.status
+        self.start_datetime = start
+        self.end_datetime = end
+        self.original_start = original_start
+
+    @property
+    def event(self):
+        return self.reservation.event
+
+    @property
+    def location(self):
+        return self.reservation.location
+
+
+def occurrences(reservation, rule, exceptions, window_start, window_end):
+    """
+    Occurrences of a series overlapping [window_start, window_end), in
+    order. exceptions maps original starts to OccurrenceExceptions.
+    """
+    found = []
+    duration = reservation.end_datetime - reservation.start_datetime
+    for start in starts(reservation.start_datetime, rule, window_start - duration):
+        if start >= window_end:
+            break
+        if start + duration > window_start and start not in exceptions:
+            found.append(Occurrence(reservation, start, start + duration, start))
+    for exception in exceptions.values():
+        if exception.cancelled or exception.start_datetime is None:
+            continue
+        if exception.start_datetime < window_end and exception.end_datetime > window_start:
+            found.append(Occurrence(reservation, exception.start_datetime, exception.end_datetime,
+                                    exception.original_start))
+    found.sort(key=lambda occurrence: occurrence.start_datetime)
+    return found
+
+
+def load(reservation_ids):
+    """
+    {reservation id: (Rule, exceptions)} for the recurring reservations
+    among the given ids (a list or a values('id') queryset). Two queries.
+    """
+    series = dict((recurrence.id, recurrence) for recurrence in Recurrence.objects.filter(reservation__in=reservation_ids))
+    exceptions = defaultdict(dict)
+    if series:
+        for exception in OccurrenceException.objects.filter(recurrence__in=list(series)):
+            exceptions[exception.recurrence_id][exception.original_start] = exception
+    return dict((recurrence.reservation_id, (parse(recurrence.rule), exceptions[recurrence.id]))
+                for recurrence in series.values())
+
+
+def singles(reservations):
+    """
+    The reservations that do not repeat
+    """
+    return reservations.filter(recurrence__isnull=True)
+
+
+def series_in_window(reservations, window_start, window_end):
+    """
+    The recurring reservations that may have occurrences in the window
+    """
+    return reservations.filter(recurrence__isnull=False, start_datetime__lt=window_end) \
+                       .filter(Q(recurrence__last_end__isnull=True) | Q(recurrence__last_end__gt=window_start))
+
+
+def expand(reservations, window_start, window_end):
+    """
+    The occurrences of the given recurring reservations in the window,
+    ordered by start
+    """
+    rows = list(reservations)
+    series = load([reservation.id for reservation in rows]) if rows else {}
+    found = []
+    for reservation in rows:
+        if reservation.id in series:
+            rule, exceptions = series[reservation.id]
+            found.extend(occurrences(reservation, rule, exceptions, window_start, window_end))
+    found.sort(key=lambda occurrence: (occurrence.start_datetime, occurrence.id))
+    return found
+
+
+def next_occurrence(reservation, rule, exceptions, after, horizon=timedelta(days=400)):
+    """
+    The first occurrence ending after the given time, or None
+    """
+    found = occurrences(reservation, rule, exceptions, after, after + horizon)
+    return found[0] if found else None
+
+
+# ----------------------------- Exceptions -----------------------------
+
+def _exception(recurrence, original_start):
+    exception, created = OccurrenceException.objects.get_or_create(recurrence=recurrence, original_start=original_start)
+    return exception
+
+
+def is_occurrence(recurrence, original_start):
+    """
+    Whether the series' rule gives an occurrence that start
+    """
+    rule = parse(recurrence.rule)
+    for start in starts(recurrence.reservation.start_datetime, rule, original_start):
+        if start >= original_start:
+            return start == original_start
+    return False
+
+
+def cancel(recurrence, original_start):
+    """
+    Cancel one occurrence of a series
+    """
+    exception = _exception(recurrence, original_start)
+    exception.cancelled = True
+    exception.save()
+    return exception
+
+
+def shift(recurrence, old_first_start, new_first_start):
+    """
+    Keep a series' exceptions on their occurrences after its first start
+    moves: each original start is moved by the same wall clock difference.
+    Moved occurrences keep the times they were given.
+    """
+    tz = timezone.get_current_timezone()
+    delta = (timezone.localtime(new_first_start, tz).replace(tzinfo=None) -
+             timezone.localtime(old_first_start, tz).replace(tzinfo=None))
+    if not delta:
+        return
+    # Latest first when moving later (earliest first otherwise), so no two
+    # exceptions share an original start on the way
+    exceptions = recurrence.exceptions.order_by('-original_start' if delta > timedelta(0) else 'original_start')
+    for exception in exceptions:
+        naive = timezone.localtime(exception.original_start, tz).replace(tzinfo=None)
+        exception.original_start = _aware(naive + delta, tz)
+        exception.save(update_fields=['original_start'])
+
+
+def move(recurrence, original_start, start, end):
+    """
+    Give one occurrence of a series other times. Check the new times with
+    ems.booking first.
+    """
+    exception = _exception(recurrence, original_start)
+    exception.cancelled = False
+    exception.start_datetime, exception.end_datetime = start, end
+    exception.save()
+    if recurrence.last_end is not None and end > recurrence.last_end:
+        Recurrence.objects.filter(pk=recurrence.pk).update(last_end=end)
+    return exception
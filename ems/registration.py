@@ -0,0 +1,88 @@
+"""
+Event registration.
+
+A seat is claimed with a single conditional UPDATE of Event.attendee_count
+(only succeeding while the count is below the location's capacity) and the
+Attendance row is inserted in the same transaction. The unique (user, event)
+constraint rejects duplicate registrations, which rolls the seat back.
+The registration is counted in the rollups in the same transaction, from
+the reservation row read for the capacity check rather than a count of the
+attendance; only the confirmation email is left to a background job.
+"""
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from ems.models import Event, Reservation, Attendance
+from ems import jobs, rollups
+
+
+class RegistrationError(Exception):
+    pass
+
+
+class AlreadyRegistered(RegistrationError):
+    pass
+
+
+class EventFull(RegistrationError):
+    pass
+
+
+def seats_left(event, event_capacity):
+    """
+    Number of open seats, or None if the location has no capacity limit
+    """
+    if not event_capacity:
+        return None
+    return max(event_capacity - event.attendee_count, 0)
+
+
+def recount():
+    """
+    Set every event's attendee_count from its Attendance rows, with one
+    UPDATE. Returns the number of events updated.
+    """
+    qn = connection.ops.quote_name
+    event_table, attendance_table = qn(Event._meta.db_table), qn(Attendance._meta.db_table)
+    cursor = connection.cursor()
+    with transaction.atomic():
+        cursor.execute('UPDATE %s SET %s = (SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s)' % (
+            event_table, qn('attendee_count'), attendance_table,
+            attendance_table, qn(Attendance._meta.get_field('event').column), event_table, qn('id')))
+    return cursor.rowcount
+
+
+def register(user, event, prepaid=False):
+    """
+    Register user to attend event and return the new Attendance.
+
+    Raises EventFull if every seat is taken and AlreadyRegistered if the
+    user is already attending.
+    """
+    reservation_values = Reservation.objects.filter(event=event.id) \
+                                            .values('location__capacity', *rollups.RESERVATION_FIELDS).first()
+    # A capacity of 0 means unlimited
+    event_capacity = reservation_values['location__capacity'] if reservation_values else 0
+    with transaction.atomic():
+        seats = Event.objects.filter(pk=event.id)
+        if event_capacity:
+            seats = seats.filter(attendee_count__lt=event_capacity)
+        if not seats.update(attendee_count=F('attendee_count') + 1):
+            raise EventFull("%s is full." % event)
+        try:
+            with transaction.atomic():
+                attendance = Attendance.objects.create(user=user,
+                                                       event=event,
+                                                       prepaid=prepaid,
+                                                       date_registered=timezone.now())
+        except IntegrityError:
+            # Leaving the outer block with an exception gives the seat back
+            raise AlreadyRegistered("%s is already attending %s." % (user, event))
+        # The rollups count the registration with the Attendance row, so
+        # snapshots taken before the confirmation is sent include it
+        if reservation_values is not None:
+            rollups.add_registrations([(reservation_values, prepaid)])
+        jobs.enqueue('registration_followup', event_id=event.id, user_id=user.id, prepaid=prepaid)
+    event.attendee_count += 1
+    return attendance
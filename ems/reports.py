@@ -0,0 +1,172 @@
+"""
+Aggregate queries used by the summary report.
+
+Every figure on the report is read with a fixed number of grouped queries,
+no matter how many categories, events or attendees fall inside the range.
+Whole days come from the DailyRollup table. Days that the range or a week
+boundary cuts through part way are read from the reservations starting in
+them, so the report counts exactly the events starting in [start, end).
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from ems.models import Attendance, Category, DailyRollup, Reservation
+from ems.rollups import rollup_day
+from ems import status_const
+
+# Longest range the report will break down (roughly one year)
+MAX_REPORT_WEEKS = 53
+
+
+def week_ranges(start, end):
+    """
+    Split [start, end) into consecutive 7 day ranges. The last range is
+    clipped to end.
+    """
+    weeks = []
+    week_start = start
+    while week_start < end:
+        week_end = min(week_start + timedelta(days=7), end)
+        weeks.append((week_start, week_end))
+        week_start = week_end
+    return weeks
+
+
+def _blank_stats(category_names):
+    return {
+        'total_event_count': 0,
+        'approved_event_count': 0,
+        'attendance_count': 0,
+        'revenue': Decimal('0.00'),
+        'revenue_by_tier': {'student': Decimal('0.00'), 'staff': Decimal('0.00'), 'public': Decimal('0.00')},
+        'category_counts': dict((name, [0, 0]) for name in category_names),
+    }
+
+
+def _category_payment_data(stats):
+    """
+    Turn the raw per category counts into (registered, prepaid, percent prepaid)
+    """
+    data = {}
+    for name, (registered, prepaid) in stats.pop('category_counts').items():
+        percent_prepaid = 0
+        if registered != 0:
+            percent_prepaid = prepaid / float(registered) * 100
+        data[name] = (registered, prepaid, percent_prepaid)
+    stats['category_payment_data'] = data
+    return stats
+
+
+def day_start(day):
+    """
+    The moment a day starts in the site's time zone
+    """
+    tz = timezone.get_current_timezone()
+    naive = datetime.combine(day, time())
+    if hasattr(tz, 'localize'):
+        return tz.normalize(tz.localize(naive, is_dst=False))
+    return naive.replace(tzinfo=tz)
+
+
+def _week_index(moment, start, week_count):
+    return min(int((moment - start).total_seconds() // timedelta(days=7).total_seconds()), week_count - 1)
+
+
+def _add_row(stats, name, row):
+    stats['total_event_count'] += row['events']
+    if row['status'] == status_const.APPROVED:
+        stats['approved_event_count'] += row['events']
+    stats['attendance_count'] += row['registrations']
+    for tier in ('student', 'staff', 'public'):
+        stats['revenue_by_tier'][tier] += row['%s_revenue' % tier] or 0
+    counts = stats['category_counts'].setdefault(name, [0, 0])
+    counts[0] += row['registrations']
+    counts[1] += row['prepaid']
+
+
+def _partial_rows(start, end, days):
+    """
+    Yield (start datetime, row) for each reservation starting in [start,
+    end) on one of the given days, with the figures a rollup row holds
+    """
+    in_days = Q()
+    for day in days:
+        in_days |= Q(start_datetime__gte=day_start(day), start_datetime__lt=day_start(day + timedelta(days=1)))
+    reservations = Reservation.objects.filter(in_days, start_datetime__gte=start, start_datetime__lt=end)
+    values = list(reservations.values('event', 'start_datetime', 'status', 'event__category',
+                                      'event__student_fee', 'event__staff_fee', 'event__public_fee').order_by())
+    if not values:
+        return
+    registrations, prepaid = {}, {}
+    for event_id, is_prepaid, count in Attendance.objects.filter(event__reservation__in=reservations) \
+                                                 .values_list('event', 'prepaid').annotate(Count('id')).order_by():
+        registrations[event_id] = registrations.get(event_id, 0) + count
+        if is_prepaid:
+            prepaid[event_id] = prepaid.get(event_id, 0) + count
+    for reservation in values:
+        count = registrations.get(reservation['event'], 0)
+        yield reservation['start_datetime'], {
+            'category': reservation['event__category'],
+            'status': reservation['status'],
+            'events': 1,
+            'registrations': count,
+            'prepaid': prepaid.get(reservation['event'], 0),
+            'student_revenue': reservation['event__student_fee'] * count,
+            'staff_revenue': reservation['event__staff_fee'] * count,
+            'public_revenue': reservation['event__public_fee'] * count,
+        }
+
+
+def summary_data(start, end):
+    """
+    Event, attendance and revenue totals for [start, end), overall and per week.
+
+    Runs at most four queries: the category names, the rollup rows of the
+    whole days summed per day, category and status, and the reservations
+    and attendance counts of the days cut part way.
+    """
+    weeks = week_ranges(start, end)
+
+    category_names = dict(Category.objects.values_list('id', 'name'))
+    totals = _blank_stats(category_names.values())
+    weekly = [_blank_stats(category_names.values()) for week in weeks]
+
+    # Days that a week boundary (the range's start and end included) does
+    # not fall on the start of
+    partial_days = set(rollup_day(moment) for moment in [start] + [week_end for week_start, week_end in weeks]
+                       if day_start(rollup_day(moment)) != moment)
+
+    rows = DailyRollup.objects.filter(day__gte=rollup_day(start), day__lt=rollup_day(end)) \
+                .exclude(day__in=partial_days) \
+                .values('day', 'category', 'status') \
+                .annotate(events=Sum('event_count'),
+                          registrations=Sum('registration_count'),
+                          prepaid=Sum('prepaid_count'),
+                          student_revenue=Sum('student_revenue'),
+                          staff_revenue=Sum('staff_revenue'),
+                          public_revenue=Sum('public_revenue')).order_by()
+    dated_rows = [(day_start(row['day']), row) for row in rows]
+    if partial_days:
+        dated_rows.extend(_partial_rows(start, end, sorted(partial_days)))
+    for moment, row in dated_rows:
+        name = category_names.get(row['category'])
+        for stats in (totals, weekly[_week_index(moment, start, len(weekly))]):
+            _add_row(stats, name, row)
+
+    # Attendance does not record which fee an attendee paid, so overall
+    # revenue is reported at the student rate as it always has been.
+    for stats in [totals] + weekly:
+        stats['revenue'] = stats['revenue_by_tier']['student']
+        _category_payment_data(stats)
+
+    for (week_start, week_end), stats in zip(weeks, weekly):
+        stats['week_start'] = week_start
+        stats['week_end'] = week_end
+
+    totals['start_datetime'] = start
+    totals['end_datetime'] = end
+    totals['weekly_data'] = weekly
+    return totals
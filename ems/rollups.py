@@ -0,0 +1,248 @@
+"""
+Maintenance of the DailyRollup reporting table.
+
+Each event contributes one event to the rollup row for its (day, category,
+location, status), plus its registrations and the revenue they bring in.
+The views take a snapshot of that contribution before and after they change
+an event, and the difference is applied with F() updates so concurrent
+requests never overwrite each other's counts. Batches of events (imports,
+moderation) apply the totals of all their rows with a fixed number of
+queries, see _apply_many.
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from ems.models import Reservation, Attendance, DailyRollup
+
+COUNTERS = ('event_count', 'registration_count', 'prepaid_count',
+            'student_revenue', 'staff_revenue', 'public_revenue')
+
+# The reservation values an event's contribution is worked out from
+RESERVATION_FIELDS = ('start_datetime', 'location', 'status', 'event__category',
+                      'event__student_fee', 'event__staff_fee', 'event__public_fee')
+
+
+def rollup_day(start_datetime):
+    """
+    The day a reservation is reported under, in the site's time zone
+    """
+    if timezone.is_aware(start_datetime):
+        start_datetime = timezone.localtime(start_datetime)
+    return start_datetime.date()
+
+
+def _contribution(reservation_values, registrations, prepaid):
+    key = (rollup_day(reservation_values['start_datetime']),
+           reservation_values['event__category'],
+           reservation_values['location'],
+           reservation_values['status'])
+    deltas = {
+        'event_count': 1,
+        'registration_count': registrations,
+        'prepaid_count': prepaid,
+        'student_revenue': reservation_values['event__student_fee'] * registrations,
+        'staff_revenue': reservation_values['event__staff_fee'] * registrations,
+        'public_revenue': reservation_values['event__public_fee'] * registrations,
+    }
+    return key, deltas
+
+
+def snapshot(event):
+    """
+    The rollup key and counter values that an event currently contributes,
+    or None if the event has no reservation yet.
+    """
+    reservation_values = Reservation.objects.filter(event=event.id).values(*RESERVATION_FIELDS)
+    if not reservation_values:
+        return None
+    counts = dict(Attendance.objects.filter(event=event.id).values_list('prepaid').annotate(Count('id')).order_by())
+    registrations = counts.get(True, 0) + counts.get(False, 0)
+    return _contribution(reservation_values[0], registrations, counts.get(True, 0))
+
+
+def _apply(key, deltas, sign):
+    deltas = dict((field, value * sign) for field, value in deltas.items() if value)
+    if not deltas:
+        return
+    day, category_id, location_id, status = key
+    rows = DailyRollup.objects.filter(day=day, category=category_id, location=location_id, status=status)
+    updates = dict((field, F(field) + value) for field, value in deltas.items())
+    if rows.update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            DailyRollup.objects.create(day=day, category_id=category_id, location_id=location_id,
+                                       status=status, **deltas)
+    except IntegrityError:
+        # Another request created the row first
+        rows.update(**updates)
+
+
+def _apply_many(totals):
+    """
+    Add {key: deltas} to the rollup rows with one locking SELECT, one
+    UPDATE of every existing row and one bulk insert of the missing ones
+    """
+    totals = dict((key, deltas) for key, deltas in totals.items() if any(deltas.values()))
+    if not totals:
+        return
+    with transaction.atomic():
+        rows = DailyRollup.objects.select_for_update().filter(
+            day__in=set(key[0] for key in totals), category__in=set(key[1] for key in totals),
+            location__in=set(key[2] for key in totals), status__in=set(key[3] for key in totals))
+        existing = dict(((day, category_id, location_id, status), pk) for pk, day, category_id, location_id, status
+                        in rows.values_list('pk', 'day', 'category', 'location', 'status'))
+        found = [(existing[key], deltas) for key, deltas in totals.items() if key in existing]
+        if found:
+            # One CASE per counter adds each row's own delta
+            qn = connection.ops.quote_name
+            assignments = []
+            params = []
+            for field in COUNTERS:
+                cases = []
+                for pk, deltas in found:
+                    cases.append('WHEN %s THEN %s')
+                    params.extend([pk, deltas.get(field, 0)])
+                assignments.append('%s = %s + CASE %s %s END' % (qn(field), qn(field), qn('id'), ' '.join(cases)))
+            params.extend(pk for pk, deltas in found)
+            connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+                qn(DailyRollup._meta.db_table), ', '.join(assignments), qn('id'), ', '.join(['%s'] * len(found))), params)
+        missing = [(key, deltas) for key, deltas in totals.items() if key not in existing]
+        if not missing:
+            return
+        try:
+            with transaction.atomic():
+                DailyRollup.objects.bulk_create([DailyRollup(day=key[0], category_id=key[1], location_id=key[2],
+                                                             status=key[3], **deltas) for key, deltas in missing])
+        except IntegrityError:
+            # Another request created some of the rows first
+            for key, deltas in missing:
+                _apply(key, deltas, 1)
+
+
+def add(contribution):
+    if contribution is not None:
+        _apply(contribution[0], contribution[1], 1)
+
+
+def remove(contribution):
+    if contribution is not None:
+        _apply(contribution[0], contribution[1], -1)
+
+
+def replace(before, after):
+    """
+    Move an event's contribution from its old snapshot to its new one
+    """
+    if before == after:
+        return
+    remove(before)
+    add(after)
+
+
+def add_reservations(reservations):
+    """
+    Add the contributions of newly created reservations whose events have
+    no registrations yet, with a fixed number of queries however many
+    there are. Each reservation's event must be set on it.
+    """
+    totals = defaultdict(lambda: dict((field, 0) for field in COUNTERS))
+    for reservation in reservations:
+        key, deltas = _contribution({
+            'start_datetime': reservation.start_datetime,
+            'location': reservation.location_id,
+            'status': reservation.status,
+            'event__category': reservation.event.category_id,
+            'event__student_fee': reservation.event.student_fee,
+            'event__staff_fee': reservation.event.staff_fee,
+            'event__public_fee': reservation.event.public_fee,
+        }, 0, 0)
+        for field, value in deltas.items():
+            totals[key][field] += value
+    _apply_many(totals)
+
+
+def restatus(reservation_values, status):
+    """
+    Move the contributions of several reservations to a new status. Each
+    dict in reservation_values holds 'event' and RESERVATION_FIELDS. The
+    changes are applied with a fixed number of queries.
+    """
+    event_ids = [values['event'] for values in reservation_values]
+    registrations = defaultdict(int)
+    prepaid = defaultdict(int)
+    counts = Attendance.objects.filter(event__in=event_ids).values_list('event', 'prepaid').annotate(Count('id')).order_by()
+    for event_id, is_prepaid, count in counts:
+        registrations[event_id] += count
+        if is_prepaid:
+            prepaid[event_id] += count
+
+    totals = defaultdict(lambda: dict((field, 0) for field in COUNTERS))
+    for values in reservation_values:
+        event_id = values['event']
+        key, deltas = _contribution(values, registrations[event_id], prepaid[event_id])
+        for field, value in deltas.items():
+            totals[key][field] -= value
+        key, deltas = _contribution(dict(values, status=status), registrations[event_id], prepaid[event_id])
+        for field, value in deltas.items():
+            totals[key][field] += value
+    _apply_many(totals)
+
+
+def add_registrations(registrations):
+    """
+    Count new registrations, given as (reservation values, prepaid) pairs
+    whose values hold RESERVATION_FIELDS. Nothing is counted from the
+    attendance table: one registration costs one UPDATE, and a batch a
+    fixed number of queries.
+    """
+    totals = defaultdict(lambda: dict((field, 0) for field in COUNTERS))
+    for reservation_values, prepaid in registrations:
+        key, deltas = _contribution(reservation_values, 1, 1 if prepaid else 0)
+        deltas['event_count'] = 0
+        for field, value in deltas.items():
+            totals[key][field] += value
+    if len(totals) == 1:
+        key, deltas = totals.popitem()
+        _apply(key, deltas, 1)
+    else:
+        _apply_many(totals)
+
+
+def rebuild():
+    """
+    Recompute every rollup row from the reservation and attendance tables.
+    Returns the number of rows written.
+    """
+    registrations = dict(Attendance.objects.values_list('event').annotate(Count('id')).order_by())
+    prepaid = dict(Attendance.objects.filter(prepaid=True).values_list('event').annotate(Count('id')).order_by())
+
+    totals = defaultdict(lambda: dict((field, 0) for field in COUNTERS))
+    reservations = Reservation.objects.values(
+        'event', 'start_datetime', 'location', 'status', 'event__category',
+        'event__student_fee', 'event__staff_fee', 'event__public_fee').order_by()
+    for reservation_values in reservations.iterator():
+        event_id = reservation_values['event']
+        key, deltas = _contribution(reservation_values, registrations.get(event_id, 0), prepaid.get(event_id, 0))
+        row = totals[key]
+        for field, value in deltas.items():
+            row[field] += value
+
+    rollups = []
+    for (day, category_id, location_id, status), row in totals.items():
+        rollups.append(DailyRollup(day=day, category_id=category_id, location_id=location_id,
+                                   status=status, **row))
+    with transaction.atomic():
+        DailyRollup.objects.all().delete()
+        DailyRollup.objects.bulk_create(rollups, batch_size=500)
+    return len(rollups)
+
+
+def event_total(status):
+    """
+    Number of events with the given reservation status
+    """
+    return DailyRollup.objects.filter(status=status).aggregate(total=Sum('event_count'))['total'] or 0
@@ -0,0 +1,52 @@
+"""
+Attendance rosters: a page at a time for the event details page, and in
+full, in constant memory, for downloads.
+"""
+from django.conf import settings
+from django.utils import timezone
+
+from ems.models import Attendance
+from ems.paging import chunked, keyset_page
+
+# Attendees shown per page of the event details roster
+PAGE_SIZE = getattr(settings, 'EMS_ROSTER_PAGE_SIZE', 50)
+
+HEADER = ('Event', 'Start', 'Username', 'First name', 'Last name', 'Email', 'Registered', 'Prepaid')
+
+# Columns read for each downloaded row; the id is only used for chunking
+_FIELDS = ('id', 'event__name', 'event__reservation__start_datetime', 'user__username', 'user__first_name',
+           'user__last_name', 'user__email', 'date_registered', 'prepaid')
+
+
+def page(attendance, number):
+    """
+    One page of attendance, in registration order, as (rows, has_next_page)
+    """
+    rows = keyset_page(attendance, 'date_registered', offset=(number - 1) * PAGE_SIZE, length=PAGE_SIZE + 1)
+    return rows[:PAGE_SIZE], len(rows) > PAGE_SIZE
+
+
+def rows(attendance, chunk_size=1000):
+    """
+    Yield a download row for every attendance row, reading the users and
+    events with each chunk rather than one by one
+    """
+    for values in chunked(attendance.values_list(*_FIELDS), chunk_size, key=lambda values: values[0]):
+        values = list(values[1:])
+        for index in (1, 6):
+            if values[index] is not None:
+                values[index] = timezone.localtime(values[index])
+        values[7] = 'Yes' if values[7] else 'No'
+        yield values
+
+
+def for_event(event_id):
+    return Attendance.objects.filter(event=event_id)
+
+
+def for_range(start, end):
+    """
+    Attendance of every event starting in [start, end)
+    """
+    return Attendance.objects.filter(event__reservation__start_datetime__gte=start,
+                                     event__reservation__start_datetime__lt=end)
@@ -0,0 +1,115 @@
+"""
+Database routing for read replicas.
+
+Views decorated with @use_replica (or code inside a replica_reads block)
+read the ems tables from one of the aliases listed in EMS_READ_REPLICAS; everything else, and every write,
+uses the default database. Sessions and users are always read from the
+default database so a fresh login is never lost to replication lag.
+
+A browser that has just written something is pinned to the default
+database for EMS_REPLICA_LAG seconds (with a cookie set by
+ReplicaPinMiddleware), so users always read their own writes.
+"""
+import random
+import threading
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Cookie marking a browser that has recently written to the default database
+PIN_COOKIE = 'ems_primary'
+
+_state = threading.local()
+
+
+def replicas():
+    return list(getattr(settings, 'EMS_READ_REPLICAS', ()))
+
+
+def replica_lag():
+    """
+    Seconds a browser keeps reading from the default database after a write
+    """
+    return getattr(settings, 'EMS_REPLICA_LAG', 10)
+
+
+def is_pinned(request):
+    return PIN_COOKIE in request.COOKIES
+
+
+def read_alias():
+    """
+    Alias the current thread reads the ems tables from
+    """
+    return getattr(_state, 'alias', None) or DEFAULT_DB_ALIAS
+
+
+class replica_reads(object):
+    """
+    Context manager sending the ems reads made inside it to a replica,
+    unless the request is pinned to the default database
+    """
+    def __init__(self, request):
+        self.request = request
+
+    def __enter__(self):
+        self.previous = getattr(_state, 'alias', None)
+        aliases = replicas()
+        if aliases and not is_pinned(self.request):
+            _state.alias = random.choice(aliases)
+        return read_alias()
+
+    def __exit__(self, *exc_info):
+        _state.alias = self.previous
+
+
+def use_replica(view):
+    """
+    Decorator for read-only views that may read from a replica
+    """
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        with replica_reads(request):
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+def mark_write():
+    _state.wrote = True
+
+
+def pop_write():
+    """
+    Whether the thread wrote to the database since the last call
+    """
+    wrote = getattr(_state, 'wrote', False)
+    _state.wrote = False
+    return wrote
+
+
+class ReplicaRouter(object):
+    """
+    Listed in DATABASE_ROUTERS. Replicas get their tables from replication,
+    so syncdb never touches them.
+    """
+    def db_for_read(self, model, **hints):
+        alias = getattr(_state, 'alias', None)
+        if alias and model._meta.app_label == 'ems':
+            return alias
+        return None
+
+    def db_for_write(self, model, **hints):
+        mark_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = [DEFAULT_DB_ALIAS] + replicas()
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in replicas():
+            return False
+        return None
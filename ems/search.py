@@ -0,0 +1,164 @@
+"""
+Event search index.
+
+Every event has a SearchDocument holding its name, category, location and
+description. MySQL and PostgreSQL search that text with their native
+full-text indexes; other databases (SQLite) fall back to the SearchToken
+inverted index maintained here. Both are updated incrementally by the
+receivers in ems.signals.
+"""
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+
+from ems.models import Event, SearchDocument, SearchToken
+from ems import status_const
+
+# Most results a single search returns
+SEARCH_LIMIT = getattr(settings, 'EMS_SEARCH_LIMIT', 200)
+RESULTS_PER_PAGE = getattr(settings, 'EMS_SEARCH_RESULTS_PER_PAGE', 25)
+
+# Token weight per field for the inverted index
+FIELD_WEIGHTS = (('name', 4), ('category', 2), ('location', 2), ('description', 1))
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKEN_LENGTH = SearchToken._meta.get_field('token').max_length
+
+FULLTEXT_INDEX_NAME = 'ems_searchdocument_fts'
+
+
+def native_backend():
+    """
+    Name of the native full-text implementation to use, or None to use the
+    inverted index
+    """
+    if connection.vendor in ('mysql', 'postgresql'):
+        return connection.vendor
+    return None
+
+
+def tokenize(text):
+    """
+    Lower case word tokens of at least two characters
+    """
+    return [token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(text.lower()) if len(token) > 1]
+
+
+def _event_fields(event_ids):
+    """
+    The text of every indexed field for the given events, in one query
+    """
+    rows = Event.objects.filter(id__in=event_ids).values_list(
+        'id', 'name', 'category__name', 'reservation__location__name', 'description')
+    for event_id, name, category, location, description in rows:
+        yield event_id, {'name': name, 'category': category or '',
+                         'location': location or '', 'description': description}
+
+
+def index_events(event_ids):
+    """
+    (Re)build the search document and tokens for the given events
+    """
+    event_ids = list(event_ids)
+    if not event_ids:
+        return
+    documents = []
+    tokens = []
+    for event_id, fields in _event_fields(event_ids):
+        documents.append(SearchDocument(event_id=event_id,
+                                        content=' '.join(fields[field] for field, weight in FIELD_WEIGHTS)))
+        if native_backend() is None:
+            weights = defaultdict(int)
+            for field, weight in FIELD_WEIGHTS:
+                for token in tokenize(fields[field]):
+                    weights[token] += weight
+            tokens.extend(SearchToken(event_id=event_id, token=token, weight=weight)
+                          for token, weight in weights.items())
+    with transaction.atomic():
+        unindex_events(event_ids)
+        SearchDocument.objects.bulk_create(documents)
+        SearchToken.objects.bulk_create(tokens, batch_size=500)
+
+
+def unindex_events(event_ids):
+    SearchToken.objects.filter(event__in=event_ids).delete()
+    SearchDocument.objects.filter(event__in=event_ids).delete()
+
+
+def rebuild(chunk_size=500):
+    """
+    Reindex every event. Returns the number of events indexed.
+    """
+    SearchToken.objects.all().delete()
+    SearchDocument.objects.all().delete()
+    event_ids = list(Event.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(event_ids), chunk_size):
+        index_events(event_ids[start:start + chunk_size])
+    return len(event_ids)
+
+
+def create_native_index():
+    """
+    Create the full-text index on the search documents if the database
+    supports one. Returns True if an index was created.
+    """
+    backend = native_backend()
+    qn = connection.ops.quote_name
+    table = qn(SearchDocument._meta.db_table)
+    cursor = connection.cursor()
+    if backend == 'mysql':
+        cursor.execute("SELECT COUNT(*) FROM information_schema.statistics "
+                       "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s",
+                       [SearchDocument._meta.db_table, FULLTEXT_INDEX_NAME])
+        if cursor.fetchone()[0]:
+            return False
+        cursor.execute("ALTER TABLE %s ADD FULLTEXT INDEX %s (content)" % (table, qn(FULLTEXT_INDEX_NAME)))
+        return True
+    if backend == 'postgresql':
+        cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING gin(to_tsvector('english', content))"
+                       % (qn(FULLTEXT_INDEX_NAME), table))
+        return True
+    return False
+
+
+def _native_search(term, limit):
+    qn = connection.ops.quote_name
+    content = '%s.%s' % (qn(SearchDocument._meta.db_table), qn('content'))
+    if native_backend() == 'mysql':
+        match = 'MATCH(%s) AGAINST (%%s IN NATURAL LANGUAGE MODE)' % content
+        score, where = match, match
+    else:
+        vector = "to_tsvector('english', %s)" % content
+        query = "plainto_tsquery('english', %s)"
+        score = 'ts_rank(%s, %s)' % (vector, query)
+        where = '%s @@ %s' % (vector, query)
+    documents = SearchDocument.objects.filter(event__reservation__status=status_const.APPROVED) \
+                    .extra(select={'score': score}, select_params=[term], where=[where], params=[term]) \
+                    .order_by('-score', 'event')
+    return [event_id for event_id, score in documents.values_list('event', 'score')[:limit]]
+
+
+def _token_search(term, limit):
+    tokens = tokenize(term)
+    if not tokens:
+        return []
+    # The last word may still be being typed, so it also matches as a prefix
+    matches = Q(token__in=tokens) | Q(token__startswith=tokens[-1])
+    rows = SearchToken.objects.filter(matches, event__reservation__status=status_const.APPROVED) \
+                .values('event').annotate(score=Sum('weight')).order_by('-score', 'event')
+    return [row['event'] for row in rows[:limit]]
+
+
+def search(term, limit=SEARCH_LIMIT):
+    """
+    Ids of approved events matching the search term, best match first
+    """
+    term = term.strip()
+    if not term:
+        return []
+    if native_backend() is not None:
+        return _native_search(term, limit)
+    return _token_search(term, limit)
@@ -0,0 +1,173 @@
+"""
+Signal receivers that keep derived data in step with the models they are
+built from. Imported at the bottom of ems.models so they are always
+connected.
+"""
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.contrib.auth.models import User
+from django.dispatch import receiver
+
+from ems.models import Event, Reservation, Attendance, Location, Category, Recurrence, OccurrenceException
+from ems import accounts, caching, search
+
+
+@receiver(post_save, sender=Event)
+def index_saved_event(sender, instance, **kwargs):
+    search.index_events([instance.id])
+
+
+@receiver(post_save, sender=Reservation)
+def index_reserved_event(sender, instance, **kwargs):
+    search.index_events([instance.event_id])
+
+
+@receiver(post_save, sender=Location)
+def reindex_location_events(sender, instance, created, **kwargs):
+    if not created:
+        search.index_events(Reservation.objects.filter(location=instance.id).values_list('event', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_events(sender, instance, created, **kwargs):
+    if not created:
+        search.index_events(Event.objects.filter(category=instance.id).values_list('id', flat=True))
+
+
+# ----------------------- Cache versions --------------------------
+# Cached pages are keyed on the versions in ems.caching; bump the version
+# of every event and location whose page shows the changed row.
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def bump_event(sender, instance, **kwargs):
+    caching.bump('event', instance.id)
+    caching.bump('location', *Reservation.objects.filter(event=instance.id).values_list('location', flat=True))
+
+
+@receiver(pre_save, sender=Reservation)
+def remember_reservation_location(sender, instance, **kwargs):
+    # A moved reservation also leaves the page of its old location
+    instance._previous_location_id = None
+    if instance.pk:
+        instance._previous_location_id = Reservation.objects.filter(pk=instance.pk) \
+                                                            .values_list('location', flat=True).first()
+
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+def bump_reservation(sender, instance, **kwargs):
+    caching.bump('event', instance.event_id)
+    caching.bump('location', instance.location_id)
+    previous = getattr(instance, '_previous_location_id', None)
+    if previous and previous != instance.location_id:
+        caching.bump('location', previous)
+
+
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def bump_attended_event(sender, instance, **kwargs):
+    caching.bump('event', instance.event_id)
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def bump_location(sender, instance, **kwargs):
+    caching.bump('location', instance.id)
+    caching.bump('event', *Reservation.objects.filter(location=instance.id).values_list('event', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def bump_category_events(sender, instance, created, **kwargs):
+    if not created:
+        events = list(Event.objects.filter(category=instance.id).values_list('id', flat=True))
+        caching.bump('event', *events)
+        caching.bump('location', *Reservation.objects.filter(event__in=events).values_list('location', flat=True).distinct())
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def bump_choices(sender, instance, **kwargs):
+    caching.bump('choices', sender._meta.model_name)
+
+
+# Feeds (see ems.feeds) are validated against category and user versions,
+# plus one 'names' version for the location and category names they show.
+
+def bump_event_feeds(event_id, category_id, creator_id):
+    caching.bump('category', category_id)
+    caching.bump('user', creator_id, *Attendance.objects.filter(event=event_id).values_list('user', flat=True))
+
+
+@receiver(pre_save, sender=Event)
+def remember_event_category(sender, instance, **kwargs):
+    # An event moved to another category also leaves the old category's feed
+    instance._previous_category_id = None
+    if instance.pk:
+        instance._previous_category_id = Event.objects.filter(pk=instance.pk) \
+                                                      .values_list('category', flat=True).first()
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def bump_event_feeds_for_event(sender, instance, **kwargs):
+    bump_event_feeds(instance.id, instance.category_id, instance.creator_id)
+    previous = getattr(instance, '_previous_category_id', None)
+    if previous != instance.category_id:
+        caching.bump('category', previous)
+
+
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+def bump_event_feeds_for_reservation(sender, instance, **kwargs):
+    event = Event.objects.filter(pk=instance.event_id).values('category', 'creator').first()
+    if event is not None:
+        bump_event_feeds(instance.event_id, event['category'], event['creator'])
+
+
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def bump_attendee_feed(sender, instance, **kwargs):
+    # The creator's My Events page shows the attendee count
+    creators = Event.objects.filter(pk=instance.event_id).values_list('creator', flat=True)
+    caching.bump('user', instance.user_id, *creators)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def bump_feed_names(sender, instance, **kwargs):
+    caching.bump('names', 0)
+
+
+@receiver(post_save, sender=Recurrence)
+@receiver(post_delete, sender=Recurrence)
+@receiver(post_save, sender=OccurrenceException)
+@receiver(post_delete, sender=OccurrenceException)
+def bump_series(sender, instance, **kwargs):
+    # A changed rule or exception moves occurrences on every page and feed
+    # showing the series
+    reservation_id = instance.reservation_id if sender is Recurrence else \
+        Recurrence.objects.filter(pk=instance.recurrence_id).values_list('reservation', flat=True).first()
+    reservation = Reservation.objects.filter(pk=reservation_id) \
+                                     .values('event', 'location', 'event__category', 'event__creator').first()
+    if reservation is not None:
+        caching.bump('event', reservation['event'])
+        caching.bump('location', reservation['location'])
+        bump_event_feeds(reservation['event'], reservation['event__category'], reservation['event__creator'])
+
+
+@receiver(post_save, sender=User)
+def save_user_key(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Deleting a user deletes the key with it. Saves that leave the username
+    # and email alone, like the last_login update on every login, skip it.
+    if not raw and (update_fields is None or set(update_fields) & set(['username', 'email'])):
+        accounts.save_key(instance)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_account(sender, instance, **kwargs):
+    caching.bump('account', instance.pk)
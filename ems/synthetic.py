@@ -0,0 +1,158 @@
+"""
+Synthetic data generator for benchmarks and load tests.
+
+Creates users, categories, locations, events, reservations and attendance
+at a configurable scale with bulk inserts. Primary keys are assigned here
+so related rows can be inserted without reading ids back, and rows are
+produced in batches so a million attendance rows never sit in memory at
+once.
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from ems.models import Category, Location, Event, Reservation, Attendance, UserKey
+from ems import rollups, search, status_const
+
+# Password of every generated user
+PASSWORD = 'synthetic'
+
+WORDS = ('annual', 'spring', 'club', 'meeting', 'lecture', 'career', 'fair', 'concert', 'workshop',
+         'hackathon', 'seminar', 'tournament', 'film', 'night', 'study', 'group', 'alumni', 'dinner')
+
+
+class Scale(object):
+    """
+    Row counts for one generated dataset
+    """
+    def __init__(self, events=100, users=None, categories=10, locations=20, attendance_per_event=10,
+                 approved_ratio=0.8, days=120):
+        self.events = events
+        self.users = users if users is not None else max(attendance_per_event * 2, events // 10, 10)
+        self.categories = categories
+        self.locations = locations
+        self.attendance_per_event = min(attendance_per_event, self.users)
+        self.approved_ratio = approved_ratio
+        self.days = days
+
+    @property
+    def attendance(self):
+        return self.events * self.attendance_per_event
+
+    def __repr__(self):
+        return '<Scale events=%d users=%d attendance=%d>' % (self.events, self.users, self.attendance)
+
+
+def _next_id(model):
+    return (model.objects.aggregate(top=Max('id'))['top'] or 0) + 1
+
+
+def _insert(model, rows, batch_size):
+    """
+    bulk_create an iterable of unsaved rows batch by batch
+    """
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            model.objects.bulk_create(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def _name(rng, words=3):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).title()
+
+
+def generate(scale=None, seed=0, batch_size=1000, start=None, index=True):
+    """
+    Insert a synthetic dataset of the given Scale and return a dict of the
+    generated primary key ranges. Rollups (and the search index when index
+    is True) are rebuilt afterwards.
+    """
+    scale = scale or Scale()
+    rng = random.Random(seed)
+    start = start or timezone.now()
+    password = make_password(PASSWORD)
+
+    with transaction.atomic():
+        first_user = _next_id(User)
+        first_category = _next_id(Category)
+        first_location = _next_id(Location)
+        first_event = _next_id(Event)
+        user_ids = range(first_user, first_user + scale.users)
+        category_ids = range(first_category, first_category + scale.categories)
+        location_ids = range(first_location, first_location + scale.locations)
+        event_ids = range(first_event, first_event + scale.events)
+
+        _insert(User, (User(id=user_id, username='synthetic%d' % user_id, email='synthetic%d@example.com' % user_id,
+                            first_name='Synthetic', last_name='User %d' % user_id, password=password,
+                            date_joined=start)
+                       for user_id in user_ids), batch_size)
+        _insert(UserKey, (UserKey(user_id=user_id, username='synthetic%d' % user_id,
+                                  email='synthetic%d@example.com' % user_id)
+                          for user_id in user_ids), batch_size)
+        _insert(Category, (Category(id=category_id, name='%s %d' % (_name(rng, 1), category_id))
+                           for category_id in category_ids), batch_size)
+        _insert(Location, (Location(id=location_id, name='Room %d' % location_id, building=_name(rng, 1),
+                                    room=str(location_id), capacity=rng.choice((0, 50, 100, 500)))
+                           for location_id in location_ids), batch_size)
+
+        def events():
+            for event_id in event_ids:
+                yield Event(id=event_id, creator_id=rng.choice(user_ids), category_id=rng.choice(category_ids),
+                            name=_name(rng), description=_name(rng, 12), is_public=rng.random() < 0.7,
+                            student_fee=rng.choice((0, 0, 5, 10)), staff_fee=rng.choice((0, 10, 15)),
+                            public_fee=rng.choice((0, 15, 20)), prepay=rng.random() < 0.5,
+                            attendee_count=scale.attendance_per_event)
+        _insert(Event, events(), batch_size)
+
+        def reservations():
+            for event_id in event_ids:
+                begins = start + timedelta(days=rng.uniform(-scale.days / 2.0, scale.days / 2.0))
+                begins = begins.replace(minute=0, second=0, microsecond=0)
+                roll = rng.random()
+                if roll < scale.approved_ratio:
+                    status = status_const.APPROVED
+                elif roll < scale.approved_ratio + (1 - scale.approved_ratio) / 2:
+                    status = status_const.PENDING
+                else:
+                    status = status_const.DENIED
+                yield Reservation(event_id=event_id, location_id=rng.choice(location_ids), start_datetime=begins,
+                                  end_datetime=begins + timedelta(hours=rng.choice((1, 2, 3))), status=status)
+        _insert(Reservation, reservations(), batch_size)
+
+        def attendance():
+            # Consecutive users from a per event offset never repeat within one event
+            for event_id in event_ids:
+                offset = rng.randrange(scale.users)
+                for i in range(scale.attendance_per_event):
+                    yield Attendance(user_id=user_ids[(offset + i) % scale.users], event_id=event_id,
+                                     prepaid=rng.random() < 0.3, date_registered=start)
+        _insert(Attendance, attendance(), batch_size)
+
+        # Databases with sequences (PostgreSQL) need them moved past the explicit ids
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), [User, Category, Location, Event]):
+            cursor.execute(sql)
+
+    rollups.rebuild()
+    if index:
+        search.rebuild()
+    return {
+        'users': user_ids,
+        'categories': category_ids,
+        'locations': location_ids,
+        'events': event_ids,
+    }
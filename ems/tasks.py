@@ -0,0 +1,55 @@
+"""
+Follow-up work run by the background workers (see ems.jobs).
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.mail import send_mass_mail
+
+from ems.models import Event
+from ems import jobs, status_const
+
+
+def _mail(subject, body, users):
+    """
+    Send the same message to every user with an email address
+    """
+    messages = [(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email]) for user in users if user.email]
+    if messages:
+        send_mass_mail(messages)
+
+
+@jobs.task
+def registration_followup(event_id, user_id, prepaid=False):
+    """
+    Confirm a new registration to the attendee
+    """
+    event = Event.objects.filter(pk=event_id).first()
+    if event is None:
+        return
+    user = User.objects.get(pk=user_id)
+    _mail("Registered for %s" % event.name,
+          "You are registered to attend %s%s." % (event.name, " and have prepaid" if prepaid else ""), [user])
+
+
+@jobs.task
+def moderation_followup(event_ids, status):
+    """
+    Register the creators of approved events to attend them, and tell the
+    creators their events were approved or denied
+    """
+    if status == status_const.APPROVED:
+        # ems.moderation queues this task, so it is imported here
+        from ems import moderation
+        moderation.register_creators(event_ids)
+    for event in Event.objects.filter(id__in=event_ids).select_related('creator'):
+        _mail("%s was %s" % (event.name, status.lower()),
+              "Your event %s has been %s." % (event.name, status.lower()), [event.creator])
+
+
+@jobs.task
+def event_cancelled(name, user_ids):
+    """
+    Tell the attendees of a deleted event that it will not take place
+    """
+    _mail("%s has been cancelled" % name, "The event %s you registered for has been cancelled." % name,
+          User.objects.filter(id__in=user_ids).only('email'))
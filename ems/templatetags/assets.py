@@ -0,0 +1,30 @@
+import json
+
+from django import template
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+
+from ems import assets
+
+register = template.Library()
+
+
+@register.simple_tag
+def bundle(name):
+    """
+    <link> or <script> tags for a bundle (see ems.assets)
+    """
+    urls = [(staticfiles_storage.url(source),) for source in assets.sources(name)]
+    if name.endswith('.css'):
+        return format_html_join('\n', '<link href="{0}" rel="stylesheet">', urls)
+    return format_html_join('\n', '<script src="{0}"></script>', urls)
+
+
+@register.simple_tag
+def bundle_urls(name):
+    """
+    A JSON array of the URLs to load a bundle from, for scripts loaded
+    with $.getScript
+    """
+    return mark_safe(json.dumps([staticfiles_storage.url(source) for source in assets.sources(name)]))
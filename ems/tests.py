@@ -1,3 +1,1159 @@
-from django.test import TestCase
+"""
+Query count, query plan and timing benchmarks for the ems views.
 
-# Create your tests here.
+The query count tests render each view over a small and a larger synthetic
+dataset and fail if the number of queries grows with the data (an N+1
+regression) or goes over the view's budget.
+
+Timing runs are skipped by default. Set EMS_BENCHMARK_SCALES to a comma
+separated list of event counts (e.g. "1000,10000") to time every view at
+each scale. EMS_BENCHMARK_ATTENDANCE sets the attendance rows per event
+(100 at 10000 events gives 1M rows) and EMS_BENCHMARK_OUTPUT names a file
+that receives the JSON report, including EXPLAIN plans.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction, IntegrityError
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import formats, timezone
+from django.utils.six import StringIO
+
+from ems.forms import RegistrationForm, ReservationEditForm, cached_choices
+from ems.models import Category, Location, Event, Reservation, Attendance, Approval, DailyRollup, Job, SearchToken, Recurrence, UserKey
+from ems.middleware import QueryBudgetExceeded
+from ems.paging import keyset_page
+from ems.reports import summary_data
+from ems import accounts, assets, booking, explorer, feeds, importer, jobs, loadtest, metrics, moderation, recurrence, registration, rollups, roster, routers, status_const, synthetic
+from ems.views import OCCURRENCE_FORMAT
+
+BENCHMARK_SCALES = [int(size) for size in os.environ.get('EMS_BENCHMARK_SCALES', '').split(',') if size.strip()]
+BENCHMARK_ATTENDANCE = int(os.environ.get('EMS_BENCHMARK_ATTENDANCE', 20))
+BENCHMARK_OUTPUT = os.environ.get('EMS_BENCHMARK_OUTPUT')
+BENCHMARK_REPEAT = 5
+
+DATATABLE_PARAMS = {'sEcho': 1, 'iDisplayStart': 0, 'iDisplayLength': 25, 'iSortCol_0': 3, 'sSortDir_0': 'asc'}
+
+
+def explain(queryset):
+    """
+    The database's query plan for a queryset, one string per plan row
+    """
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+
+def write_report(section, data):
+    if not BENCHMARK_OUTPUT:
+        return
+    report = {}
+    if os.path.exists(BENCHMARK_OUTPUT):
+        with open(BENCHMARK_OUTPUT) as report_file:
+            report = json.load(report_file)
+    report[section] = data
+    with open(BENCHMARK_OUTPUT, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+@override_settings(EMS_BUNDLE_ASSETS=False)
+class BenchmarkTestCase(TestCase):
+    """
+    Logs in a staff user who owns an event at their own location, and grows
+    every list that user can see with synthetic data. Pages include the
+    static source files, as the tests run without collectstatic.
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='bench', password='bench')
+        now = timezone.now()
+        self.category = Category.objects.create(name='Benchmarks')
+        self.location = Location.objects.create(name='Bench Hall', capacity=0)
+        self.event = Event.objects.create(creator=self.user, category=self.category, name='Bench Event')
+        Reservation.objects.create(event=self.event, location=self.location, start_datetime=now,
+                                   end_datetime=now + timedelta(hours=2), status=status_const.APPROVED)
+        self.size = 0
+        cache.clear()
+
+    def grow(self, size, attendance_per_event=2):
+        """
+        Add size events created and attended by the test user: half approved
+        at the test location, half pending. The test event gains one
+        attendee per generated user.
+        """
+        ids = synthetic.generate(synthetic.Scale(events=size, categories=3, locations=3,
+                                                 attendance_per_event=attendance_per_event),
+                                 seed=self.size + size)
+        self.size += size
+        events = list(ids['events'])
+        Event.objects.filter(id__in=events).update(creator=self.user)
+        Reservation.objects.filter(event__in=events[:size // 2]).update(status=status_const.APPROVED,
+                                                                       location=self.location)
+        Reservation.objects.filter(event__in=events[size // 2:]).update(status=status_const.PENDING)
+        now = timezone.now()
+        Attendance.objects.bulk_create([Attendance(user=self.user, event_id=event_id, date_registered=now)
+                                        for event_id in events])
+        Attendance.objects.bulk_create([Attendance(user_id=user_id, event=self.event, date_registered=now)
+                                        for user_id in ids['users']])
+        # Bulk inserts and updates skip the receivers that bump cache versions
+        cache.clear()
+        return ids
+
+    def views(self):
+        """
+        (name, url, GET data, query budget) for every view under test
+        """
+        return [
+            ('my_events', reverse('my_events'), {}, 12),
+            ('all_events', reverse('all_events'), {}, 4),
+            ('all_events_data', reverse('all_events_data'), DATATABLE_PARAMS, 8),
+            ('all_events_search', reverse('all_events_data'), dict(DATATABLE_PARAMS, sSearch='club'), 10),
+            ('pending_events', reverse('pending_events'), {}, 6),
+            ('event_details', reverse('event_details', args=[self.event.id]), {}, 12),
+            ('location_details', reverse('location_details', args=[self.location.id]), {}, 6),
+            ('summary_report', reverse('summary_report'), {}, 6),
+        ]
+
+    def count_queries(self, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries)
+
+
+class QueryCountTest(BenchmarkTestCase):
+    """
+    Query counts must not depend on the amount of data a view shows
+    """
+    def assertFlatQueryCount(self, name):
+        url, data, budget = [(url, data, budget) for view_name, url, data, budget in self.views() if view_name == name][0]
+        self.grow(4)
+        small = self.count_queries(url, data)
+        self.grow(16)
+        large = self.count_queries(url, data)
+        self.assertEqual(small, large, "%s ran %d queries over the small dataset and %d over the large one"
+                         % (name, small, large))
+        self.assertLessEqual(large, budget, "%s ran %d queries, over its budget of %d" % (name, large, budget))
+
+    def test_my_events(self):
+        self.assertFlatQueryCount('my_events')
+
+    def test_all_events(self):
+        self.assertFlatQueryCount('all_events')
+
+    def test_all_events_data(self):
+        self.assertFlatQueryCount('all_events_data')
+
+    def test_all_events_search(self):
+        self.assertFlatQueryCount('all_events_search')
+
+    def test_all_events_total_without_rollups(self):
+        DailyRollup.objects.all().delete()
+        response = json.loads(self.client.get(reverse('all_events_data'), DATATABLE_PARAMS).content.decode())
+        self.assertEqual(response['iTotalRecords'], 1)
+
+    def test_all_events_search_ranked(self):
+        now = timezone.now()
+        for name, description, days in (('Talk', 'About zyzzyva', 1), ('Zyzzyva', 'Zyzzyva again', 2)):
+            event = Event.objects.create(creator=self.user, category=self.category, name=name, description=description)
+            Reservation.objects.create(event=event, location=self.location, start_datetime=now + timedelta(days=days),
+                                       end_datetime=now + timedelta(days=days, hours=1), status=status_const.APPROVED)
+        params = {'sEcho': 1, 'iDisplayStart': 0, 'iDisplayLength': 25, 'iSortingCols': 0, 'sSearch': 'zyzzyva'}
+        names = [row['name'] for row in json.loads(self.client.get(reverse('all_events_data'), params).content.decode())['aaData']]
+        self.assertEqual(names, ['Zyzzyva', 'Talk'])
+        params.update(iSortingCols=1, iSortCol_0=3, sSortDir_0='asc')
+        names = [row['name'] for row in json.loads(self.client.get(reverse('all_events_data'), params).content.decode())['aaData']]
+        self.assertEqual(names, ['Talk', 'Zyzzyva'])
+
+    def test_pending_events(self):
+        self.assertFlatQueryCount('pending_events')
+
+    def test_event_details(self):
+        self.assertFlatQueryCount('event_details')
+
+    def test_location_details(self):
+        self.assertFlatQueryCount('location_details')
+
+    def test_summary_report(self):
+        self.assertFlatQueryCount('summary_report')
+
+
+class QueryPlanTest(BenchmarkTestCase):
+    """
+    Capture the plans of the queries behind the busiest pages
+    """
+    def key_queries(self):
+        now = timezone.now()
+        approved = Reservation.objects.filter(status=status_const.APPROVED)
+        return [
+            ('all_events_page', approved.order_by('start_datetime', 'pk')[:25]),
+            ('all_events_seek', approved.order_by('start_datetime', 'pk').values_list('start_datetime', 'pk')[99:100]),
+            ('location_overlap', booking.overlapping(self.location.id, now, now + timedelta(hours=1))),
+            ('search_tokens', SearchToken.objects.filter(token__startswith='club').values('event')),
+            ('summary_rollups', DailyRollup.objects.filter(day__gte=now.date(), day__lt=(now + timedelta(days=7)).date())),
+            ('event_attendance', Attendance.objects.filter(event=self.event.id).select_related('user')),
+            ('my_events', Event.objects.filter(creator=self.user)),
+        ]
+
+    def test_explain_key_queries(self):
+        self.grow(20)
+        plans = {}
+        for name, queryset in self.key_queries():
+            plans[name] = explain(queryset)
+            self.assertTrue(plans[name], "No plan returned for %s" % name)
+        write_report('plans', plans)
+
+    def test_keyset_page_matches_offset(self):
+        self.grow(20)
+        approved = Reservation.objects.filter(status=status_const.APPROVED)
+        ordered = approved.order_by('start_datetime', 'pk')
+        expected = list(ordered[5:10])
+        self.assertEqual(keyset_page(approved, 'start_datetime', offset=5, length=5), expected)
+        previous = list(ordered[4:5])[0]
+        self.assertEqual(keyset_page(approved, 'start_datetime', offset=5, length=5, after=previous.pk), expected)
+        self.assertEqual(keyset_page(approved, 'start_datetime', offset=approved.count(), length=5), [])
+
+
+@unittest.skipUnless(BENCHMARK_SCALES, "Set EMS_BENCHMARK_SCALES to run the timing benchmarks")
+class TimingBenchmark(BenchmarkTestCase):
+    """
+    Wall-clock time of every view at each EMS_BENCHMARK_SCALES size
+    """
+    def time_view(self, url, data):
+        timings = []
+        for i in range(BENCHMARK_REPEAT):
+            began = time.time()
+            response = self.client.get(url, data)
+            timings.append(time.time() - began)
+            self.assertEqual(response.status_code, 200)
+        timings.sort()
+        return timings[len(timings) // 2] * 1000
+
+    def test_timings(self):
+        results = []
+        previous = {}
+        for size in sorted(BENCHMARK_SCALES):
+            if size > self.size:
+                self.grow(size - self.size, attendance_per_event=BENCHMARK_ATTENDANCE)
+            for name, url, data, budget in self.views():
+                milliseconds = self.time_view(url, data)
+                queries = self.count_queries(url, data)
+                result = {'view': name, 'events': size, 'attendance': size * BENCHMARK_ATTENDANCE,
+                          'median_ms': round(milliseconds, 2), 'queries': queries}
+                # Flag views whose time grows faster than the data does
+                if name in previous:
+                    last_size, last_milliseconds = previous[name]
+                    result['superlinear'] = milliseconds / max(last_milliseconds, 0.01) > 1.5 * size / float(last_size)
+                previous[name] = (size, milliseconds)
+                results.append(result)
+                sys.stderr.write('%(view)-20s %(events)8d events %(median_ms)10.2f ms %(queries)4d queries\n' % result)
+        write_report('timings', results)
+
+
+class RequestMetricsTest(BenchmarkTestCase):
+    """
+    Requests are counted and timed without the debug cursor, and only
+    reads raise over their query budget
+    """
+    def test_queries_counted(self):
+        metrics.reset()
+        self.client.get(reverse('my_events'))
+        self.assertFalse(connection.use_debug_cursor)
+        self.assertFalse(connection.queries)
+        row = [row for row in metrics.summary() if row['name'] == 'my_events'][0]
+        queries = [metric for metric in row['metrics'] if metric['name'] == 'queries'][0]
+        self.assertGreater(queries['percentiles'][0], 0)
+
+    @override_settings(EMS_QUERY_BUDGETS={'my_events': 0, 'delete_event': 0}, EMS_QUERY_BUDGET_RAISE=True)
+    def test_budget(self):
+        self.assertRaises(QueryBudgetExceeded, self.client.get, reverse('my_events'))
+        response = self.client.post(reverse('delete_event', args=[self.event.id]))
+        self.assertEqual(response.status_code, 302)
+
+
+class CachedPageTest(BenchmarkTestCase):
+    """
+    Cached event and location pages change as soon as their data does
+    """
+    def test_event_details_follows_saves(self):
+        url = reverse('event_details', args=[self.event.id])
+        self.assertContains(self.client.get(url), 'Bench Event')
+        self.event.name = 'Renamed Event'
+        self.event.save()
+        self.assertContains(self.client.get(url), 'Renamed Event')
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        Attendance.objects.create(user=other, event=self.event, date_registered=timezone.now())
+        self.assertContains(self.client.get(url), 'other')
+
+    def test_location_details_follows_saves(self):
+        url = reverse('location_details', args=[self.location.id])
+        self.assertContains(self.client.get(url), 'Bench Event')
+        self.event.name = 'Renamed Event'
+        self.event.save()
+        self.assertContains(self.client.get(url), 'Renamed Event')
+        self.location.name = 'Moved Hall'
+        self.location.save()
+        self.assertContains(self.client.get(url), 'Moved Hall')
+
+    def test_cached_event_details_skip_queries(self):
+        url = reverse('event_details', args=[self.event.id])
+        first = self.count_queries(url)
+        self.assertLess(self.count_queries(url), first)
+
+
+class CachedChoiceTest(BenchmarkTestCase):
+    """
+    Category and location choices come from the cache and follow saves
+    """
+    def test_choices_validate_without_queries(self):
+        data = {'location': self.location.id, 'start_datetime': '01/01/30 10:00', 'end_datetime': '01/01/30 11:00'}
+        ReservationEditForm(data).is_valid()
+        with CaptureQueriesContext(connection) as queries:
+            form = ReservationEditForm(data)
+            self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(form.cleaned_data['location'], self.location.id)
+        self.assertFalse(ReservationEditForm(dict(data, location=self.location.id + 1000)).is_valid())
+
+    def test_edit_sets_location_id(self):
+        annex = Location.objects.create(name='Annex', capacity=25)
+        reservation = Reservation.objects.get(event=self.event)
+        self.assertEqual(reservation.location, self.location)
+        form = ReservationEditForm({'location': annex.id, 'start_datetime': '01/01/30 10:00',
+                                    'end_datetime': '01/01/30 11:00'}, instance=reservation)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(reservation.location.capacity, 25)
+        self.assertEqual(Reservation.objects.get(event=self.event).location_id, annex.id)
+
+    def test_create_event(self):
+        data = {'name': 'Created', 'category': self.category.id, 'description': 'New', 'location': self.location.id,
+                'start_datetime': '01/01/30 10:00', 'end_datetime': '01/01/30 11:00',
+                'student_fee': '0', 'staff_fee': '0', 'public_fee': '0'}
+        self.assertEqual(self.client.post(reverse('create_event'), data).status_code, 302)
+        reservation = Reservation.objects.get(event__name='Created')
+        self.assertEqual((reservation.location_id, reservation.event.category_id), (self.location.id, self.category.id))
+        response = self.client.post(reverse('create_event'), dict(data, name='Clash'))
+        self.assertContains(response, 'Bench Hall is already booked')
+        self.assertFalse(Event.objects.filter(name='Clash').exists())
+
+    def test_new_location_is_offered(self):
+        cached_choices(Location)
+        hall = Location.objects.create(name='New Hall', capacity=0)
+        self.assertIn((hall.id, 'New Hall'), cached_choices(Location))
+
+    def test_choice_search(self):
+        response = self.client.get(reverse('choice_search', args=['location']), {'q': 'bench'})
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['results'],
+                         [{'id': self.location.id, 'text': 'Bench Hall'}])
+
+
+class ImportTest(BenchmarkTestCase):
+    """
+    Bulk imports resolve names, batch their inserts and skip double bookings
+    """
+    def test_import_csv(self):
+        rows = ['name,category,location,start,end,creator\n',
+                'Lecture,Benchmarks,Bench Hall,01/05/30 10:00,01/05/30 11:00,bench\n',
+                'Clash,Benchmarks,Bench Hall,01/05/30 10:30,01/05/30 12:00,bench\n',
+                'Seminar,Benchmarks,Nowhere,01/06/30 10:00,01/06/30 11:00,bench\n',
+                'Evening,benchmarks,%d,01/05/30 18:00,01/05/30 19:00,\n' % self.location.id]
+        rejects = []
+        imported, rejected = importer.import_rows(importer.read_csv(rows), creator=self.user, batch_size=2,
+                                                  on_reject=lambda line, reason: rejects.append(line))
+        self.assertEqual((imported, rejected), (2, 2))
+        self.assertEqual(sorted(rejects), [3, 4])
+        self.assertEqual(sorted(Event.objects.filter(category=self.category).values_list('name', flat=True)),
+                         ['Bench Event', 'Evening', 'Lecture'])
+        self.assertEqual(Reservation.objects.get(event__name='Lecture').location_id, self.location.id)
+
+    def test_import_ics(self):
+        lines = ['BEGIN:VCALENDAR\r\n', 'BEGIN:VEVENT\r\n', 'SUMMARY:Term\\, opening\r\n',
+                 'DESCRIPTION:A long\r\n', ' er description\r\n', 'LOCATION:Bench Hall\r\n',
+                 'CATEGORIES:Benchmarks\r\n', 'DTSTART:20300105T100000Z\r\n', 'DURATION:PT2H\r\n',
+                 'END:VEVENT\r\n', 'END:VCALENDAR\r\n']
+        imported, rejected = importer.import_rows(importer.read_ics(lines), creator=self.user)
+        self.assertEqual((imported, rejected), (1, 0))
+        event = Event.objects.get(name='Term, opening')
+        self.assertEqual(event.description, 'A longer description')
+        self.assertEqual(event.reservation.end_datetime - event.reservation.start_datetime, timedelta(hours=2))
+
+
+class FeedTest(BenchmarkTestCase):
+    """
+    Feeds stream the approved events and answer 304 while nothing changes
+    """
+    def test_location_feed(self):
+        url = feeds.urls('location', self.location.id)['ics']
+        self.client.logout()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'SUMMARY:Bench Event', b''.join(response.streaming_content))
+        etag = response['ETag']
+        # Requests that write nothing leave the feed's versions alone
+        self.assertEqual(self.client.get(url)['ETag'], etag)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.event.name = 'Renamed Event'
+        self.event.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_user_feed(self):
+        url = reverse('feed', kwargs={'kind': 'user', 'pk': self.user.id, 'fmt': 'json'})
+        response = self.client.get(url)
+        self.assertEqual(json.loads(b''.join(response.streaming_content).decode('utf-8'))['events'][0]['name'],
+                         'Bench Event')
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        self.assertEqual(self.client.get(reverse('feed', kwargs={'kind': 'user', 'pk': other.id, 'fmt': 'json'}))
+                         .status_code, 404)
+
+
+class ExplorerTest(BenchmarkTestCase):
+    """
+    The admin db explorer pages, explains and exports query results
+    """
+    def test_pages_and_export(self):
+        self.grow(12)
+        query = 'SELECT id, name FROM ems_event ORDER BY id'
+        columns, rows, has_next = explorer.fetch_page(query, page=1, page_size=5)
+        self.assertEqual(columns, ['id', 'name'])
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(has_next)
+        with CaptureQueriesContext(connection) as queries:
+            columns, rows, has_next = explorer.fetch_page(query, page=3, page_size=5)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0][0], list(Event.objects.order_by('id').values_list('id', flat=True))[10])
+        # The database skips the earlier pages
+        self.assertTrue([captured for captured in queries.captured_queries if 'LIMIT 6 OFFSET 10' in captured['sql']])
+        self.assertFalse(has_next)
+        lines = ''.join(explorer.csv_rows(query)).splitlines()
+        self.assertEqual(lines[0], 'id,name')
+        self.assertEqual(len(lines), 14)
+        self.assertTrue(explorer.explain(query)[1])
+
+
+class ModerationTest(BenchmarkTestCase):
+    """
+    Bulk moderation costs the same queries for one event or many
+    """
+    def test_bulk_approve(self):
+        self.grow(10)
+        rollups.rebuild()
+        pending = list(Event.objects.filter(reservation__status=status_const.PENDING).values_list('id', flat=True))
+        self.assertEqual(len(pending), 5)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('moderate_events'), {'action': 'approve', 'event_ids': pending})
+        self.assertEqual(response.status_code, 302)
+        self.assertLessEqual(len(queries.captured_queries), 20)
+        self.assertFalse(Reservation.objects.filter(status=status_const.PENDING).exists())
+        self.assertEqual(Approval.objects.filter(approver=self.user).count(), 5)
+        self.assertEqual(jobs.work_all(), 1)
+        for event in Event.objects.filter(id__in=pending):
+            self.assertTrue(Attendance.objects.filter(event=event, user=event.creator).exists())
+        totals = DailyRollup.objects.filter(status=status_const.PENDING).aggregate(total=Sum('event_count'))
+        self.assertFalse(totals['total'])
+        counted = sorted(DailyRollup.objects.filter(event_count__gt=0)
+                                            .values_list('day', 'location', 'status', 'event_count', 'registration_count'))
+        rollups.rebuild()
+        self.assertEqual(counted, sorted(DailyRollup.objects.values_list('day', 'location', 'status', 'event_count',
+                                                                         'registration_count')))
+
+    def test_register_creators(self):
+        self.grow(20)
+        Attendance.objects.filter(user=self.user).delete()
+        Event.objects.update(attendee_count=0)
+        rollups.rebuild()
+        events = list(Event.objects.exclude(pk=self.event.pk).values_list('id', flat=True))
+        counts = []
+        for batch in (events[:2], events[2:]):
+            with CaptureQueriesContext(connection) as queries:
+                moderation.register_creators(batch)
+            counts.append(len(queries.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Attendance.objects.filter(user=self.user).count(), len(events))
+        counted = sorted(DailyRollup.objects.filter(event_count__gt=0).values_list('day', 'location', 'status',
+                                                                                   'registration_count'))
+        rollups.rebuild()
+        self.assertEqual(counted, sorted(DailyRollup.objects.values_list('day', 'location', 'status', 'registration_count')))
+
+    def test_approving_denied_checks_bookings(self):
+        reservation = Reservation.objects.get(event=self.event)
+        Reservation.objects.filter(pk=reservation.pk).update(status=status_const.DENIED)
+        other = Event.objects.create(creator=self.user, category=self.category, name='Taken')
+        Reservation.objects.create(event=other, location=self.location, start_datetime=reservation.start_datetime,
+                                   end_datetime=reservation.end_datetime, status=status_const.APPROVED)
+        self.assertEqual(moderation.moderate([self.event.id], status_const.APPROVED, self.user), [])
+        self.assertEqual(Reservation.objects.get(pk=reservation.pk).status, status_const.DENIED)
+        other.delete()
+        self.assertEqual(moderation.moderate([self.event.id], status_const.APPROVED, self.user), [self.event.id])
+
+    def test_deny_single(self):
+        self.client.get(reverse('deny_event', args=[self.event.id]))
+        self.assertEqual(Reservation.objects.get(event=self.event).status, status_const.DENIED)
+        self.assertFalse(Approval.objects.exists())
+
+
+class BookingTest(BenchmarkTestCase):
+    """
+    Overlaps are found in the database and, for batches, in an interval
+    index per location
+    """
+    def book(self, start, end, location=None):
+        event = Event.objects.create(creator=self.user, category=self.category, name='Booked')
+        Reservation.objects.create(event=event, location=location or self.location, start_datetime=start,
+                                   end_datetime=end, status=status_const.APPROVED)
+        return event
+
+    def test_interval_index(self):
+        intervals = [(0, 100, 'long'), (10, 20, 'a'), (30, 40, 'b'), (50, 60, 'c')]
+        index = booking.IntervalIndex(intervals[:2])
+        for start, end, key in intervals[2:]:
+            index.add(start, end, key)
+        index.add(5, 8, 'd')
+        rebuilt = booking.IntervalIndex(intervals + [(5, 8, 'd')])
+        self.assertEqual((index.intervals, index.starts, index.max_ends),
+                         (rebuilt.intervals, rebuilt.starts, rebuilt.max_ends))
+        self.assertEqual(index.overlapping(35, 55), ['long', 'b', 'c'])
+        self.assertEqual(index.overlapping(100, 110), [])
+        self.assertEqual(index.overlapping(20, 30), ['long'])
+
+    def test_check_slots(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        event = self.book(start, start + timedelta(hours=2))
+        other = Location.objects.create(name='Annex', capacity=0)
+        results = booking.check_slots([(self.location.id, start + timedelta(hours=1), start + timedelta(hours=3)),
+                                       (other.id, start, start + timedelta(hours=1)),
+                                       (other.id, start + timedelta(minutes=30), start + timedelta(hours=2)),
+                                       (self.location.id, start + timedelta(hours=2), start + timedelta(hours=3))])
+        self.assertEqual(results, [([event.id], []), ([], []), ([], [1]), ([], [])])
+
+    def test_ensure_available(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        event = self.book(start - timedelta(days=2), start + timedelta(hours=1))
+        with self.assertRaises(booking.BookingConflict) as raised:
+            booking.ensure_available(self.location.id, start, start + timedelta(hours=1))
+        self.assertEqual(raised.exception.event_ids, [event.id])
+        booking.ensure_available(self.location.id, start + timedelta(hours=1), start + timedelta(hours=2))
+        booking.ensure_available(self.location.id, start, start + timedelta(hours=1), exclude_event=event.id)
+
+    def test_max_duration(self):
+        start = timezone.now().replace(microsecond=0)
+        self.assertRaises(ValueError, booking.check_duration, start, start + booking.MAX_DURATION + timedelta(minutes=1))
+        form = ReservationEditForm({'location': self.location.id, 'start_datetime': '01/01/30 09:00',
+                                    'end_datetime': '06/01/30 09:00'})
+        self.assertFalse(form.is_valid())
+
+
+class ConcurrentBookingTest(TransactionTestCase):
+    """
+    Of two concurrent bookings of the same slot, one wins
+    """
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_one_booking_wins(self):
+        user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+        category = Category.objects.create(name='Benchmarks')
+        location = Location.objects.create(name='Bench Hall', capacity=0)
+        events = [Event.objects.create(creator=user, category=category, name='Racing') for n in range(2)]
+        start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        results = []
+
+        def book(event):
+            try:
+                with transaction.atomic():
+                    booking.ensure_available(location.id, start, start + timedelta(hours=1))
+                    # Hold the location lock while the other booking waits for it
+                    time.sleep(0.2)
+                    Reservation.objects.create(event=event, location=location, start_datetime=start,
+                                               end_datetime=start + timedelta(hours=1))
+                results.append('booked')
+            except booking.BookingConflict:
+                results.append('conflict')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(event,)) for event in events]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ['booked', 'conflict'])
+
+
+class AvailabilityTest(BenchmarkTestCase):
+    """
+    Free slots are the gaps between active reservations
+    """
+    def test_free_slots(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        other = Location.objects.create(name='Annex', capacity=10)
+        for offset, hours in ((1, 2), (2, 1), (6, 1)):
+            event = Event.objects.create(creator=self.user, category=self.category, name='Booked')
+            Reservation.objects.create(event=event, location=self.location, start_datetime=start + timedelta(hours=offset),
+                                       end_datetime=start + timedelta(hours=offset + hours), status=status_const.APPROVED)
+        results = dict((location['id'], slots) for location, slots in
+                       booking.free_slots(start, start + timedelta(hours=8), timedelta(hours=1)))
+        self.assertEqual(results[self.location.id], [(start, start + timedelta(hours=1)),
+                                                     (start + timedelta(hours=3), start + timedelta(hours=6)),
+                                                     (start + timedelta(hours=7), start + timedelta(hours=8))])
+        self.assertEqual(results[other.id], [(start, start + timedelta(hours=8))])
+        results = booking.free_slots(start, start + timedelta(hours=8), timedelta(hours=1), min_capacity=20)
+        self.assertEqual([location['id'] for location, slots in results], [self.location.id])
+
+    def test_long_reservation_before_window(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        event = Event.objects.create(creator=self.user, category=self.category, name='Conference')
+        Reservation.objects.create(event=event, location=self.location, start_datetime=start - timedelta(days=3),
+                                   end_datetime=start + timedelta(hours=2), status=status_const.APPROVED)
+        event = Event.objects.create(creator=self.user, category=self.category, name='Earlier')
+        Reservation.objects.create(event=event, location=self.location, start_datetime=start - timedelta(days=60),
+                                   end_datetime=start - timedelta(days=59), status=status_const.APPROVED)
+        results = booking.free_slots(start, start + timedelta(hours=8), timedelta(hours=1), location_ids=[self.location.id])
+        self.assertEqual(results[0][1], [(start + timedelta(hours=2), start + timedelta(hours=8))])
+
+    def test_availability_view(self):
+        response = self.client.get(reverse('availability'), {'start_datetime': '01/01/30 09:00',
+                                                             'end_datetime': '01/01/30 17:00'})
+        locations = json.loads(response.content.decode('utf-8'))['locations']
+        self.assertEqual([location['name'] for location in locations], ['Bench Hall'])
+
+
+class RosterTest(BenchmarkTestCase):
+    """
+    Rosters are paged on the details page and downloaded in full
+    """
+    def test_roster_export(self):
+        ids = self.grow(4, attendance_per_event=1)
+        response = self.client.get(reverse('export_roster', args=[self.event.id, 'csv']))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], ','.join(roster.HEADER))
+        self.assertEqual(len(lines), len(ids['users']) + 1)
+
+    def test_roster_rows_are_chunked(self):
+        ids = self.grow(4, attendance_per_event=1)
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(roster.rows(roster.for_event(self.event.id), chunk_size=3))
+        self.assertEqual(len(rows), len(ids['users']))
+        self.assertEqual(len(queries.captured_queries), len(rows) // 3 + 1)
+
+    def test_roster_pages(self):
+        self.grow(4, attendance_per_event=1)
+        attendance = roster.for_event(self.event.id)
+        first, has_next = roster.page(attendance, 1)
+        self.assertEqual(len(first), attendance.count())
+        self.assertFalse(has_next)
+        self.assertEqual(roster.page(attendance, 2), ([], False))
+
+
+class SummaryReportTest(BenchmarkTestCase):
+    """
+    The report counts exactly the events starting in its range, even when
+    the range starts or ends part way through a day
+    """
+    def test_partial_days(self):
+        start = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0) + timedelta(days=30)
+        end = start + timedelta(days=9)
+        offsets = [-timedelta(hours=1), timedelta(hours=1), timedelta(days=3), timedelta(days=7, hours=1),
+                   timedelta(days=9, hours=-1), timedelta(days=9, hours=1)]
+        for n, offset in enumerate(offsets):
+            event = Event.objects.create(creator=self.user, category=self.category, name='Report %d' % n)
+            Reservation.objects.create(event=event, location=self.location, start_datetime=start + offset,
+                                       end_datetime=start + offset + timedelta(minutes=30), status=status_const.APPROVED)
+            Attendance.objects.create(user=self.user, event=event, prepaid=True, date_registered=start)
+        rollups.rebuild()
+        data = summary_data(start, end)
+        self.assertEqual(data['total_event_count'], 4)
+        self.assertEqual(data['attendance_count'], 4)
+        self.assertEqual([week['total_event_count'] for week in data['weekly_data']], [2, 2])
+        self.assertEqual(summary_data(start, start + timedelta(hours=2))['total_event_count'], 1)
+
+
+class RegistrationTest(BenchmarkTestCase):
+    """
+    Seats are claimed atomically against the location's capacity, and a
+    registration never counts the event's attendance
+    """
+    def attendees(self, count):
+        return [User.objects.create_user('attendee%d' % n, 'attendee%d@example.com' % n, 'x') for n in range(count)]
+
+    def test_full(self):
+        Location.objects.filter(pk=self.location.pk).update(capacity=1)
+        first, second = self.attendees(2)
+        registration.register(first, self.event)
+        self.assertRaises(registration.EventFull, registration.register, second, self.event)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).attendee_count, 1)
+
+    def test_duplicate_gives_seat_back(self):
+        Location.objects.filter(pk=self.location.pk).update(capacity=2)
+        first, second = self.attendees(2)
+        registration.register(first, self.event)
+        self.assertRaises(registration.AlreadyRegistered, registration.register, first, self.event)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).attendee_count, 1)
+        self.assertEqual(DailyRollup.objects.aggregate(total=Sum('registration_count'))['total'], 1)
+        registration.register(second, self.event)
+
+    def test_unlimited(self):
+        for user in self.attendees(3):
+            registration.register(user, self.event)
+        self.assertEqual(Event.objects.get(pk=self.event.pk).attendee_count, 3)
+
+    def test_no_attendance_count(self):
+        self.grow(2)
+        rollups.rebuild()
+        user, = self.attendees(1)
+        with CaptureQueriesContext(connection) as queries:
+            registration.register(user, self.event, prepaid=True)
+        self.assertFalse([query['sql'] for query in queries.captured_queries if 'COUNT(' in query['sql'].upper()])
+        counted = DailyRollup.objects.aggregate(registrations=Sum('registration_count'), prepaid=Sum('prepaid_count'))
+        rollups.rebuild()
+        self.assertEqual(counted, DailyRollup.objects.aggregate(registrations=Sum('registration_count'),
+                                                                prepaid=Sum('prepaid_count')))
+
+
+class RecountTest(BenchmarkTestCase):
+    """
+    Attendee counts are rebuilt from the attendance rows
+    """
+    def test_recount(self):
+        self.grow(4, attendance_per_event=3)
+        Event.objects.update(attendee_count=0)
+        registration.recount()
+        for event in Event.objects.all():
+            self.assertEqual(event.attendee_count, Attendance.objects.filter(event=event).count())
+
+
+class JobTest(BenchmarkTestCase):
+    """
+    Follow-up work runs in the worker, and failed jobs are retried later
+    """
+    def test_registration_followup(self):
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        registration.register(other, self.event)
+        self.assertEqual(DailyRollup.objects.aggregate(total=Sum('registration_count'))['total'], 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(jobs.work_all(), 1)
+        self.assertEqual(mail.outbox[0].to, ['other@example.com'])
+        self.assertEqual(DailyRollup.objects.aggregate(total=Sum('registration_count'))['total'], 1)
+
+    def test_rollups_match_rebuild_before_followup(self):
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        registration.register(other, self.event)
+        moderation.moderate([self.event.id], status_const.DENIED, self.user)
+        jobs.work_all()
+        counted = sorted(DailyRollup.objects.filter(event_count__gt=0)
+                                            .values_list('status', 'event_count', 'registration_count'))
+        rollups.rebuild()
+        self.assertEqual(counted, sorted(DailyRollup.objects.filter(event_count__gt=0)
+                                                            .values_list('status', 'event_count', 'registration_count')))
+
+    def test_retry_with_backoff(self):
+        calls = []
+
+        @jobs.task
+        def flaky():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError("first try fails")
+
+        try:
+            job = jobs.enqueue('flaky', max_attempts=2)
+            self.assertEqual(jobs.work_all(), 1)
+            job = Job.objects.get(pk=job.pk)
+            self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+            self.assertIn('first try fails', job.last_error)
+            self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=jobs.backoff(1) - 5))
+            Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            self.assertEqual(jobs.work_all(), 1)
+            self.assertEqual(Job.objects.get(pk=job.pk).status, Job.DONE)
+        finally:
+            del jobs.TASKS['flaky']
+
+    def test_done_with_task_writes(self):
+        @jobs.task
+        def write_category():
+            Category.objects.create(name='Written')
+
+        finish = jobs._finish
+
+        def crash(job, began):
+            if job.status == Job.DONE:
+                raise RuntimeError("The worker died before recording the job")
+            finish(job, began)
+
+        jobs._finish = crash
+        try:
+            job = jobs.enqueue('write_category')
+            jobs.work_all()
+            self.assertFalse(Category.objects.filter(name='Written').exists())
+            self.assertEqual(Job.objects.get(pk=job.pk).status, Job.QUEUED)
+        finally:
+            jobs._finish = finish
+            del jobs.TASKS['write_category']
+
+    def test_reclaimed_job_left_alone(self):
+        calls = []
+
+        @jobs.task
+        def counted():
+            calls.append(1)
+
+        try:
+            jobs.enqueue('counted')
+            job, = jobs.claim(worker='slow')
+            # Another worker took the job over after JOB_TIMEOUT
+            Job.objects.filter(pk=job.pk).update(locked_by='other')
+            self.assertFalse(jobs.run(job))
+            self.assertEqual(calls, [])
+        finally:
+            del jobs.TASKS['counted']
+
+
+@override_settings(EMS_READ_REPLICAS=['replica'])
+class ReplicaRouterTest(BenchmarkTestCase):
+    """
+    Replica views read the ems tables from a replica unless the browser
+    has just written something
+    """
+    def test_replica_reads(self):
+        router = routers.ReplicaRouter()
+        request = RequestFactory().get('/')
+        with routers.replica_reads(request):
+            self.assertEqual(router.db_for_read(Event), 'replica')
+            self.assertEqual(routers.read_alias(), 'replica')
+            self.assertEqual(router.db_for_read(User), None)
+        self.assertEqual(router.db_for_read(Event), None)
+        request.COOKIES[routers.PIN_COOKIE] = '1'
+        with routers.replica_reads(request):
+            self.assertEqual(router.db_for_read(Event), None)
+        self.assertFalse(router.allow_syncdb('replica', Event))
+
+    def replica_names(self, **cookies):
+        for name, value in cookies.items():
+            self.client.cookies[name] = value
+        response = self.client.get(reverse('all_events_data'), DATATABLE_PARAMS)
+        return [row['name'] for row in json.loads(response.content.decode('utf-8'))['aaData']]
+
+    def test_views_read_from_replica(self):
+        # A second SQLite database stands in for the replica, holding an
+        # event the default database does not have
+        replica_file = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        replica_file.close()
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': replica_file.name}
+        try:
+            with self.settings(EMS_READ_REPLICAS=[]):
+                # Replicas are left out of syncdb
+                call_command('syncdb', database='replica', interactive=False, verbosity=0)
+                self.assertEqual(self.replica_names(), ['Bench Event'])
+            Category.objects.using('replica').bulk_create([Category(pk=self.category.pk, name='Benchmarks')])
+            Location.objects.using('replica').bulk_create([Location(pk=self.location.pk, name='Bench Hall', capacity=0)])
+            Event.objects.using('replica').bulk_create([Event(pk=self.event.pk + 1000, creator_id=self.user.pk,
+                                                              category_id=self.category.pk, name='Replicated')])
+            now = timezone.now()
+            Reservation.objects.using('replica').bulk_create([
+                Reservation(event_id=self.event.pk + 1000, location_id=self.location.pk, start_datetime=now,
+                            end_datetime=now + timedelta(hours=1), status=status_const.APPROVED)])
+            self.assertEqual(self.replica_names(), ['Replicated'])
+            self.assertEqual(self.replica_names(**{routers.PIN_COOKIE: '1'}), ['Bench Event'])
+        finally:
+            connections['replica'].close()
+            del connections.databases['replica']
+            delattr(connections._connections, 'replica')
+            os.remove(replica_file.name)
+
+    def test_writes_pin_to_primary(self):
+        response = self.client.get(reverse('all_events'))
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+        other = Event.objects.create(creator=self.user, category=self.category, name='Other')
+        Reservation.objects.create(event=other, location=self.location, start_datetime=timezone.now(),
+                                   end_datetime=timezone.now() + timedelta(hours=1), status=status_const.APPROVED)
+        response = self.client.get(reverse('attend', args=[other.id]))
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], routers.replica_lag())
+
+
+@override_settings(EMS_SHARED_CACHE=True, SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+class CachedSessionTest(BenchmarkTestCase):
+    """
+    With a shared cache, logged in requests read the session and the user
+    from the cache
+    """
+    def auth_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('all_events'))
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in queries.captured_queries
+                if 'django_session' in query['sql'] or 'auth_user' in query['sql']]
+
+    def test_session_and_user_cached(self):
+        self.auth_queries()
+        self.assertEqual(self.auth_queries(), [])
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.assertEqual(len(self.auth_queries()), 1)
+        self.assertEqual(self.auth_queries(), [])
+
+    @override_settings(EMS_SHARED_CACHE=False, SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_unshared_cache_reads_database(self):
+        self.auth_queries()
+        self.assertEqual(len(self.auth_queries()), 2)
+
+
+class AssetTest(TestCase):
+    """
+    Bundles keep their stylesheets' references working, and unused select2
+    locales are not collected
+    """
+    def read(self, path):
+        with open(os.path.join(settings.BASE_DIR, 'static', path), 'rb') as static_file:
+            return static_file.read()
+
+    def test_bundle_rebases_urls(self):
+        css = assets.concatenate('bundles/site.css', self.read)
+        self.assertIn("url('../plugins/fancybox/blank.gif')", css)
+        self.assertIn("url(../img/devoops_pattern_b10.png)", css)
+        self.assertIn("url('../fonts/glyphicons-halflings-regular.eot?#iefix')", css)
+        self.assertNotIn('/*', css)
+
+    @override_settings(EMS_SELECT2_LOCALES=['de'])
+    def test_unused_locales_skipped(self):
+        paths = [path.replace(os.sep, '/') for path, storage in assets.StaticFinder().list(['CVS', '.*', '*~'])]
+        self.assertIn('plugins/select2/select2.min.js', paths)
+        self.assertIn('plugins/select2/select2_locale_de.js', paths)
+        self.assertNotIn('plugins/select2/select2_locale_fr.js', paths)
+
+    @override_settings(EMS_BUNDLE_ASSETS=False)
+    def test_unbundled_sources(self):
+        self.assertEqual(assets.sources('bundles/datatables.js'), assets.BUNDLES['bundles/datatables.js'])
+
+    @override_settings(EMS_BUNDLE_ASSETS=True)
+    def test_uncollected_bundle_falls_back(self):
+        self.assertEqual(assets.sources('bundles/datatables.js'), assets.BUNDLES['bundles/datatables.js'])
+
+
+class LoadTestReportTest(TestCase):
+    """
+    Load test results are summarized per route with exact percentiles
+    """
+    def test_mix(self):
+        self.assertEqual(loadtest.parse_mix('browse=3, approve=0,search=1'), [('browse', 3), ('search', 1)])
+        self.assertRaises(loadtest.LoadTestError, loadtest.parse_mix, 'browse=3,dance=1')
+
+    def test_report(self):
+        results = loadtest.Results()
+        for milliseconds in range(1, 101):
+            results.record('event_details', milliseconds, 200)
+        results.record('attend', 5, 500)
+        report = results.report(10, clients=2)
+        details = report['routes']['event_details']
+        self.assertEqual((details['requests'], details['p50_ms'], details['p99_ms'], details['max_ms']), (100, 50, 99, 100))
+        self.assertEqual(details['throughput'], 10)
+        self.assertEqual(report['routes']['attend']['errors'], 1)
+        self.assertEqual(report['total']['requests'], 101)
+        self.assertEqual(report['clients'], 2)
+        self.assertEqual(len(loadtest.format_report(report, report)), 4)
+
+    def test_no_seeding_by_default(self):
+        # Without --seed-data nothing is written, and there is no data to run over
+        self.assertRaises(CommandError, call_command, 'loadtest', duration=0, warmup=0, stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(User.objects.exists())
+
+
+@override_settings(EMS_SHARED_CACHE=True, SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+class FragmentConditionTest(BenchmarkTestCase):
+    """
+    Unchanged fragments answer conditional GETs with 304, and with a shared
+    cache holding the session and user, with no queries
+    """
+    def test_not_modified(self):
+        url = reverse('my_events')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url)['ETag'], etag)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries.captured_queries), 0)
+
+        other = User.objects.create_user('other', 'other@example.com', 'other')
+        Attendance.objects.create(user=other, event=self.event, date_registered=timezone.now())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_event_details_pages(self):
+        url = reverse('event_details', args=[self.event.id])
+        self.assertNotEqual(self.client.get(url)['ETag'], self.client.get(url, {'page': 2})['ETag'])
+
+
+class RecurrenceTest(BenchmarkTestCase):
+    """
+    A series is expanded per window, with its exceptions, and books its
+    location on every date
+    """
+    def setUp(self):
+        super(RecurrenceTest, self).setUp()
+        self.start = timezone.now().replace(microsecond=0) + timedelta(days=10)
+        self.series_event = Event.objects.create(creator=self.user, category=self.category, name='Weekly')
+        self.reservation = Reservation.objects.create(event=self.series_event, location=self.location,
+                                                      start_datetime=self.start, end_datetime=self.start + timedelta(hours=1),
+                                                      status=status_const.APPROVED)
+        rule = recurrence.parse('FREQ=WEEKLY;COUNT=4')
+        self.series = Recurrence.objects.create(reservation=self.reservation, rule=recurrence.build(rule.freq, count=4),
+                                                last_end=recurrence.last_end(self.start, self.start + timedelta(hours=1), rule))
+
+    def window(self):
+        return recurrence.expand(Reservation.objects.filter(pk=self.reservation.pk),
+                                 self.start - timedelta(days=1), self.start + timedelta(days=60))
+
+    def test_weekly(self):
+        occurrences = self.window()
+        self.assertEqual(len(occurrences), 4)
+        self.assertEqual(occurrences[0].start_datetime, self.start)
+        self.assertEqual(set(timezone.localtime(occurrence.start_datetime).weekday() for occurrence in occurrences),
+                         set([timezone.localtime(self.start).weekday()]))
+        self.assertEqual(recurrence.describe(recurrence.parse(self.series.rule)), 'Every week, 4 times')
+
+    def test_cancel(self):
+        original_start = self.window()[1].original_start
+        self.assertTrue(recurrence.is_occurrence(self.series, original_start))
+        self.assertFalse(recurrence.is_occurrence(self.series, original_start + timedelta(hours=1)))
+        recurrence.cancel(self.series, original_start)
+        self.assertEqual(len(self.window()), 3)
+
+    def test_cancel_requires_post(self):
+        original_start = self.window()[1].original_start
+        url = reverse('cancel_occurrence', args=[self.series_event.id])
+        start = original_start.astimezone(timezone.utc).strftime(OCCURRENCE_FORMAT)
+        self.assertEqual(self.client.get(url, {'start': start}).status_code, 405)
+        self.assertEqual(len(self.window()), 4)
+        self.assertEqual(self.client.post(url, {'start': start}).status_code, 302)
+        self.assertEqual(len(self.window()), 3)
+
+    def test_shift_keeps_exceptions(self):
+        recurrence.cancel(self.series, self.window()[1].original_start)
+        new_start = self.start + timedelta(days=1)
+        recurrence.shift(self.series, self.start, new_start)
+        Reservation.objects.filter(pk=self.reservation.pk).update(start_datetime=new_start,
+                                                                  end_datetime=new_start + timedelta(hours=1))
+        self.reservation = Reservation.objects.get(pk=self.reservation.pk)
+        self.series = Recurrence.objects.get(pk=self.series.pk)
+        occurrences = self.window()
+        self.assertEqual(len(occurrences), 3)
+        self.assertEqual(occurrences[1].original_start, new_start + timedelta(weeks=2))
+
+    def test_skip_matches_walk(self):
+        since = timezone.make_aware(datetime(2026, 7, 4, 8, 0), timezone.get_current_timezone())
+        for first_start in (since - timedelta(days=900), timezone.make_aware(datetime(2024, 1, 31, 9, 0), timezone.get_current_timezone())):
+            for text in ('FREQ=DAILY;INTERVAL=3', 'FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,TH,SU', 'FREQ=MONTHLY',
+                         'FREQ=MONTHLY;INTERVAL=5', 'FREQ=DAILY;COUNT=950', 'FREQ=WEEKLY;BYDAY=TU,SA;COUNT=260'):
+                rule = recurrence.parse(text)
+                walked = (start for start in recurrence.starts(first_start, rule) if start >= since)
+                skipped = (start for start in recurrence.starts(first_start, rule, since) if start >= since)
+                self.assertEqual(list(islice(skipped, 5)), list(islice(walked, 5)), text)
+
+    def test_all_events_dated_by_first_start(self):
+        # The table is sorted by first start, so a series shows that date and names its next one
+        Reservation.objects.filter(pk=self.reservation.pk).update(start_datetime=self.start - timedelta(weeks=2),
+                                                                 end_datetime=self.start - timedelta(weeks=2, hours=-1))
+        later = Event.objects.create(creator=self.user, category=self.category, name='Later')
+        Reservation.objects.create(event=later, location=self.location, start_datetime=self.start - timedelta(days=1),
+                                   end_datetime=self.start - timedelta(hours=23), status=status_const.APPROVED)
+        params = dict(DATATABLE_PARAMS, iSortingCols=1, iSortCol_0=3, sSortDir_0='asc')
+        rows = json.loads(self.client.get(reverse('all_events_data'), params).content.decode())['aaData']
+        rows = [row for row in rows if row['name'] in ('Weekly', 'Later')]
+        self.assertEqual([row['name'] for row in rows], ['Weekly', 'Later'])
+        first_date = formats.date_format(timezone.localtime(self.start - timedelta(weeks=2)).date())
+        self.assertTrue(rows[0]['date'].startswith(first_date + ' (Every week, 4 times, next '))
+
+    def test_conflicts(self):
+        original_start = self.window()[2].original_start
+        third = original_start + timedelta(minutes=30)
+        self.assertTrue(booking.busy([self.location.id], third, third + timedelta(hours=1), ()))
+        self.assertRaises(booking.BookingConflict, booking.ensure_available, self.location.id, third, third + timedelta(hours=1))
+        recurrence.cancel(self.series, original_start)
+        booking.ensure_available(self.location.id, third, third + timedelta(hours=1))
+
+
+class ProvisionTest(BenchmarkTestCase):
+    """
+    Rosters are provisioned in bulk, and usernames and emails stay unique
+    ignoring case
+    """
+    def test_provision(self):
+        roster = ['username,email,first_name,last_name,password',
+                  'ada,ada@example.com,Ada,Lovelace,secret',
+                  'ADA,other@example.com,,,',
+                  'Bench,new@example.com,,,',
+                  'grace,BENCH@example.com,,,',
+                  'not a name!,x@example.com,,,',
+                  'linus,linus@example.com,,,']
+        rejects = []
+        created, rejected = accounts.provision(accounts.read_roster(roster), batch_size=2, processes=1,
+                                               on_reject=lambda line, reason: rejects.append(line))
+        self.assertEqual((created, rejected), (2, 4))
+        self.assertEqual(sorted(rejects), [3, 4, 5, 6])
+        self.assertTrue(User.objects.get(username='ada').check_password('secret'))
+        self.assertFalse(User.objects.get(username='linus').has_usable_password())
+        self.assertEqual(UserKey.objects.get(user__username='ada').email, 'ada@example.com')
+
+    def test_case_duplicates(self):
+        # Accounts made before the keys existed may differ only by case
+        User.objects.bulk_create([User(username='BENCH')])
+        duplicate = User.objects.get(username='BENCH')
+        self.assertFalse(UserKey.objects.filter(user=duplicate).exists())
+        duplicate.save(update_fields=['last_login'])
+        self.assertRaises(IntegrityError, transaction.atomic()(duplicate.save))
+        count, duplicates = accounts.rebuild_keys()
+        self.assertEqual([user.pk for user in duplicates], [duplicate.pk])
+        self.assertEqual(count, User.objects.count() - 1)
+        self.assertEqual(UserKey.objects.get(username='bench').user_id, self.user.id)
+
+    def test_case_variant_rejected(self):
+        self.assertRaises(IntegrityError, transaction.atomic()(User.objects.create), username='Bench')
+        other = User.objects.create(username='other')
+        other.username = 'BENCH'
+        self.assertRaises(IntegrityError, transaction.atomic()(other.save))
+        other.username = 'Other2'
+        other.save()
+        self.assertEqual(UserKey.objects.get(user=other).username, 'other2')
+        self.assertFalse(UserKey.objects.filter(username='other').exists())
+
+    def test_registration_race(self):
+        # A registration in another case that commits after this one's form
+        # was checked makes the key insert fail, and rolls back the user
+        username_taken = accounts.username_taken
+        accounts.username_taken = lambda username: False
+        try:
+            response = self.client.post(reverse('register'), {'first_name': 'B', 'last_name': 'B', 'username': 'BENCH',
+                                                              'email': 'race@example.com', 'password1': 'x', 'password2': 'x'})
+        finally:
+            accounts.username_taken = username_taken
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('username', response.context['form'].errors)
+        self.assertFalse(User.objects.filter(username='BENCH').exists())
+
+    def test_registration_form(self):
+        form = RegistrationForm({'first_name': 'B', 'last_name': 'B', 'username': 'BENCH', 'email': 'Bench@Example.com',
+                                 'password1': 'x', 'password2': 'x'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('username', form.errors)
+        self.assertIn('email', form.errors)
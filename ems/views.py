@@ -1,19 +1,73 @@
+import hashlib
+import json
 from datetime import datetime, timedelta
 from django.utils import timezone
 
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import Http404, HttpResponse
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition, require_POST
+from django.views.decorators.vary import vary_on_cookie
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.models import User
 from django.db import transaction, IntegrityError, connection
 from django.contrib import messages
-from django.db.models import Q
-from ems.forms import RegistrationForm, EventCreationForm, EventEditForm, ReservationEditForm, QueryForm, SummaryReportForm, SearchForm
-from ems.models import Event, Reservation, Location, Approval, Attendance, Category
+from django.utils import formats
+from django.utils.encoding import force_text
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from ems.forms import RegistrationForm, EventCreationForm, EventEditForm, ReservationEditForm, QueryForm, SummaryReportForm, SearchForm, AvailabilityForm
+from ems.forms import RosterExportForm
+from ems.forms import CHOICE_MODELS, cached_choices
+from ems.models import Event, Reservation, Location, Approval, Attendance, Category, Recurrence
+from ems.reports import summary_data
+from ems.paging import keyset_page
+from ems import booking, caching, export, feeds, jobs, moderation, recurrence, registration, roster, rollups, search
+from ems.routers import use_replica
 from ems import status_const # constants for reservation status
 
+# --------------------- List querysets ---------------------------
+# Each list table is fetched with the related rows it shows joined in and
+# only the columns its template reads, so a page costs the same number of
+# queries however many rows it has.
+
+def event_rows(events):
+    """
+    Events with their category, reservation and location
+    """
+    return events.select_related('category', 'reservation__location') \
+                .only('name', 'description', 'attendee_count', 'category', 'category__name',
+                      'reservation__event', 'reservation__start_datetime', 'reservation__end_datetime',
+                      'reservation__status', 'reservation__location', 'reservation__location__name')
+
+def attendance_event_rows(attendance):
+    """
+    Attendance with the event, category, reservation and location of each row
+    """
+    return attendance.select_related('event__category', 'event__reservation__location') \
+                .only('event', 'event__name', 'event__description', 'event__category', 'event__category__name',
+                      'event__reservation__event', 'event__reservation__start_datetime', 'event__reservation__end_datetime',
+                      'event__reservation__location', 'event__reservation__location__name')
+
+def attendance_user_rows(attendance):
+    """
+    Attendance with the username of each attendee
+    """
+    return attendance.select_related('user').only('prepaid', 'date_registered', 'user', 'user__username')
+
+def reservation_rows(reservations):
+    """
+    Reservations with their event and category
+    """
+    return reservations.select_related('event__category') \
+                .only('start_datetime', 'end_datetime', 'event', 'event__name', 'event__description',
+                      'event__category', 'event__category__name')
+
+
 @login_required
 def dashboard(request, template_name='base.html'):
     """
@@ -22,6 +76,50 @@ def dashboard(request, template_name='base.html'):
     return render(request, template_name, {'user':request.user})
 
 
+# ------------------ Conditional GET for fragments ------------------
+# The AJAX fragments carry an ETag and Last-Modified built from the cache
+# versions of what they show (see ems.caching) and of the user they are
+# rendered for, so reloading an unchanged tab is answered with a 304 before
+# any query runs.
+
+def fragment_condition(sources):
+    """
+    Decorator answering conditional GETs for a fragment view. sources is
+    called with the view's arguments and returns the (kind, pk) versions
+    the fragment is built from, or None to always render it.
+    """
+    def items(request, *args, **kwargs):
+        # Queued messages are shown once, so the page must be rendered
+        if len(messages.get_messages(request)):
+            return None
+        found = sources(request, *args, **kwargs)
+        if found is None:
+            return None
+        return [('account', request.user.id)] + list(found)
+
+    def etag(request, *args, **kwargs):
+        found = items(request, *args, **kwargs)
+        if found is None:
+            return None
+        parts = [request.user.id, request.get_full_path()] + [caching.get_version(kind, pk) for kind, pk in found]
+        return hashlib.md5(':'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def last_modified(request, *args, **kwargs):
+        found = items(request, *args, **kwargs)
+        if found is None:
+            return None
+        times = [caching.last_modified(kind, pk) for kind, pk in found]
+        if None in times:
+            return None
+        return datetime.utcfromtimestamp(max(times))
+
+    def decorator(view):
+        # no-cache makes browsers revalidate every time instead of guessing
+        # a lifetime from Last-Modified
+        return vary_on_cookie(cache_control(private=True, no_cache=True)(condition(etag, last_modified)(view)))
+    return decorator
+
+
 # --------------------- User Login/Registration ---------------------------
 @login_required
 def logout(request):
@@ -46,11 +144,18 @@ def register_user(request, template_name= 'registration/registration_form.html')
             email = form.cleaned_data['email']
             password = form.cleaned_data['password1']
             test = {'username':username, 'email':email, 'original':original}
-            User.objects.create_user(username=username, email=email, password=password,
-                        first_name=first_name, last_name=last_name)
-            new_user = authenticate(username=username, password=password)
-            login(request, new_user)
-            return redirect('dashboard')
+            try:
+                # The user's key is written by a post_save receiver; its unique
+                # username catches a registration racing this one in another case
+                with transaction.atomic():
+                    User.objects.create_user(username=username, email=email, password=password,
+                                first_name=first_name, last_name=last_name)
+            except IntegrityError:
+                form._errors['username'] = form.error_class(["A user with that username already exists."])
+            else:
+                new_user = authenticate(username=username, password=password)
+                login(request, new_user)
+                return redirect('dashboard')
     else:
         form = RegistrationForm()
 
@@ -61,20 +166,24 @@ def register_user(request, template_name= 'registration/registration_form.html')
  # --------------- Events ---------------------   
 
 @login_required
+@fragment_condition(lambda request: [('user', request.user.id), ('names', 0)])
 def my_events(request, template_name="ajax/my_events.html"):
     """
     View all events created by the user
     """
-    event_list = Event.objects.filter(creator=request.user)
-    attend_list = Attendance.objects.filter(user=request.user)
-    return render(request, template_name, {'event_list':event_list, 'attend_list':attend_list})
+    event_list = event_rows(Event.objects.filter(creator=request.user))
+    attend_list = attendance_event_rows(Attendance.objects.filter(user=request.user))
+    return render(request, template_name, {'event_list':event_list, 'attend_list':attend_list,
+                                           'feed_urls':feeds.urls('user', request.user.id)})
 
 @login_required
+@use_replica
+@fragment_condition(lambda request: [])
 def all_events(request, template_name="ajax/all_events.html"):
     """
-    View all approved events/reservations
+    View all approved events/reservations. The table rows are fetched
+    page by page from all_events_data.
     """
-    reservation_list = Reservation.objects.filter(status=status_const.APPROVED)
     search_term = ""
     if request.method == 'GET' and 'search_term' in request.GET:
         form = SearchForm(request.GET)
@@ -82,9 +191,161 @@ def all_events(request, template_name="ajax/all_events.html"):
             search_term = form.cleaned_data['search_term']
     else:
         form = SearchForm()
+    return render(request, template_name, {'form':form, 'search_term':search_term})
+
+
+# Sortable all_events table columns and the field each one orders by
+ALL_EVENTS_SORT_FIELDS = {0: 'event__name', 1: 'event__category__name', 3: 'start_datetime', 4: 'start_datetime', 5: 'location__name'}
+ALL_EVENTS_MAX_PAGE = 100
+
+def _int_param(params, name, default):
+    try:
+        return int(params[name])
+    except (KeyError, ValueError):
+        return default
+
+@login_required
+@use_replica
+def all_events_data(request):
+    """
+    DataTables (1.9) server-side processing endpoint for the all events table.
+
+    Pages are read with keyset pagination on (sort field, id). The client
+    echoes back the cursor from the previous response so that paging
+    forward does not have to locate the page start again. Searches that no
+    column sort was asked for are paged best match first.
+
+    The total number of events is read from the rollups (see ems.rollups),
+    which are only right once rebuild_rollups has run on an existing
+    database; while they count no approved events, the events are counted.
+    """
+    params = request.GET
+    start = max(_int_param(params, 'iDisplayStart', 0), 0)
+    length = _int_param(params, 'iDisplayLength', 25)
+    if length < 1 or length > ALL_EVENTS_MAX_PAGE:
+        length = ALL_EVENTS_MAX_PAGE
+    sort_field = ALL_EVENTS_SORT_FIELDS.get(_int_param(params, 'iSortCol_0', 3), 'start_datetime')
+    descending = params.get('sSortDir_0') == 'desc'
+    search_term = params.get('sSearch', '').strip()
+    column_sorted = 'iSortCol_0' in params and _int_param(params, 'iSortingCols', 1) > 0
+
+    reservations = Reservation.objects.filter(status=status_const.APPROVED)
+    total = rollups.event_total(status_const.APPROVED) or reservations.count()
+    filtered = total
     if search_term:
-        reservation_list = event_search(search_term)
-    return render(request, template_name, {'reservation_list':reservation_list, 'form':form})
+        event_ids = search.search(search_term)
+        filtered = len(event_ids)
+        if not column_sorted:
+            # The ranked ids are already in order and limited, so page them directly
+            event_ids = event_ids[start:start + length]
+        reservations = reservations.filter(event__in=event_ids)
+
+    cursor_key = '%s:%s:%s' % (sort_field, descending, search_term)
+    after = None
+    if params.get('sCursorKey') == cursor_key and _int_param(params, 'iCursorStart', -1) == start:
+        after = _int_param(params, 'iCursorId', None)
+
+    reservations = reservations.select_related('event', 'event__category', 'location') \
+                    .only('start_datetime', 'end_datetime', 'event', 'location',
+                          'event__name', 'event__description', 'event__category', 'event__category__name', 'location__name')
+    if search_term and not column_sorted:
+        rank = dict((event_id, position) for position, event_id in enumerate(event_ids))
+        rows = sorted(reservations, key=lambda reservation: rank[reservation.event_id])
+    else:
+        rows = keyset_page(reservations, sort_field, descending, start, length, after)
+
+    # A series is one row, dated by its first occurrence as the rows are
+    # sorted, with how it repeats and when it next takes place
+    series = recurrence.load([reservation.id for reservation in rows]) if rows else {}
+    now = timezone.now()
+    data = []
+    for reservation in rows:
+        repeats = ''
+        if reservation.id in series:
+            rule, exceptions = series[reservation.id]
+            repeats = recurrence.describe(rule)
+            upcoming = recurrence.next_occurrence(reservation, rule, exceptions, now)
+            if upcoming is not None and upcoming.start_datetime != reservation.start_datetime:
+                repeats += ', next %s' % formats.date_format(timezone.localtime(upcoming.start_datetime).date())
+            repeats = ' (%s)' % repeats
+        start_datetime = timezone.localtime(reservation.start_datetime)
+        end_datetime = timezone.localtime(reservation.end_datetime)
+        date = formats.date_format(start_datetime.date())
+        if start_datetime.date() != end_datetime.date():
+            date = '%s - %s' % (date, formats.date_format(end_datetime.date()))
+        date += repeats
+        data.append({
+            'name': escape(reservation.event.name),
+            'category': escape(reservation.event.category.name),
+            'description': escape(reservation.event.description_short()),
+            'date': date,
+            'time': '%s - %s' % (formats.time_format(start_datetime.time()), formats.time_format(end_datetime.time())),
+            'location': escape(reservation.location.name),
+            'url': reservation.event.get_absolute_url(),
+        })
+
+    response = {'sEcho': _int_param(params, 'sEcho', 0), 'iTotalRecords': total, 'iTotalDisplayRecords': filtered, 'aaData': data}
+    if rows:
+        response['cursor'] = {'start': start + len(rows), 'id': rows[-1].pk, 'key': cursor_key}
+    return HttpResponse(json.dumps(response), content_type='application/json')
+
+CHOICES_PER_PAGE = 30
+
+@login_required
+def choice_search(request, model_name):
+    """
+    Options matching a search term, for the select2 search boxes that
+    replace long selects (see CachedChoiceSelect). Served from the cached
+    choice list, so typing never reaches the database.
+    """
+    model = CHOICE_MODELS.get(model_name)
+    if model is None:
+        raise Http404
+    term = request.GET.get('q', '').strip().lower()
+    page = max(_int_param(request.GET, 'page', 1), 1)
+    matches = [{'id': pk, 'text': name} for pk, name in cached_choices(model) if term in name.lower()]
+    start = (page - 1) * CHOICES_PER_PAGE
+    response = {'results': matches[start:start + CHOICES_PER_PAGE], 'more': len(matches) > start + CHOICES_PER_PAGE}
+    return HttpResponse(json.dumps(response), content_type='application/json')
+
+
+def _format_slot(start, end):
+    start, end = timezone.localtime(start), timezone.localtime(end)
+    if start.date() == end.date():
+        return '%s %s - %s' % (formats.date_format(start.date()), formats.time_format(start.time()),
+                               formats.time_format(end.time()))
+    return '%s %s - %s %s' % (formats.date_format(start.date()), formats.time_format(start.time()),
+                              formats.date_format(end.date()), formats.time_format(end.time()))
+
+def suggest_slots(request, location_id, start_datetime, end_datetime):
+    """
+    Add messages suggesting free times at the location and free locations
+    at the time after a booking conflict
+    """
+    slots, locations = booking.suggestions(location_id, start_datetime, end_datetime)
+    if slots:
+        messages.info(request, "%s is free %s." % (dict(cached_choices(Location)).get(location_id),
+                                                   ', '.join(_format_slot(*slot) for slot in slots)))
+    if locations:
+        messages.info(request, "Free at that time: %s." % ', '.join(other['name'] for other in locations))
+
+@login_required
+def availability(request):
+    """
+    Free slots per location as JSON. Takes start_datetime, end_datetime,
+    min_duration (minutes, default 60) and an optional minimum capacity.
+    """
+    form = AvailabilityForm(request.GET)
+    if not form.is_valid():
+        errors = dict((field, [force_text(error) for error in field_errors]) for field, field_errors in form.errors.items())
+        return HttpResponse(json.dumps({'errors': errors}), status=400, content_type='application/json')
+    data = form.cleaned_data
+    results = booking.free_slots(data['start_datetime'], data['end_datetime'],
+                                 timedelta(minutes=data['min_duration']), data['capacity'])
+    locations = [dict(location, slots=[{'start': start.isoformat(), 'end': end.isoformat()} for start, end in slots])
+                 for location, slots in results if slots]
+    return HttpResponse(json.dumps({'locations': locations}), content_type='application/json')
+
 
 @login_required
 def create_event(request, template_name="ajax/create_event.html"):
@@ -96,9 +357,9 @@ def create_event(request, template_name="ajax/create_event.html"):
         if form.is_valid():
             creator = request.user
             name = form.cleaned_data['name']
-            category = form.cleaned_data['category']
+            category_id = form.cleaned_data['category']
             description = form.cleaned_data['description']
-            location = form.cleaned_data['location']
+            location_id = form.cleaned_data['location']
             is_public = form.cleaned_data['is_public']
             start_datetime = form.cleaned_data['start_datetime']
             end_datetime = form.cleaned_data['end_datetime']
@@ -106,12 +367,17 @@ def create_event(request, template_name="ajax/create_event.html"):
             staff_fee = form.cleaned_data['staff_fee']
             public_fee = form.cleaned_data['public_fee']
             prepay = form.cleaned_data['prepay']
+            rule = form.cleaned_data['rule']
 
             try:
                 with transaction.atomic():
+                    if rule:
+                        booking.ensure_series_available(location_id, start_datetime, end_datetime, recurrence.parse(rule))
+                    else:
+                        booking.ensure_available(location_id, start_datetime, end_datetime)
                     event = Event(creator=creator,
                                         name=name, 
-                                        category=category,
+                                        category_id=category_id,
                                         description=description,
                                         is_public=is_public,
                                         student_fee=student_fee,
@@ -120,11 +386,19 @@ def create_event(request, template_name="ajax/create_event.html"):
                                         prepay=prepay)
                     event.save()
                     reservation = Reservation(event=event,
-                                                location=location,
+                                                location_id=location_id,
                                                 start_datetime=start_datetime,
                                                 end_datetime=end_datetime)
                     reservation.save()
+                    if rule:
+                        Recurrence.objects.create(reservation=reservation, rule=rule,
+                                                  last_end=recurrence.last_end(start_datetime, end_datetime,
+                                                                               recurrence.parse(rule)))
+                    rollups.add(rollups.snapshot(event))
                     return redirect("my_events")
+            except booking.BookingConflict:
+                messages.error(request, "Error: %s is already booked at that time." % form.fields['location'].choice_label(location_id))
+                suggest_slots(request, location_id, start_datetime, end_datetime)
             except Exception as e: 
                 messages.error(request, "%s: Event could not be created" % e)
     else:
@@ -132,29 +406,107 @@ def create_event(request, template_name="ajax/create_event.html"):
     return render(request, template_name, {'form':form, 'redirect_url':reverse('my_events')})
 
 
+# Upcoming occurrences of a recurring event listed on its details page
+EVENT_OCCURRENCES = 10
+
+# How the occurrence to cancel is named in URLs: its original start in UTC
+OCCURRENCE_FORMAT = '%Y%m%dT%H%M%SZ'
+
+def event_details_data(event_id, page=1):
+    """
+    The parts of the event details page that are the same for every user:
+    the rendered details rows and one page of the attendee list, plus the
+    fields the view needs to work out permissions. Cached under the event's
+    version, which the receivers in ems.signals bump whenever the event,
+    its reservation, its location or its attendance changes.
+    """
+    today = timezone.localtime(timezone.now()).date()
+    key = caching.versioned_key('event_details', 'event', event_id, page, today)
+    details = cache.get(key)
+    if details is None:
+        event = get_object_or_404(Event.objects.select_related('creator', 'category', 'reservation__location'), pk=event_id)
+        attendance_list, has_next = roster.page(attendance_user_rows(Attendance.objects.filter(event_id=event.id)), page)
+        capacity = event.reservation.location.capacity
+        seats_left = registration.seats_left(event, capacity)
+        context = {'event':event, 'attendance_list':attendance_list, 'capacity':capacity, 'seats_left':seats_left,
+                   'page':page, 'previous_page':page - 1, 'next_page':page + 1 if has_next else None}
+        occurrences = []
+        series = recurrence.load([event.reservation.id]).get(event.reservation.id)
+        if series is not None:
+            rule, exceptions = series
+            context['repeats'] = recurrence.describe(rule)
+            now = timezone.now()
+            upcoming = recurrence.occurrences(event.reservation, rule, exceptions, now, now + timedelta(days=LOCATION_OCCURRENCE_DAYS))
+            occurrences = [{'start': occurrence.start_datetime, 'end': occurrence.end_datetime,
+                            'original_start': occurrence.original_start.astimezone(timezone.utc).strftime(OCCURRENCE_FORMAT)}
+                           for occurrence in upcoming[:EVENT_OCCURRENCES]]
+        details = {
+            'id': event.id,
+            'creator_id': event.creator_id,
+            'creator': event.creator.username,
+            'status': event.reservation.status,
+            'prepay': event.prepay,
+            'seats_left': seats_left,
+            'rows_html': render_to_string('include/event_details_rows.html', context),
+            'attendance_html': render_to_string('include/event_attendance.html', context),
+            'occurrences': occurrences,
+        }
+        cache.set(key, details, caching.CACHE_TIMEOUT)
+    details['rows_html'] = mark_safe(details['rows_html'])
+    details['attendance_html'] = mark_safe(details['attendance_html'])
+    return details
+
 
 @login_required
+@fragment_condition(lambda request, event_id: [('event', event_id), ('day', timezone.localtime(timezone.now()).date())])
 def event_details(request, event_id, template_name="ajax/event_details.html"):
     """
     View event and reservation details
     """
-    event = get_object_or_404(Event, pk=event_id)
-    attendance_list = Attendance.objects.filter(event_id=event.id)
-    permissions = {'creator':False, 'mod': False,  'prepay': False, 'attend':False}
+    details = event_details_data(event_id, max(_int_param(request.GET, 'page', 1), 1))
+    permissions = {'creator':False, 'mod': False,  'prepay': False, 'attend':False, 'export':False}
 
-    if request.user == event.creator:
+    if request.user.id == details['creator_id']:
         permissions['creator'] = True
-    if request.user.is_staff and event.reservation.status == status_const.PENDING:
+    if permissions['creator'] or request.user.is_staff:
+        permissions['export'] = True
+    if request.user.is_staff and details['status'] == status_const.PENDING:
         permissions['mod'] = True
-    if event.reservation.status == status_const.APPROVED:
-        user_register_count = Attendance.objects.filter(user=request.user, event=event).count()
-        if user_register_count == 0:
+    if details['status'] == status_const.APPROVED:
+        is_attending = Attendance.objects.filter(user=request.user, event=details['id']).exists()
+        if not is_attending and details['seats_left'] != 0:
             permissions['attend'] = True
-        if event.prepay:
+        if details['prepay']:
             permissions['prepay'] = True
 
-    return render(request, template_name, {'event':event, 'attendance_list':attendance_list, 'permissions':permissions})
+    return render(request, template_name, {'details':details, 'permissions':permissions, 'export_formats':export.FORMATS})
+
+
+@login_required
+def export_roster(request, event_id, fmt):
+    """
+    Download the full attendance roster of an event
+    """
+    event = get_object_or_404(Event.objects.only('id', 'creator'), pk=event_id)
+    if fmt not in export.FORMATS or (request.user.id != event.creator_id and not request.user.is_staff):
+        raise Http404
+    return export.response(roster.HEADER, roster.rows(roster.for_event(event.id)), 'roster-%d' % event.id, fmt)
+
 
+@login_required
+def export_rosters(request, fmt):
+    """
+    Download the attendance rosters of every event starting in a date range
+    """
+    if fmt not in export.FORMATS or not request.user.is_staff:
+        raise Http404
+    form = RosterExportForm(request.GET)
+    if not form.is_valid():
+        return HttpResponse(' '.join(force_text(error) for errors in form.errors.values() for error in errors),
+                            status=400, content_type='text/plain')
+    start, end = form.cleaned_data['start_datetime'], form.cleaned_data['end_datetime']
+    filename = 'rosters-%s-%s' % (start.strftime('%Y%m%d'), end.strftime('%Y%m%d'))
+    return export.response(roster.HEADER, roster.rows(roster.for_range(start, end)), filename, fmt)
 
 
 @login_required
@@ -167,11 +519,32 @@ def edit_event(request, event_id, template_name="ajax/edit_event.html"):
         form1 = EventEditForm(request.POST, instance=event)
         form2 = ReservationEditForm(request.POST, instance=event.reservation)
         if form1.is_valid() and form2.is_valid():
+            series = Recurrence.objects.filter(reservation=event.reservation).first()
             try:
                 with transaction.atomic():
+                    location_id = form2.cleaned_data['location']
+                    start_datetime = form2.cleaned_data['start_datetime']
+                    end_datetime = form2.cleaned_data['end_datetime']
+                    if series is not None:
+                        rule = recurrence.parse(series.rule)
+                        booking.ensure_series_available(location_id, start_datetime, end_datetime, rule, exclude_event=event.id)
+                        series.last_end = recurrence.last_end(start_datetime, end_datetime, rule)
+                    else:
+                        booking.ensure_available(location_id, start_datetime, end_datetime, exclude_event=event.id)
+                    before = rollups.snapshot(event)
                     form2.save()
                     form1.save()
+                    if series is not None:
+                        series.save()
+                        # The exceptions name occurrences by their old starts
+                        recurrence.shift(series, form2.initial['start_datetime'], start_datetime)
+                    rollups.replace(before, rollups.snapshot(event))
                 return redirect('my_events')
+            except booking.BookingConflict:
+                messages.error(request, "Error: %s is already booked at that time." %
+                               form2.fields['location'].choice_label(form2.cleaned_data['location']))
+                suggest_slots(request, form2.cleaned_data['location'], form2.cleaned_data['start_datetime'],
+                              form2.cleaned_data['end_datetime'])
             except Exception as e:
                 messages.error(request, "%s: Event could not be edited" % e)
 
@@ -181,6 +554,28 @@ def edit_event(request, event_id, template_name="ajax/edit_event.html"):
     return render(request, template_name, {'event_form':form1, 'reservation_form':form2, 'event_id':event.id, 'redirect_url':reverse('my_events')})
 
 
+@login_required
+@require_POST
+def cancel_occurrence(request, event_id):
+    """
+    Cancel one occurrence of a recurring event, named by its original
+    start in the posted start parameter
+    """
+    event = get_object_or_404(Event.objects.select_related('reservation'), pk=event_id)
+    series = get_object_or_404(Recurrence.objects.select_related('reservation'), reservation=event.reservation)
+    if request.user != event.creator and not request.user.is_staff:
+        raise Http404
+    try:
+        original_start = timezone.make_aware(datetime.strptime(request.POST.get('start', ''), OCCURRENCE_FORMAT), timezone.utc)
+    except ValueError:
+        raise Http404
+    if not recurrence.is_occurrence(series, original_start):
+        raise Http404
+    recurrence.cancel(series, original_start)
+    messages.info(request, "The %s occurrence was cancelled." % formats.date_format(timezone.localtime(original_start).date()))
+    return redirect('event_details', event_id=event.id)
+
+
 @login_required
 def delete_event(request, event_id):
     """
@@ -190,8 +585,12 @@ def delete_event(request, event_id):
     reservation = event.reservation
     if request.user == event.creator:
         with transaction.atomic():
+            attendees = list(event.attendance_set.exclude(user=event.creator).values_list('user', flat=True))
+            rollups.remove(rollups.snapshot(event))
             reservation.delete()
             event.delete()
+            if attendees:
+                jobs.enqueue('event_cancelled', name=event.name, user_ids=attendees)
     return redirect('my_events')
 
 
@@ -199,13 +598,14 @@ def delete_event(request, event_id):
 # Mod powers 
 
 @login_required
+@fragment_condition(lambda request: [('event', caching.ALL)] if request.user.is_staff else None)
 def pending_events(request, template_name="ajax/pending_events.html"):
     """
     View all events that need approval/denial
     """
     if not request.user.is_staff:
         raise Http404
-    pending_list = Event.objects.filter(reservation__status=status_const.PENDING)
+    pending_list = event_rows(Event.objects.filter(reservation__status=status_const.PENDING))
     return render(request, template_name, {'pending_list': pending_list})
 
 
@@ -216,17 +616,10 @@ def approve_event(request, event_id):
     """
     if not request.user.is_staff:
         raise Http404
-    event = get_object_or_404(Event, pk=event_id)
-    event.reservation.status = status_const.APPROVED
-    event.reservation.save()
-    date = timezone.now()
-    new_attendee = Attendance(user=event.creator, 
-                                                event=event,
-                                                prepaid=False,
-                                                date_registered=date
-                                                )
-    new_attendee.save()
-
+    event = get_object_or_404(Event.objects.select_related('reservation'), pk=event_id)
+    if not moderation.moderate([event.id], status_const.APPROVED, request.user) \
+            and event.reservation.status == status_const.DENIED:
+        messages.error(request, "%s was not approved: its location is booked at that time." % event.name)
     return redirect('pending_events') 
 
 
@@ -238,12 +631,30 @@ def deny_event(request, event_id):
     if not request.user.is_staff:
         raise Http404
     event = get_object_or_404(Event, pk=event_id)
-    event.reservation.status = status_const.DENIED
-    event.reservation.save()
+    moderation.moderate([event.id], status_const.DENIED, request.user)
+    return redirect('pending_events')
+
+
+@login_required
+def moderate_events(request):
+    """
+    Approve or deny every event selected on the pending events page at once
+    """
+    if not request.user.is_staff:
+        raise Http404
+    if request.method == 'POST':
+        status = {'approve': status_const.APPROVED, 'deny': status_const.DENIED}.get(request.POST.get('action'))
+        event_ids = [event_id for event_id in request.POST.getlist('event_ids') if event_id.isdigit()]
+        if status is None or not event_ids:
+            messages.error(request, "Select the events to approve or deny.")
+        else:
+            changed = moderation.moderate(event_ids, status, request.user)
+            messages.info(request, "%d event(s) %s." % (len(changed), status.lower()))
     return redirect('pending_events')
 
 
 @login_required
+@use_replica
 def summary_report(request, template_name="ajax/summary_report.html"):
     """
     View summary report of events
@@ -251,44 +662,22 @@ def summary_report(request, template_name="ajax/summary_report.html"):
     if not request.user.is_staff:
         raise Http404
 
-    week_start_datetime = datetime.now()
-    week_start_datetime = week_start_datetime.replace(tzinfo=timezone.utc)
+    start_datetime = datetime.now()
+    start_datetime = start_datetime.replace(tzinfo=timezone.utc)
+    end_datetime = start_datetime + timedelta(days=7)
 
     if request.method == 'POST':
         form = SummaryReportForm(request.POST)
         if form.is_valid():
-            week_start_datetime = form.cleaned_data['week_start_datetime']
+            start_datetime = form.cleaned_data['start_datetime']
+            end_datetime = form.cleaned_data['end_datetime']
     else:
         form = SummaryReportForm()
-    week_end_datetime = week_start_datetime + timedelta(days=7)
-
-    total_event_count = Event.objects.filter(reservation__start_datetime__gte=week_start_datetime, reservation__start_datetime__lte=week_end_datetime).count()
-    approved_event_count = Event.objects.filter(reservation__status=status_const.APPROVED, reservation__start_datetime__gte=week_start_datetime, reservation__start_datetime__lte=week_end_datetime).count()
-    attendance = Attendance.objects.filter(event__reservation__start_datetime__gte=week_start_datetime, event__reservation__start_datetime__lte=week_end_datetime)
-    attendance_count = attendance.count()
-    revenue = 0
-
-    for currentAttendance in attendance:
-        revenue = revenue + currentAttendance.event.student_fee
-
-    categories = Category.objects.all()
 
-    category_registration = {}
-    category_prepay = {}
-
-    for current_category in categories:
-        category_registration[current_category.name] = Attendance.objects.filter(event__category=current_category, event__reservation__start_datetime__gte=week_start_datetime, event__reservation__start_datetime__lte=week_end_datetime).count()
-        category_prepay[current_category.name] = Attendance.objects.filter(prepaid=True, event__category=current_category, event__reservation__start_datetime__gte=week_start_datetime, event__reservation__start_datetime__lte=week_end_datetime).count()
-
-    category_payment_data = {}
-
-    for current_category in category_registration:
-        current_category_percent_prepay = 0
-        if category_registration[current_category] != 0:
-            current_category_percent_prepay = category_prepay[current_category]/float(category_registration[current_category])*100
-        category_payment_data[current_category] = (category_registration[current_category], category_prepay[current_category], current_category_percent_prepay)
-
-    return render(request, template_name, {'form':form, 'total_event_count':total_event_count, 'approved_event_count':approved_event_count, 'attendance_count':attendance_count, 'revenue':revenue, 'category_payment_data':category_payment_data})
+    context = summary_data(start_datetime, end_datetime)
+    context['form'] = form
+    context['export_formats'] = export.FORMATS
+    return render(request, template_name, context)
 
 @login_required
 def attend(request, event_id):
@@ -297,20 +686,12 @@ def attend(request, event_id):
     """
     event = get_object_or_404(Event, pk=event_id)
 
-    user_register_count = Attendance.objects.filter(user=request.user, event=event).count()
-
-    if user_register_count != 0:
+    try:
+        registration.register(request.user, event, prepaid=False)
+    except registration.AlreadyRegistered:
         messages.error(request, "Error: You are already attending this event.")
-        return redirect('event_details', event_id=event_id)
-
-    timestamp = timezone.now()
-    #timestamp = timestamp.replace(tzinfo=timezone.utc)
-
-    attendance = Attendance(user=request.user,
-                    event=event, 
-                    prepaid=False,
-                    date_registered=timestamp)
-    attendance.save()
+    except registration.EventFull:
+        messages.error(request, "Error: This event is full.")
     return redirect('event_details', event_id=event_id)
 
 @login_required
@@ -324,42 +705,68 @@ def prepay(request, event_id):
         messages.error(request, "Error: Pre-payments are not accepted.")
         return redirect('event_details', event_id=event_id)
 
-    user_register_count = Attendance.objects.filter(user=request.user, event=event).count()
-
-    if user_register_count != 0:
+    try:
+        registration.register(request.user, event, prepaid=True)
+    except registration.AlreadyRegistered:
         messages.error(request, "Error: User has already prepaid for this event.")
-        return redirect('event_details', event_id=event_id)
-
-    timestamp = timezone.now()
-    #timestamp = timestamp.replace(tzinfo=timezone.utc)
-
-    attendance = Attendance(user=request.user,
-                    event=event, 
-                    prepaid=True,
-                    date_registered=timestamp)
-    attendance.save()
+    except registration.EventFull:
+        messages.error(request, "Error: This event is full.")
     return redirect('event_details', event_id=event_id)
 
 
 
+# Days ahead the occurrences of recurring events are listed on location pages
+LOCATION_OCCURRENCE_DAYS = 60
+
 @login_required
+@fragment_condition(lambda request, loc_id: [('location', loc_id), ('day', timezone.localtime(timezone.now()).date())])
 def location_details(request, loc_id, template_name="ajax/location_details.html"):
     """
     View location details and upcoming events at that location
     """
-    location = get_object_or_404(Location, pk=loc_id)
-    reservation_list = Reservation.objects.filter(status=status_const.APPROVED, location=location.id)
-    return render(request, template_name, {'location':location, 'reservation_list':reservation_list})
-
-
-
-
-
-
-def event_search(term):
-    """
-    Search event names that contain the given search term
-    """
-
-    search_results = Reservation.objects.filter(Q(status=status_const.APPROVED), Q(event__name__icontains=term) | Q(event__description__icontains=term) | Q(location__name__icontains=term))
-    return search_results
+    # Nothing on this page depends on the user, so the whole page is cached
+    # under the location's version. Recurring events are listed by their
+    # occurrences in the coming LOCATION_OCCURRENCE_DAYS, a window that
+    # moves daily.
+    today = timezone.localtime(timezone.now()).date()
+    key = caching.versioned_key('location_details', 'location', loc_id, template_name, today)
+    html = cache.get(key)
+    if html is None:
+        location = get_object_or_404(Location, pk=loc_id)
+        approved = Reservation.objects.filter(status=status_const.APPROVED, location=location.id)
+        window_start = timezone.make_aware(datetime.combine(today, datetime.min.time()), timezone.get_current_timezone())
+        window_end = window_start + timedelta(days=LOCATION_OCCURRENCE_DAYS)
+        occurrences = recurrence.expand(reservation_rows(recurrence.series_in_window(approved, window_start, window_end)),
+                                        window_start, window_end)
+        reservation_list = sorted(list(reservation_rows(recurrence.singles(approved))) + occurrences,
+                                  key=lambda reservation: reservation.start_datetime)
+        html = render_to_string(template_name, {'location':location, 'reservation_list':reservation_list,
+                                                'feed_urls':feeds.urls('location', location.id)})
+        cache.set(key, html, caching.CACHE_TIMEOUT)
+    return HttpResponse(html)
+
+
+FEED_TITLES = {'location': (Location, "Events at %s"), 'category': (Category, "%s events"), 'user': (User, "Events for %s")}
+
+def feed(request, kind, pk, fmt, feed_token=None):
+    """
+    iCalendar or JSON feed of the approved events at a location, in a
+    category, or created or attended by a user (see ems.feeds)
+    """
+    if not feeds.allowed(request, kind, pk, feed_token):
+        raise Http404
+    return _feed_response(request, kind, pk, fmt)
+
+@condition(etag_func=lambda request, kind, pk, fmt: feeds.etag(kind, pk, fmt),
+           last_modified_func=lambda request, kind, pk, fmt: feeds.last_modified(kind, pk))
+def _feed_response(request, kind, pk, fmt):
+    model, title = FEED_TITLES[kind]
+    name = title % get_object_or_404(model, pk=pk)
+    rows = feeds.reservations(kind, pk).iterator()
+    series = feeds.series(kind, pk)
+    base_url = request.build_absolute_uri('/')
+    if fmt == 'ics':
+        stamp = feeds.last_modified(kind, pk) or datetime.utcnow()
+        content = feeds.ics(rows, name, base_url, timezone.make_aware(stamp, timezone.utc), series)
+        return StreamingHttpResponse(content, content_type='text/calendar; charset=utf-8')
+    return StreamingHttpResponse(feeds.json_events(rows, name, base_url, series), content_type='application/json')
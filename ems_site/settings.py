@@ -40,14 +40,17 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'ems.middleware.RequestMetricsMiddleware',
+    'ems.middleware.ReplicaPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'ems.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+
 ROOT_URLCONF = 'ems_site.urls'
 
 WSGI_APPLICATION = 'ems_site.wsgi.application'
@@ -79,10 +82,29 @@ DATABASES = {
         'ENGINE': 'mysql.connector.django',
         'USER': 'root',
         'PASSWORD': '',
+        # Seconds a connection is kept open between requests
+        'CONN_MAX_AGE': 60,
     }
 }
 #****************************************************
 
+# Read replicas. Reports, search and listings (views decorated with
+# ems.routers.use_replica) read from one of EMS_READ_REPLICAS; a browser
+# reads from 'default' for EMS_REPLICA_LAG seconds after it writes. To try
+# it with two local SQLite files standing in for primary and replica, copy
+# db.sqlite3 to replica.sqlite3 after syncdb and add:
+#
+#    'replica': {
+#        'ENGINE': 'django.db.backends.sqlite3',
+#        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+#        'TEST_MIRROR': 'default',
+#    },
+#
+# with EMS_READ_REPLICAS = ['replica'].
+DATABASE_ROUTERS = ['ems.routers.ReplicaRouter']
+EMS_READ_REPLICAS = []
+EMS_REPLICA_LAG = 10
+
 
 
 # Internationalization
@@ -108,6 +130,22 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, "static"),
 )
 
+STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
+
+# collectstatic bundles, minifies and fingerprints the assets and writes
+# gzipped copies (see ems.assets). Templates use the bundles whenever
+# EMS_BUNDLE_ASSETS is on, which it is by default when DEBUG is off.
+# Serve STATIC_ROOT with far future expiry and gzip_static from the front
+# end server, or turn on EMS_SERVE_STATIC to serve it from the site.
+STATICFILES_STORAGE = 'ems.assets.BundledStaticFilesStorage'
+STATICFILES_FINDERS = (
+    'ems.assets.StaticFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+)
+EMS_SERVE_STATIC = False
+# select2 locales copied to STATIC_ROOT, e.g. ['de', 'fr']
+EMS_SELECT2_LOCALES = []
+
 #For web hosting
 #STATIC_URL = 'http://andyn.webfactional.com/static/'
 #STATIC_ROOT = '/home/andyn/webapps/ems_static/'
@@ -118,5 +156,76 @@ TEMPLATE_DIRS = (
     os.path.join(BASE_DIR, "templates"),
 )
 
+# Cache for request metrics and rendered pages. Use a shared backend such
+# as memcached in production so every worker sees the same versions:
+#    'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#    'LOCATION': '127.0.0.1:11211',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Turn on once CACHES is shared by every worker. Sessions are then read from
+# the cache and written through to the database, and the logged in user is
+# read from the cache too (see ems.auth). With a per-process cache they stay
+# in the database, as a logout, password change or deactivation handled by
+# one worker would go unseen by the others.
+EMS_SHARED_CACHE = False
+SESSION_ENGINE = ('django.contrib.sessions.backends.cached_db' if EMS_SHARED_CACHE
+                  else 'django.contrib.sessions.backends.db')
+
+# How long (in seconds) rendered event and location pages are cached.
+# Entries are replaced as soon as their data changes (see ems.caching), so
+# this only bounds the memory they use.
+EMS_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Request metrics (see ems.middleware and ems.metrics). Histograms live in
+# the cache, so use a shared cache backend in production to combine workers.
+# Views running more SQL queries than their budget log a warning. Turn on
+# EMS_QUERY_BUDGET_RAISE in development to have GET requests over budget
+# raise QueryBudgetExceeded instead.
+EMS_DEFAULT_QUERY_BUDGET = 20
+EMS_QUERY_BUDGETS = {
+    'all_events': 4,
+    'all_events_data': 8,
+    'my_events': 6,
+    'pending_events': 6,
+    'event_details': 8,
+    'location_details': 6,
+    'summary_report': 6,
+}
+EMS_QUERY_BUDGET_RAISE = False
+
+# Longest a reservation may last, in days. Conflict checks only look this far
+# back for reservations that could still be running (see ems.booking), so
+# existing longer reservations are not seen by them.
+EMS_MAX_RESERVATION_DAYS = 31
+
+# Background jobs (see ems.jobs), run by `manage.py run_worker`. With
+# EMS_JOBS_EAGER on, jobs run inside the request that queues them instead.
+EMS_JOBS_EAGER = False
+EMS_JOB_RETRY_DELAY = 30
+EMS_JOB_MAX_RETRY_DELAY = 60 * 60
+
+DEFAULT_FROM_EMAIL = 'ems@localhost'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'ems': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/'
\ No newline at end of file
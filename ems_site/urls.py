@@ -1,8 +1,9 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
 
 from django.contrib import admin
 admin.autodiscover()
-from ems import views
+from ems import assets, views
 urlpatterns = patterns('',
     url(r'^$', views.dashboard, name='dashboard'),
     url(r'^admin/', include(admin.site.urls)),
@@ -11,15 +12,29 @@ urlpatterns = patterns('',
     url(r'^register/$', views.register_user, name='register'),
     url(r'^my_events/$', views.my_events, name='my_events'),
     url(r'^all_events/$', views.all_events, name='all_events'),
+    url(r'^all_events/data/$', views.all_events_data, name='all_events_data'),
     url(r'^event/create/$', views.create_event, name='create_event'),
     url(r'^event/edit/(?P<event_id>\d+)/$', views.edit_event, name='edit_event'),
     url(r'^event/delete/(?P<event_id>\d+)/$', views.delete_event, name='delete_event'),
+    url(r'^event/cancel/(?P<event_id>\d+)/$', views.cancel_occurrence, name='cancel_occurrence'),
     url(r'^event/details/(?P<event_id>\d+)/$', views.event_details, name='event_details'),
+    url(r'^event/roster/(?P<event_id>\d+)\.(?P<fmt>csv|xlsx)$', views.export_roster, name='export_roster'),
+    url(r'^rosters\.(?P<fmt>csv|xlsx)$', views.export_rosters, name='export_rosters'),
     url(r'^location/(?P<loc_id>\d+)/$', views.location_details, name='location_details'),
+    url(r'^availability/$', views.availability, name='availability'),
     url(r'^event/attend/(?P<event_id>\d+)/$', views.attend, name='attend'),
     url(r'^event/prepay/(?P<event_id>\d+)/$', views.prepay, name='prepay'),
     url(r'^pending_events/$', views.pending_events, name='pending_events'),
     url(r'^event/approve/(?P<event_id>\d+)/$', views.approve_event, name="approve_event"),
     url(r'^event/deny/(?P<event_id>\d+)/$', views.deny_event, name="deny_event"),
+    url(r'^pending_events/moderate/$', views.moderate_events, name="moderate_events"),
+    url(r'^choices/(?P<model_name>\w+)/$', views.choice_search, name='choice_search'),
+    url(r'^feeds/(?P<kind>location|category|user)/(?P<pk>\d+)\.(?P<fmt>ics|json)$', views.feed, name='feed'),
+    url(r'^feeds/(?P<kind>location|category|user)/(?P<pk>\d+)/(?P<feed_token>\w+)\.(?P<fmt>ics|json)$', views.feed, name='feed'),
     url(r'^summary_report/$', views.summary_report, name='summary_report'),
 )
+
+if getattr(settings, 'EMS_SERVE_STATIC', False):
+    urlpatterns += patterns('',
+        url(r'^%s(?P<path>.*)$' % settings.STATIC_URL.lstrip('/'), assets.serve),
+    )